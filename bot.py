@@ -1,17 +1,51 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import sys
+import json
+import html
+import asyncio
 import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import groupby
+from zoneinfo import ZoneInfo
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
+
+# Настройка (.env читаем до импорта database, он берет из окружения значения по умолчанию)
+load_dotenv()
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, ContextTypes, ConversationHandler, 
-    MessageHandler, filters, CallbackQueryHandler
+    MessageHandler, filters, CallbackQueryHandler, TypeHandler, ApplicationHandlerStop
 )
 from telegram.constants import ParseMode
-from database import User, Project, DailyTask, SessionLocal, create_tables, generate_project_id
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from database import (
+    User, Project, DailyTask, ProjectMember, SessionLocal, ReadSessionLocal, current_user_id, get_engine, get_read_engine, create_tables, generate_project_id, set_task_status,
+    utcnow, user_timezone, run_lifecycle, rollup_stats, load_update_offset, save_update_offset, read_stats, clone_project, search_projects, claim_deliveries,
+    enqueue_message, enqueue_messages, due_outbox, finish_outbox, query_events, purge_event_months,
+    calendar_projects, iter_calendar_tasks, project_visible_to, add_project_members, add_member_tasks, team_progress, team_day_statuses, team_recipients,
+    weekly_report_data, bump_user_stats, project_stats_deltas, flush_task_stats,
+    DEFAULT_TIMEZONE
+)
+from scheduler import (
+    ReminderScheduler, next_fire_time, local_now, is_valid_timezone, parse_reminder_time, utc_minute_of_day
+)
+from dedup import UpdateDeduplicator
+from profiling import HandlerProfiler
+from eventlog import EventBuffer
+from ical import CalendarCache, calendar_header, calendar_footer, calendar_key, format_events, project_version
+from reports import lower_priority, render_weekly_report
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
 
-# Настройка
-load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -21,6 +55,109 @@ ADMINS = [499188225, 6166088736]
 # Состояния для диалогов
 PROJECT_NAME, PROJECT_DAYS, DAILY_TASKS, REMINDER_TIME, START_DATE, PROJECT_OWNER, CONFIRM_PROJECT = range(7)
 ADD_DAY, ADD_DAY_TASK, REMINDER_COUNT, REMINDER_TIMES, CHANGE_NAME, CONFIRM_NAME = range(7, 13)
+QUICK_NAME, QUICK_DAYS, QUICK_TASKS, QUICK_TIME, QUICK_DATE, QUICK_OWNER, QUICK_CONFIRM = range(13, 20)
+
+# Планировщик напоминаний: куча ближайших срабатываний всех активных проектов
+reminder_scheduler = ReminderScheduler()
+REMINDER_TICK_SECONDS = 30
+# Окно догоняющей отправки: напоминания, опоздавшие сильнее (например, бот был выключен), не отправляются
+REMINDER_CATCHUP_WINDOW = timedelta(minutes=int(os.getenv("REMINDER_CATCHUP_MINUTES", "15")))
+# Outbox: уведомления отправляются фоновой задачей пачками, с повторами при ошибках
+OUTBOX_TICK_SECONDS = 1
+OUTBOX_BATCH_SIZE = 25  # Не больше ~30 сообщений в секунду — лимит Telegram
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_RETRY_BASE_SECONDS = 5
+# Дайджест: все напоминания пользователя в одном сообщении (настраивается командой /digest)
+REMINDER_DIGEST_DEFAULT = os.getenv("REMINDER_DIGEST_DEFAULT", "1").lower() in ("1", "true", "yes", "on")
+DIGEST_MAX_PROJECTS = 10
+# Дайджест должен уложиться в лимит Telegram (4096 символов): длинные задачи
+# обрезаются, а по длине текста дайджест делится на несколько сообщений
+DIGEST_TASK_PREVIEW = 300
+DIGEST_MAX_LENGTH = 3500
+# Жизненный цикл проектов пересчитывается ежечасно, чтобы полночь каждого часового пояса обрабатывалась вовремя
+LIFECYCLE_INTERVAL_SECONDS = 3600
+# Счетчики /stats от смены статусов задач сбрасываются в БД пачкой
+STATS_FLUSH_SECONDS = int(os.getenv("STATS_FLUSH_SECONDS", "10"))
+# Периодическая сверка сводных таблиц /stats с исходными данными
+STATS_ROLLUP_INTERVAL_SECONDS = int(os.getenv("STATS_ROLLUP_MINUTES", "60")) * 60
+
+# Незавершенные диалоги сбрасываются после CONVERSATION_TIMEOUT_MINUTES бездействия
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT_MINUTES", "30")) * 60
+DRAFT_CLEANUP_INTERVAL_SECONDS = 600
+# Ключи user_data с черновиками диалогов
+DRAFT_KEYS = ('project', 'add_day', 'reminder_settings', 'new_name')
+
+# Дедупликация апдейтов: окно последних update_id и период сохранения high-water mark
+update_dedup = UpdateDeduplicator(window=int(os.getenv("UPDATE_DEDUP_WINDOW", "2048")))
+UPDATE_OFFSET_FLUSH_SECONDS = 5
+
+# Экспорт в календарь (/ical): файл собирается в буфере, который в памяти держит
+# не больше ICAL_SPOOL_BYTES, а дальше уходит во временный файл на диске
+ICAL_SPOOL_BYTES = 1024 * 1024
+ICAL_MAX_BYTES = 50 * 1024 * 1024  # Лимит Telegram на отправку документа ботом
+ICAL_FETCH_SIZE = 500
+calendar_cache = CalendarCache(os.getenv("ICAL_CACHE_DIR"))
+
+# Командный проект: сколько участников можно перечислить в мастере
+TEAM_MAX_MEMBERS = int(os.getenv("TEAM_MAX_MEMBERS", "500"))
+TEAM_NAMES_SHOWN = 10
+
+# Профилирование по /profile; при PROFILING_ENABLED=0 обработчики не оборачиваются вовсе
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "1").lower() in ("1", "true", "yes", "on")
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+profiler = HandlerProfiler()
+
+# Журнал событий: обработчики пишут в буфер, в БД он сбрасывается пачкой
+# раз в EVENT_FLUSH_MS или при накоплении EVENT_FLUSH_SIZE событий
+EVENT_FLUSH_MS = int(os.getenv("EVENT_FLUSH_MS", "1000"))
+EVENT_FLUSH_SIZE = int(os.getenv("EVENT_FLUSH_SIZE", "100"))
+EVENT_RETENTION_MONTHS = int(os.getenv("EVENT_RETENTION_MONTHS", "12"))
+EVENT_PURGE_INTERVAL_SECONDS = 86400
+HISTORY_LIMIT = 20
+event_log = EventBuffer(flush_size=EVENT_FLUSH_SIZE)
+
+# Недельный отчет: по понедельникам в REPORT_TIME (DEFAULT_TIMEZONE) за прошедшую неделю.
+# Графики, HTML и CSV рисуются в пуле процессов, чтобы не задерживать ответы на команды
+REPORT_TIME = os.getenv("REPORT_TIME", "09:00")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "1"))
+REPORT_USER_SUMMARIES = os.getenv("REPORT_USER_SUMMARIES", "1").lower() in ("1", "true", "yes", "on")
+report_pool = None
+
+@dataclass(slots=True)
+class ProjectDraft:
+    """Черновик проекта в мастере /newproject: задачи хранятся кортежем строк"""
+    name: str
+    days_count: int = 0
+    tasks: tuple = ()
+    reminder_time: str = None
+    start_date: datetime = None
+    owner_id: int = None
+    member_ids: tuple = ()  # Участники командного проекта (пусто — обычный проект)
+    message_id: int = None  # Сообщение мастера /quickproject, которое редактируется на каждом шаге
+    touched_at: float = field(default_factory=time.monotonic)
+    
+    @property
+    def current_day(self):
+        return len(self.tasks) + 1
+    
+    def touch(self):
+        self.touched_at = time.monotonic()
+    
+    def add_task(self, description):
+        self.tasks += (description,)
+        self.touch()
+    
+    def approx_size(self):
+        """Примерный размер черновика в байтах"""
+        return sys.getsizeof(self) + sys.getsizeof(self.tasks) + sys.getsizeof(self.name) + sys.getsizeof(self.member_ids) + sum(
+            sys.getsizeof(task) for task in self.tasks
+        )
+
+def clear_drafts(user_data):
+    """Удаляет из user_data все черновики диалогов"""
+    for key in DRAFT_KEYS:
+        user_data.pop(key, None)
 
 def is_admin(user_id: int) -> bool:
     return user_id in ADMINS
@@ -32,6 +169,36 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db(user_id):
+    """Сессия для обработчиков, которые только читают: реплика, если она настроена"""
+    db = ReadSessionLocal(user_id)
+    try:
+        return db
+    finally:
+        db.close()
+
+def init_project_schedule(project, tz_name):
+    """Заполняет у нового проекта end_date, current_day и ближайшее напоминание"""
+    project.end_date = project.start_date + timedelta(days=project.days_count - 1)
+    project.current_day = (local_now(tz_name).date() - project.start_date.date()).days + 1
+    return plan_reminder(project, tz_name)
+
+def plan_reminder(project, tz_name, after=None):
+    """Пересчитывает ближайшее напоминание проекта (только колонки, без commit).
+
+    После commit результат нужно передать в reminder_scheduler.schedule().
+    """
+    planned = None
+    if (project.status or "active") == "active":
+        planned = next_fire_time(
+            project.start_date, project.days_count, project.reminder_time or "09:00",
+            tz_name, after or utcnow()
+        )
+    fire_at = planned[0] if planned else None
+    project.next_reminder_at = fire_at
+    project.reminder_utc_minute = utc_minute_of_day(fire_at) if fire_at else None
+    return fire_at
+
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -75,27 +242,44 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📚 <b>Справка по командам:</b>
 
 🎯 <b>Основные команды:</b>
-• /newproject - Создать новый проект
+• /newproject - Создать новый проект (несколько Short ID в ответе «кому» — командный проект)
+• /quickproject - Быстрое создание проекта кнопками (задачи всех дней одним сообщением)
 • /myprojects - Показать мои проекты
 • /complete [ID] - Завершить проект
 • /plusoneday [ID] - Добавить день к проекту
 • /daily [ID] - Показать задачи проекта
+• /ical [ID] - Расписание проекта для календаря (без ID — всех проектов)
+• /complete_task [ID] [день] - Отметить задачу дня выполненной
+• /skip_task [ID] [день] - Пропустить задачу дня
 • /delete [ID] - Удалить проект
+• /savetemplate [ID] - Сохранить проект как шаблон
+• /templates - Список шаблонов
+• /find [текст] - Поиск проектов по названию и задачам
+• /clone [ID] [Short ID] [ДД.ММ] - Создать копию проекта или шаблона
 • /changename - Изменить свой никнейм
 
 ⚙️ <b>Настройки:</b>
 • /remindersettings [ID] - Настройки напоминаний (количество и время)
+• /timezone [пояс] - Часовой пояс для напоминаний (например, Europe/Moscow)
+• /digest [on|off] - Напоминания по всем проектам одним сообщением
 
 👑 <b>Админские команды:</b>
 • /projects - Все проекты в системе
 • /users - Список пользователей
+• /stats - Статистика выполнения и доставки напоминаний
+• /profile [секунды] - Профилирование обработчиков и SQL
+• /history [ID] - История проекта (/history user [Short ID] - пользователя)
+• /report [last] - Недельный отчет файлами HTML и CSV (last — за прошлую неделю)
 • /seereminder - Посмотреть пример сообщения напоминания
+• /drafts - Черновики проектов в памяти
+• /assign [ID] [ДД.ММ] [Short ID...] - Назначить шаблон нескольким пользователям
 
 💡 <b>Примеры:</b>
 • /newproject - создать проект
 • /complete 0001 - завершить проект 0001
 • /remindersettings 0001 - настроить напоминания для проекта 0001
 • /daily 0001 - показать задачи проекта 0001
+• /complete_task 0001 1 - отметить выполненной задачу дня 1
 """
     
     await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
@@ -106,7 +290,7 @@ async def users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
         return
     
-    db = get_db()
+    db = get_read_db(update.effective_user.id)
     users_list = db.query(User).all()
     
     lines = ["👥 <b>Пользователи системы:</b>"]
@@ -118,13 +302,179 @@ async def users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
+def percent(part, whole):
+    return f"{part * 100 // whole}%" if whole else "—"
+
+STATS_TOP_USERS = 15
+
+# Команда /stats (только для админа)
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
+        return
+    
+    # Только сводные таблицы: время ответа не зависит от объема истории задач
+    db = get_read_db(update.effective_user.id)
+    totals, user_rows, daily_rows = read_stats(db, top=STATS_TOP_USERS)
+    if not totals.users and not daily_rows:
+        await update.message.reply_text("📭 Статистика еще не собрана. Она обновляется раз в час.")
+        return
+    
+    completed, skipped = totals.tasks_completed, totals.tasks_skipped
+    lines = [
+        "📊 <b>Статистика</b>",
+        "",
+        f"🟢 Активных проектов: {totals.projects_active}",
+        f"📝 Задач: {totals.tasks_total} | ✅ {completed} | ⏭ {skipped} | ⏰ просрочено {totals.tasks_overdue}",
+        f"🎯 Выполнение: {percent(completed, completed + skipped)}",
+    ]
+    
+    if user_rows:
+        lines += ["", "👥 <b>По пользователям</b> (выполнено из завершенных дней):"]
+        for row, user in user_rows:
+            decided = row.tasks_completed + row.tasks_skipped
+            lines.append(
+                f"• {html.escape(display_name_of(user))} — {percent(row.tasks_completed, decided)} "
+                f"({row.tasks_completed}/{decided}) | ⏰ {row.tasks_overdue} | 🟢 {row.projects_active}"
+            )
+        if totals.users > STATS_TOP_USERS:
+            lines.append(f"… и еще {totals.users - STATS_TOP_USERS}")
+    
+    if daily_rows:
+        lines += ["", "📅 <b>По дням (UTC):</b>"]
+        for day in daily_rows:
+            delivered = day.reminders_sent + day.reminders_failed
+            lines.append(
+                f"• {day.day.strftime('%d.%m')}: 🟢 {day.active_projects} | ✅ {day.tasks_completed} | "
+                f"⏭ {day.tasks_skipped} | ⏰ {day.tasks_overdue} | "
+                f"📨 {day.reminders_sent}/{delivered} ({percent(day.reminders_sent, delivered)})"
+            )
+    
+    if totals.updated_at:
+        lines += ["", f"🔄 Сверка: {totals.updated_at.strftime('%d.%m %H:%M')} UTC"]
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# Команда /profile [секунды] (только для админа)
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
+        return
+    
+    if not PROFILING_ENABLED:
+        await update.message.reply_text("❌ Профилирование выключено (PROFILING_ENABLED=0).")
+        return
+    
+    if profiler.active:
+        await update.message.reply_text("⏳ Профилирование уже идет, дождитесь отчета.")
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        seconds = 0
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"❌ Используйте: /profile [секунды от 1 до {PROFILE_MAX_SECONDS}]")
+        return
+    
+    profiler.start([get_engine(), get_read_engine()])
+    context.job_queue.run_once(finish_profile, seconds, chat_id=update.effective_chat.id)
+    await update.message.reply_text(
+        f"🔬 Профилирование запущено на {seconds} с. Отчет придет документом."
+    )
+
+async def finish_profile(context: ContextTypes.DEFAULT_TYPE):
+    report, raw_stats = profiler.stop()
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    chat_id = context.job.chat_id
+    await context.bot.send_document(
+        chat_id=chat_id,
+        document=report.encode(),
+        filename=f"profile-{stamp}.txt",
+        caption=f"🔬 Отчет профилирования. Дольше всего: {profiler.summary() or 'нет вызовов'}"
+    )
+    # Дамп для snakeviz / python -m pstats
+    await context.bot.send_document(chat_id=chat_id, document=raw_stats, filename=f"profile-{stamp}.pstats")
+
+EVENT_LABELS = {
+    "project_created": "🆕 создан",
+    "project_cloned": "🧬 создан по образцу",
+    "project_assigned": "📌 назначен",
+    "template_saved": "📄 сохранен шаблон",
+    "project_completed": "🎉 завершен",
+    "project_deleted": "🗑️ удален",
+    "day_added": "➕ добавлен день",
+    "reminder_changed": "⏰ изменено время напоминаний",
+    "task_completed": "✅ задача выполнена",
+    "task_skipped": "⏭ задача пропущена",
+}
+
+# Команда /history [ID проекта] или /history user [Short ID] (только для админа)
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
+        return
+    
+    usage = "❌ Используйте: /history [ID проекта] или /history user [Short ID]"
+    if not context.args or len(context.args) > 2 or (len(context.args) == 2 and context.args[0] != "user"):
+        await update.message.reply_text(usage)
+        return
+    
+    # Недавние события могут еще лежать в буфере. Сброс идет в основную БД,
+    # поэтому и читаем из нее: отстающая реплика их еще не видит
+    event_log.flush()
+    db = get_db()
+    if len(context.args) == 2:
+        try:
+            target = find_user(db, int(context.args[1]))
+        except ValueError:
+            target = None
+        if not target:
+            await update.message.reply_text(f"❌ Пользователь с ID {context.args[1]} не найден.")
+            return
+        events = query_events(db, actor_id=target.id, limit=HISTORY_LIMIT)
+        title = f"📜 <b>История пользователя {html.escape(display_name_of(target))}</b>"
+    else:
+        events = query_events(db, project_id=context.args[0], limit=HISTORY_LIMIT)
+        title = f"📜 <b>История проекта {html.escape(context.args[0])}</b>"
+    
+    if not events:
+        await update.message.reply_text(f"{title}\n\n📭 Событий нет.", parse_mode=ParseMode.HTML)
+        return
+    
+    # Имена участников одним запросом
+    people = {event["actor_id"] for event in events} | {event["subject_id"] for event in events}
+    names = {
+        user.id: html.escape(display_name_of(user))
+        for user in db.query(User).filter(User.id.in_(people - {None})).all()
+    }
+    lines = [title, ""]
+    for event in events:
+        line = (
+            f"• {event['occurred_at'].strftime('%d.%m %H:%M')} "
+            f"{EVENT_LABELS.get(event['event_type'], event['event_type'])}"
+        )
+        if event["project_id"] and len(context.args) == 2:
+            line += f" <b>[{event['project_id']}]</b>"
+        details = json.loads(event["details"]) if event["details"] else {}
+        if "name" in details:
+            line += f" {html.escape(details['name'])}"
+        if "day" in details:
+            line += f", день {details['day']}"
+        line += f" — {names.get(event['actor_id'], event['actor_id'] or 'бот')}"
+        if event["subject_id"] and event["subject_id"] != event["actor_id"]:
+            line += f" → {names.get(event['subject_id'], event['subject_id'])}"
+        lines.append(line)
+    lines += ["", "🕐 Время UTC"]
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
 # Команда /projects (только для админа)
 async def all_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
         return
     
-    db = get_db()
+    db = get_read_db(update.effective_user.id)
     projects = db.query(Project).all()
     
     if not projects:
@@ -134,7 +484,7 @@ async def all_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lines = ["📋 <b>Все проекты в системе:</b>"]
     for p in projects:
         user = db.query(User).filter(User.id == p.user_id).first()
-        status_emoji = {"active": "🟢", "completed": "✅", "paused": "⏸️"}
+        status_emoji = {"active": "🟢", "completed": "✅", "paused": "⏸️", "template": "📄"}
         status = status_emoji.get(p.status, "❓")
         user_name = user.display_name or user.username or str(user.id)
         lines.append(f"<b>[{p.project_id}]</b> {p.name} — {user_name} {status}")
@@ -144,9 +494,17 @@ async def all_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Команда /myprojects
 async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db = get_db()
+    db = get_read_db(update.effective_user.id)
     
-    projects = db.query(Project).filter(Project.user_id == user_id).all()
+    projects = db.query(Project).filter(project_visible_to(user_id)).all()
+    # Прогресс командных проектов — одним запросом на все
+    team = team_progress(db, [p.id for p in projects if p.is_team], user_id)
+    
+    def progress_of(p):
+        if p.is_team:
+            done, total, _ = team.get(p.id, (0, 0, 0))
+            return done, total
+        return sum(1 for task in p.daily_tasks if task.completed == "completed"), len(p.daily_tasks)
     
     if not projects:
         await update.message.reply_text(
@@ -165,13 +523,12 @@ async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lines.append("")
         lines.append("🟢 <b>Активные:</b>")
         for p in active_projects:
-            completed_tasks = sum(1 for task in p.daily_tasks if task.completed == "completed")
-            total_tasks = len(p.daily_tasks)
+            completed_tasks, total_tasks = progress_of(p)
             progress = f"{completed_tasks}/{total_tasks}" if total_tasks > 0 else "0/0"
             
-            # Вычисляем даты начала и окончания
+            # Даты начала и окончания хранятся в проекте
             start_date = p.start_date
-            end_date = start_date + timedelta(days=p.days_count - 1)
+            end_date = p.end_date or start_date + timedelta(days=p.days_count - 1)
             
             # Получаем названия дней недели
             day_names = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
@@ -181,6 +538,10 @@ async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
             lines.append(f"• <b>[{p.project_id}]</b> {p.name}")
             lines.append(f"  📅 {p.days_count} дней | ⏰ {p.reminder_time} | 📊 {progress}")
             lines.append(f"  📆 {start_date.strftime('%d.%m')}({start_day}) - {end_date.strftime('%d.%m')}({end_day})")
+            if p.is_team:
+                lines.append(f"  👥 Командный проект: {team.get(p.id, (0, 0, 0))[2]} участников")
+            if p.current_day and 1 <= p.current_day <= p.days_count:
+                lines.append(f"  📍 Сегодня день {p.current_day} из {p.days_count}")
             lines.append("")
             if hasattr(p, 'created_by') and p.created_by and p.created_by != p.user_id:
                 assigner = db.query(User).filter(User.id == p.created_by).first()
@@ -197,13 +558,12 @@ async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if completed_projects:
         lines.append("✅ <b>Завершенные:</b>")
         for p in completed_projects:
-            completed_tasks = sum(1 for task in p.daily_tasks if task.completed == "completed")
-            total_tasks = len(p.daily_tasks)
+            completed_tasks, total_tasks = progress_of(p)
             progress = f"{completed_tasks}/{total_tasks}" if total_tasks > 0 else "0/0"
             
-            # Вычисляем даты начала и окончания
+            # Даты начала и окончания хранятся в проекте
             start_date = p.start_date
-            end_date = start_date + timedelta(days=p.days_count - 1)
+            end_date = p.end_date or start_date + timedelta(days=p.days_count - 1)
             
             # Получаем названия дней недели
             day_names = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
@@ -213,6 +573,8 @@ async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
             lines.append(f"• <b>[{p.project_id}]</b> {p.name}")
             lines.append(f"  📅 {p.days_count} дней | ⏰ {p.reminder_time} | 📊 {progress}")
             lines.append(f"  📆 {start_date.strftime('%d.%m')}({start_day}) - {end_date.strftime('%d.%m')}({end_day})")
+            if p.is_team:
+                lines.append(f"  👥 Командный проект: {team.get(p.id, (0, 0, 0))[2]} участников")
             lines.append("")
             if hasattr(p, 'created_by') and p.created_by and p.created_by != p.user_id:
                 assigner = db.query(User).filter(User.id == p.created_by).first()
@@ -251,7 +613,7 @@ async def newproject_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Название слишком длинное. Максимум 100 символов.")
         return PROJECT_NAME
     
-    context.user_data['project'] = {'name': project_name}
+    context.user_data['project'] = ProjectDraft(name=project_name)
     
     await update.message.reply_text(
         f"📝 <b>Проект:</b> {project_name}\n\n"
@@ -269,9 +631,10 @@ async def newproject_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Введите число от 1 до 30:")
         return PROJECT_DAYS
     
-    context.user_data['project']['days_count'] = days
-    context.user_data['project']['daily_tasks'] = []
-    context.user_data['current_day'] = 1
+    draft = context.user_data['project']
+    draft.days_count = days
+    draft.tasks = ()
+    draft.touch()
     
     await update.message.reply_text(
         f"📅 <b>Количество дней:</b> {days}\n\n"
@@ -282,16 +645,12 @@ async def newproject_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def newproject_daily_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     task_description = update.message.text.strip()
-    current_day = context.user_data['current_day']
-    days_count = context.user_data['project']['days_count']
+    draft = context.user_data['project']
+    current_day = draft.current_day
     
-    context.user_data['project']['daily_tasks'].append({
-        'day': current_day,
-        'description': task_description
-    })
+    draft.add_task(task_description)
     
-    if current_day < days_count:
-        context.user_data['current_day'] = current_day + 1
+    if current_day < draft.days_count:
         await update.message.reply_text(
             f"✅ <b>День {current_day}</b> добавлен!\n\n"
             f"📝 Напишите, что вы будете делать в <b>День {current_day + 1}</b>:",
@@ -310,11 +669,17 @@ async def newproject_daily_tasks(update: Update, context: ContextTypes.DEFAULT_T
 async def newproject_reminder_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
     time = update.message.text.strip()
     import re
-    if not re.match(r"^\d{2}:\d{2}$", time):
+    try:
+        if not re.match(r"^\d{2}:\d{2}$", time):
+            raise ValueError
+        parse_reminder_time(time)
+    except ValueError:
         await update.message.reply_text("❌ Введите время в формате HH:MM (например, 09:00):")
         return REMINDER_TIME
     
-    context.user_data['project']['reminder_time'] = time
+    draft = context.user_data['project']
+    draft.reminder_time = time
+    draft.touch()
     
     await update.message.reply_text(
         f"⏰ <b>Время напоминания:</b> {time}\n\n"
@@ -324,61 +689,72 @@ async def newproject_reminder_time(update: Update, context: ContextTypes.DEFAULT
     )
     return START_DATE
 
-async def newproject_start_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    date_text = update.message.text.strip()
+def parse_start_date(date_text, today):
+    """Разбирает дату начала ДД.ММ относительно `today` (дата пользователя).
+
+    Бросает ValueError с текстом ошибки для пользователя.
+    """
     import re
     
     # Проверяем формат ДД.ММ
     if not re.match(r"^\d{2}\.\d{2}$", date_text):
-        await update.message.reply_text("❌ Введите дату в формате ДД.ММ (например, 01.07):")
-        return START_DATE
+        raise ValueError("❌ Введите дату в формате ДД.ММ (например, 01.07):")
     
+    day, month = date_text.split('.')
     try:
-        day, month = date_text.split('.')
-        day, month = int(day), int(month)
-        
         # Проверяем валидность даты
-        current_year = datetime.now().year
-        start_date = datetime(current_year, month, day)
-        
-        # Проверяем, что дата не в прошлом
-        if start_date < datetime.now():
-            await update.message.reply_text("❌ Дата начала не может быть в прошлом. Введите другую дату:")
-            return START_DATE
-        
-        # Проверяем, что дата не слишком далеко в будущем (максимум 1 год)
-        max_future_date = datetime.now() + timedelta(days=365)
-        if start_date > max_future_date:
-            await update.message.reply_text("❌ Дата начала не может быть более чем через год. Введите другую дату:")
-            return START_DATE
-            
+        start_date = datetime(today.year, int(month), int(day))
     except ValueError:
-        await update.message.reply_text("❌ Неверная дата. Введите дату в формате ДД.ММ (например, 01.07):")
+        raise ValueError("❌ Неверная дата. Введите дату в формате ДД.ММ (например, 01.07):")
+    
+    # Проверяем, что дата не в прошлом
+    if start_date.date() < today:
+        raise ValueError("❌ Дата начала не может быть в прошлом. Введите другую дату:")
+    
+    # Проверяем, что дата не слишком далеко в будущем (максимум 1 год)
+    if start_date.date() > today + timedelta(days=365):
+        raise ValueError("❌ Дата начала не может быть более чем через год. Введите другую дату:")
+    
+    return start_date
+
+async def newproject_start_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    date_text = update.message.text.strip()
+    
+    # Сравниваем с текущей датой в часовом поясе пользователя
+    db = get_db()
+    today = local_now(user_timezone(db, update.effective_user.id)).date()
+    
+    try:
+        start_date = parse_start_date(date_text, today)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
         return START_DATE
     
-    context.user_data['project']['start_date'] = start_date
+    draft = context.user_data['project']
+    draft.start_date = start_date
+    draft.touch()
     
     # Показываем подтверждение
-    project_data = context.user_data['project']
     lines = [
         f"📋 <b>Подтверждение проекта:</b>",
         f"",
-        f"🎯 <b>Название:</b> {project_data['name']}",
-        f"📅 <b>Дней:</b> {project_data['days_count']}",
+        f"🎯 <b>Название:</b> {draft.name}",
+        f"📅 <b>Дней:</b> {draft.days_count}",
         f"📆 <b>Дата начала:</b> {start_date.strftime('%d.%m.%Y')}",
-        f"⏰ <b>Время напоминания:</b> {project_data['reminder_time']}",
+        f"⏰ <b>Время напоминания:</b> {draft.reminder_time}",
         f"",
         f"📝 <b>Ежедневные задачи:</b>"
     ]
     
-    for task in project_data['daily_tasks']:
-        lines.append(f"<b>День {task['day']}:</b> {task['description']}")
+    for day, description in enumerate(draft.tasks, start=1):
+        lines.append(f"<b>День {day}:</b> {description}")
     
     lines.append("")
     lines.append("👤 <b>Кому назначить проект?</b>")
     lines.append("")
     lines.append("• Напишите 'себе' для создания проекта для себя")
     lines.append("• Напишите Short ID пользователя (число в скобках)")
+    lines.append("• Напишите несколько Short ID через пробел или запятую — командный проект")
     lines.append("")
     
     # Получаем список пользователей
@@ -397,64 +773,76 @@ async def newproject_start_date(update: Update, context: ContextTypes.DEFAULT_TY
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
     return PROJECT_OWNER
 
+def format_team(members):
+    """Подпись команды: число участников и первые имена"""
+    names = ", ".join(display_name_of(member) for member in members[:TEAM_NAMES_SHOWN])
+    if len(members) > TEAM_NAMES_SHOWN:
+        names += f" и еще {len(members) - TEAM_NAMES_SHOWN}"
+    return f"{len(members)} чел.: {names}"
+
+def resolve_owner_input(db, owner_input, user_id):
+    """Разбирает ответ на вопрос «кому назначить проект».
+
+    'себе', один ID (основной или Short ID) или список Short ID через пробел
+    или запятую — тогда проект командный, а все участники ищутся одним
+    запросом IN. Возвращает (ID владельца, ID участников, подпись), при
+    ошибке бросает ValueError с текстом для пользователя.
+    """
+    import re
+    if owner_input == "себе":
+        return user_id, (), "себя"
+    if not re.fullmatch(r"[\d\s,;]+", owner_input):
+        raise ValueError("❌ Неверный формат. Напишите 'себе', ID пользователя или несколько Short ID через запятую.")
+    ids = list(dict.fromkeys(int(x) for x in re.findall(r"\d+", owner_input)))
+    if len(ids) == 1:
+        owner_user = find_user(db, ids[0])
+        if not owner_user:
+            raise ValueError(f"❌ Пользователь с ID {ids[0]} не найден.")
+        return owner_user.id, (), display_name_of(owner_user)
+    if len(ids) > TEAM_MAX_MEMBERS:
+        raise ValueError(f"❌ В команде может быть не больше {TEAM_MAX_MEMBERS} участников.")
+    
+    members = db.query(User).filter(User.short_id.in_(ids)).order_by(User.short_id).all()
+    missing = sorted(set(ids) - {member.short_id for member in members})
+    if missing:
+        raise ValueError(f"❌ Не найдены пользователи с Short ID: {', '.join(map(str, missing))}.")
+    return user_id, tuple(member.id for member in members), format_team(members)
+
 async def newproject_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     owner_input = update.message.text.strip().lower()
+    draft = context.user_data['project']
+    draft.touch()
     db = get_db()
     
-    if owner_input == "себе":
-        # Проект для себя
-        context.user_data['project']['owner_id'] = update.effective_user.id
-        owner_name = "себя"
-    else:
-        # Проверяем, является ли ввод числом (ID пользователя)
-        try:
-            input_id = int(owner_input)
-            
-            # Сначала ищем по основному ID
-            owner_user = db.query(User).filter(User.id == input_id).first()
-            
-            # Если не найден, ищем по short_id
-            if not owner_user:
-                owner_user = db.query(User).filter(User.short_id == input_id).first()
-            
-            if not owner_user:
-                await update.message.reply_text(
-                    f"❌ Пользователь с ID {input_id} не найден.\n\n"
-                    f"💡 Используйте /users чтобы посмотреть список пользователей.\n"
-                    f"   Можно использовать основной ID или Short ID.\n\n"
-                    f"👤 Напишите 'себе' или ID пользователя:",
-                    parse_mode=ParseMode.HTML
-                )
-                return PROJECT_OWNER
-            
-            context.user_data['project']['owner_id'] = owner_user.id  # Всегда используем основной ID
-            owner_name = owner_user.display_name or owner_user.username or str(owner_user.id)
-            
-        except ValueError:
-            await update.message.reply_text(
-                "❌ Неверный формат. Напишите 'себе' или ID пользователя (число):",
-                parse_mode=ParseMode.HTML
-            )
-            return PROJECT_OWNER
+    try:
+        draft.owner_id, draft.member_ids, owner_name = resolve_owner_input(db, owner_input, update.effective_user.id)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"{e}\n\n"
+            f"💡 Используйте /users чтобы посмотреть список пользователей.\n"
+            f"   Можно использовать основной ID или Short ID.\n\n"
+            f"👤 Напишите 'себе', ID пользователя или несколько Short ID через запятую:",
+            parse_mode=ParseMode.HTML
+        )
+        return PROJECT_OWNER
     
     # Показываем финальное подтверждение
-    project_data = context.user_data['project']
-    start_date = project_data['start_date']
+    start_date = draft.start_date
     
     lines = [
         f"📋 <b>Подтверждение проекта:</b>",
         f"",
-        f"🎯 <b>Название:</b> {project_data['name']}",
-        f"👤 <b>Владелец:</b> {owner_name}",
-        f"📅 <b>Дней:</b> {project_data['days_count']}",
+        f"🎯 <b>Название:</b> {draft.name}",
+        f"👥 <b>Команда:</b> {owner_name}" if draft.member_ids else f"👤 <b>Владелец:</b> {owner_name}",
+        f"📅 <b>Дней:</b> {draft.days_count}",
         f"📆 <b>Дата начала:</b> {start_date.strftime('%d.%m.%Y')}",
-        f"⏰ <b>Время напоминания:</b> {project_data['reminder_time']}",
+        f"⏰ <b>Время напоминания:</b> {draft.reminder_time}",
         f"",
         f"📝 <b>Ежедневные задачи:</b>"
     ]
     
-    for task in project_data['daily_tasks']:
-        lines.append(f"<b>День {task['day']}:</b> {task['description']}")
+    for day, description in enumerate(draft.tasks, start=1):
+        lines.append(f"<b>День {day}:</b> {description}")
     
     lines.append("")
     lines.append("✅ Напишите 'да' для создания проекта или 'нет' для отмены:")
@@ -462,66 +850,94 @@ async def newproject_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
     return CONFIRM_PROJECT
 
-async def newproject_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text.strip().lower() != 'да':
-        await update.message.reply_text("❌ Создание проекта отменено.")
-        return ConversationHandler.END
-    
-    user_id = update.effective_user.id
-    project_data = context.user_data['project']
-    db = get_db()
-    
+def save_project_draft(db, project_data, user_id, creation_key=None):
+    """Сохраняет черновик проекта в БД одной транзакцией.
+
+    creation_key — ключ идемпотентности (чат и сообщение подтверждения): при
+    повторной обработке того же подтверждения возвращается уже созданный проект.
+    Уведомление владельцу (если проект назначен другому) попадает в outbox
+    той же транзакцией. Командный проект (project_data.member_ids) принадлежит
+    создателю, а участники, их статусы задач и уведомления им добавляются
+    пакетными INSERT. Возвращает (проект, текст об успехе).
+    """
+    member_ids = project_data.member_ids
+    # Получаем ID владельца проекта (командным проектом руководит создатель)
+    owner_id = user_id if member_ids else project_data.owner_id or user_id  # По умолчанию создатель проекта
+    start_date = project_data.start_date or datetime.now() + timedelta(days=1)
+    print(f"[DEBUG] Создаём проект: name={project_data.name}, owner_id={owner_id}, created_by={user_id}")
+    # Определяем, кто создал проект
+    creator_user = db.query(User).filter(User.id == user_id).first()
+    creator_name = creator_user.display_name or creator_user.username or str(creator_user.id)
+    # Создаем проект
+    project = Project(
+        project_id=generate_project_id(),
+        user_id=owner_id,  # Используем указанного владельца
+        name=project_data.name,
+        days_count=project_data.days_count,
+        reminder_time=project_data.reminder_time,
+        start_date=start_date,
+        created_by=user_id,  # Сохраняем, кто назначил
+        creation_key=creation_key,
+        is_team=bool(member_ids)
+    )
+    fire_at = init_project_schedule(project, user_timezone(db, owner_id))
+    # Проект и задачи сохраняем вместе: при сбое не останется проекта без задач
+    project.daily_tasks = [
+        DailyTask(day_number=day, description=description)
+        for day, description in enumerate(project_data.tasks, start=1)
+    ]
+    db.add(project)
+    if not member_ids:
+        # Сводка /stats обновляется в той же транзакции, что и проект
+        bump_user_stats(db, {owner_id: {"projects_active": 1, "tasks_total": len(project.daily_tasks)}})
+    if owner_id != user_id:
+        enqueue_message(db, "assignment", owner_id, format_assignment_notice(creator_name, project.name, project.project_id))
     try:
-        # Получаем ID владельца проекта
-        owner_id = project_data.get('owner_id', user_id)  # По умолчанию создатель проекта
-        print(f"[DEBUG] Создаём проект: name={project_data['name']}, owner_id={owner_id}, created_by={user_id}")
-        # Создаем проект
-        project = Project(
-            project_id=generate_project_id(),
-            user_id=owner_id,  # Используем указанного владельца
-            name=project_data['name'],
-            days_count=project_data['days_count'],
-            reminder_time=project_data['reminder_time'],
-            start_date=project_data.get('start_date', datetime.now() + timedelta(days=1)),
-            created_by=user_id  # Сохраняем, кто назначил
+        if member_ids:
+            # id проекта нужен для пакетной вставки участников
+            db.flush()
+            add_project_members(db, project.id, member_ids)
+            bump_user_stats(db, project_stats_deltas(db, Project.id == project.id))
+            notice = format_assignment_notice(creator_name, project.name, project.project_id)
+            enqueue_messages(db, "assignment", [
+                (member_id, notice, None, ()) for member_id in member_ids if member_id != user_id
+            ])
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = creation_key and db.query(Project).filter(Project.creation_key == creation_key).first()
+        if not existing:
+            raise
+        # Повтор того же подтверждения: проект уже создан, второй раз не создаем
+        logger.info(f"Повторное подтверждение {creation_key}: проект {existing.project_id} уже создан")
+        project, owner_id = existing, existing.user_id
+    else:
+        reminder_scheduler.schedule(project.id, fire_at)
+        event_log.append(
+            "project_created", user_id, project.project_id, owner_id,
+            name=project.name, days=project.days_count, **({"members": len(member_ids)} if member_ids else {})
         )
-        db.add(project)
-        db.commit()  # Сначала сохраняем проект
-        print(f"[DEBUG] Проект сохранён: id={project.id}, project_id={project.project_id}, created_by={project.created_by}, user_id={project.user_id}")
-        
-        # Создаем ежедневные задачи
-        for task_data in project_data['daily_tasks']:
-            daily_task = DailyTask(
-                project_id=project.id,
-                day_number=task_data['day'],
-                description=task_data['description']
-            )
-            db.add(daily_task)
-        
-        db.commit()  # Сохраняем задачи
-        
-        # Формируем сообщение об успехе
-        
-        # Получаем дату начала проекта
-        start_date = project.start_date
-        day_names = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-        day_name = day_names[start_date.weekday()]
-        
-        # Получаем информацию о владельце проекта
-        owner_user = db.query(User).filter(User.id == owner_id).first()
-        owner_name = owner_user.display_name or owner_user.username or str(owner_user.id)
-        
-        # Определяем, кто создал проект
-        creator_user = db.query(User).filter(User.id == user_id).first()
-        creator_name = creator_user.display_name or creator_user.username or str(creator_user.id)
-        
-        success_text = f"""
+    print(f"[DEBUG] Проект сохранён: id={project.id}, project_id={project.project_id}, created_by={project.created_by}, user_id={project.user_id}")
+    
+    # Формируем сообщение об успехе
+    
+    # Получаем дату начала проекта
+    start_date = project.start_date
+    day_names = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+    day_name = day_names[start_date.weekday()]
+    
+    # Получаем информацию о владельце проекта
+    owner_user = db.query(User).filter(User.id == owner_id).first()
+    owner_name = owner_user.display_name or owner_user.username or str(owner_user.id)
+    team_line = f"\n• <b>Участников:</b> {len(project.members)}" if project.is_team else ""
+    
+    success_text = f"""
 🎉 <b>Проект успешно создан!</b>
 
 📋 <b>Детали проекта:</b>
 • <b>Название:</b> {project.name}
 • <b>ID проекта:</b> <code>{project.project_id}</code>
-• <b>Владелец:</b> {owner_name}
+• <b>Владелец:</b> {owner_name}{team_line}
 • <b>Создал:</b> {creator_name}
 • <b>Дней:</b> {project.days_count}
 • <b>Время напоминания:</b> {project.reminder_time}
@@ -536,25 +952,36 @@ async def newproject_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
 • /remindersettings {project.project_id} - настройки напоминаний
 • /myprojects - мои проекты
 """
+    
+    return project, success_text
+
+def format_assignment_notice(creator_name, project_name, project_id):
+    """Текст уведомления пользователю, которому назначили проект"""
+    return (
+        f"👋 <b>Привет!</b>\n\n"
+        f"Пользователь <b>{creator_name}</b> назначил вам новый проект!\n\n"
+        f"• <b>Название:</b> {project_name}\n"
+        f"• <b>ID:</b> <code>{project_id}</code>\n\n"
+        f"Посмотреть все проекты: /myprojects"
+    )
+
+async def newproject_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text.strip().lower() != 'да':
+        context.user_data.pop('project', None)
+        await update.message.reply_text("❌ Создание проекта отменено.")
+        return ConversationHandler.END
+    
+    user_id = update.effective_user.id
+    project_data = context.user_data.pop('project')
+    db = get_db()
+    
+    try:
+        # Ключ — сообщение «да»: повторная доставка того же апдейта не создаст второй проект
+        creation_key = f"{update.effective_chat.id}:{update.message.message_id}"
+        project, success_text = save_project_draft(db, project_data, user_id, creation_key)
         
         await update.message.reply_text(success_text, parse_mode=ParseMode.HTML)
         
-        # Уведомление назначенному пользователю
-        if owner_id != user_id:
-            try:
-                print(f"[DEBUG] Пробую отправить уведомление пользователю {owner_id}")
-                notify_text = (
-                    f"👋 <b>Привет!</b>\n\n"
-                    f"Пользователь <b>{creator_name}</b> назначил вам новый проект!\n\n"
-                    f"• <b>Название:</b> {project.name}\n"
-                    f"• <b>ID:</b> <code>{project.project_id}</code>\n\n"
-                    f"Посмотреть все проекты: /myprojects"
-                )
-                await context.bot.send_message(chat_id=owner_id, text=notify_text, parse_mode=ParseMode.HTML)
-                print(f"[DEBUG] Уведомление отправлено пользователю {owner_id}")
-            except Exception as e:
-                print(f"[DEBUG] Не удалось отправить уведомление: {e}")
-        
     except Exception as e:
         db.rollback()
         logger.error(f"Ошибка создания проекта: {e}")
@@ -564,34 +991,562 @@ async def newproject_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ConversationHandler.END
 
 async def newproject_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clear_drafts(context.user_data)
     await update.message.reply_text("❌ Создание проекта отменено.")
     return ConversationHandler.END
 
-# Команда /complete [ID]
-async def complete_project(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Диалог брошен: истек CONVERSATION_TIMEOUT
+def conversation_timeout(draft_key):
+    """Обработчик таймаута диалога: удаляет только черновик этого диалога (ключ из DRAFT_KEYS)"""
+    async def on_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        context.user_data.pop(draft_key, None)
+        if update.effective_chat:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="⌛ Диалог закрыт из-за бездействия. Черновик удален, начните заново при необходимости."
+            )
+        return ConversationHandler.END
+    on_timeout.__name__ = f"conversation_timeout_{draft_key}"
+    return on_timeout
+
+# Быстрый мастер /quickproject: одно сообщение бота, которое редактируется на каждом шаге
+QUICK_TIME_PRESETS = ["07:00", "08:00", "09:00", "10:00", "12:00", "15:00", "18:00", "21:00"]
+QUICK_DATE_CHOICES = 14
+QUICK_OWNER_BUTTONS = 30
+# Сообщение мастера не должно превышать 4096 символов (лимит Telegram):
+# длинные задачи обрезаются, а список дней сворачивается в «… и еще N»
+QUICK_TASK_PREVIEW = 80
+QUICK_SUMMARY_LIMIT = 3000
+
+def _quick_keyboard(buttons, per_row):
+    rows = [buttons[i:i + per_row] for i in range(0, len(buttons), per_row)]
+    rows.append([InlineKeyboardButton("❌ Отмена", callback_data="qp:cancel")])
+    return InlineKeyboardMarkup(rows)
+
+def _quick_summary(draft):
+    """Шапка сообщения мастера с уже заполненными полями"""
+    lines = ["🎯 <b>Создание нового проекта</b>", ""]
+    if draft.name:
+        lines.append(f"📝 <b>Проект:</b> {html.escape(draft.name)}")
+    if draft.days_count:
+        lines.append(f"📅 <b>Дней:</b> {draft.days_count}")
+    if draft.tasks:
+        lines.append("📝 <b>Ежедневные задачи:</b>")
+        budget = QUICK_SUMMARY_LIMIT - sum(len(line) + 1 for line in lines)
+        for day, description in enumerate(draft.tasks, start=1):
+            if len(description) > QUICK_TASK_PREVIEW:
+                description = description[:QUICK_TASK_PREVIEW - 1] + "…"
+            line = f"<b>День {day}:</b> {html.escape(description)}"
+            if len(line) + 1 > budget:
+                lines.append(f"… и еще {len(draft.tasks) - day + 1}")
+                break
+            lines.append(line)
+            budget -= len(line) + 1
+    if draft.reminder_time:
+        lines.append(f"⏰ <b>Время напоминания:</b> {draft.reminder_time}")
+    if draft.start_date:
+        lines.append(f"📆 <b>Дата начала:</b> {draft.start_date.strftime('%d.%m.%Y')}")
+    lines.append("")
+    return lines
+
+async def _edit_quick(context, chat_id, draft, lines, keyboard=None):
+    """Обновляет сообщение мастера вместо отправки нового"""
+    draft.touch()
+    try:
+        await context.bot.edit_message_text(
+            chat_id=chat_id, message_id=draft.message_id, text="\n".join(lines),
+            parse_mode=ParseMode.HTML, reply_markup=keyboard
+        )
+    except BadRequest as e:
+        # Повторная ошибка ввода дает тот же текст — Telegram отвечает «message is not modified»
+        if "not modified" in str(e).lower():
+            return
+        # Сообщение мастера удалено или не принято — продолжаем мастер новым сообщением с вопросом шага
+        logger.warning(f"Не удалось обновить сообщение мастера: {e}")
+        message = await context.bot.send_message(
+            chat_id=chat_id, text=f"⚠️ Не удалось показать сводку проекта.\n\n{lines[-1]}",
+            parse_mode=ParseMode.HTML, reply_markup=keyboard
+        )
+        draft.message_id = message.message_id
+
+def parse_task_lines(text):
+    """Разбирает вставленный список задач: одна строка — один день.
+
+    Отбрасывается только нумерация вида «1. », «2) » и «День 3:» — число
+    в начале самой задачи остается:
+
+    >>> parse_task_lines("1. Зарядка\\n2) Чтение\\nДень 3: Бег\\n10-минутная зарядка\\n1.5 км пешком")
+    ('Зарядка', 'Чтение', 'Бег', '10-минутная зарядка', '1.5 км пешком')
+    """
+    import re
+    tasks = []
+    for line in text.splitlines():
+        line = re.sub(r"^\s*(день\s*\d+\s*[.):\-]|день\s*\d+\s|\d+[.)]\s)\s*", "", line, flags=re.IGNORECASE).strip()
+        if line:
+            tasks.append(line)
+    return tuple(tasks)
+
+async def _quick_ask_days(context, chat_id, draft, error=None):
+    lines = _quick_summary(draft)
+    if error:
+        lines.append(error)
+    lines.append("📅 Выберите количество дней:")
+    buttons = [InlineKeyboardButton(str(days), callback_data=f"qp:days:{days}") for days in range(1, 31)]
+    await _edit_quick(context, chat_id, draft, lines, _quick_keyboard(buttons, 6))
+
+async def _quick_ask_tasks(context, chat_id, draft, error=None):
+    lines = _quick_summary(draft)
+    if error:
+        lines.append(error)
+    lines.append(f"📝 Отправьте задачи на все {draft.days_count} дн. одним сообщением — по одной строке на день:")
+    lines.append("<i>Посмотреть материалы\nСделать конспект\n...</i>")
+    await _edit_quick(context, chat_id, draft, lines, _quick_keyboard([], 1))
+
+async def _quick_ask_time(context, chat_id, draft, error=None):
+    lines = _quick_summary(draft)
+    if error:
+        lines.append(error)
+    lines.append("⏰ Выберите время напоминания или напишите свое (HH:MM):")
+    buttons = [InlineKeyboardButton(t, callback_data=f"qp:time:{t}") for t in QUICK_TIME_PRESETS]
+    await _edit_quick(context, chat_id, draft, lines, _quick_keyboard(buttons, 4))
+
+async def _quick_ask_date(context, chat_id, draft, user_id, error=None):
+    db = get_db()
+    today = local_now(user_timezone(db, user_id)).date()
+    day_names = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+    buttons = [
+        InlineKeyboardButton(
+            f"{day.strftime('%d.%m')} {day_names[day.weekday()]}",
+            callback_data=f"qp:date:{day.isoformat()}"
+        )
+        for day in (today + timedelta(days=i) for i in range(QUICK_DATE_CHOICES))
+    ]
+    lines = _quick_summary(draft)
+    if error:
+        lines.append(error)
+    lines.append("📆 Выберите дату начала проекта:")
+    await _edit_quick(context, chat_id, draft, lines, _quick_keyboard(buttons, 4))
+
+async def _quick_ask_owner(context, chat_id, draft, error=None):
+    db = get_db()
+    users_list = db.query(User).order_by(User.short_id).limit(QUICK_OWNER_BUTTONS).all()
+    buttons = [InlineKeyboardButton("👤 Себе", callback_data="qp:owner:self")] + [
+        InlineKeyboardButton(
+            f"[{u.short_id}] {u.display_name or u.username or u.id}",
+            callback_data=f"qp:owner:{u.id}"
+        )
+        for u in users_list
+    ]
+    lines = _quick_summary(draft)
+    if error:
+        lines.append(error)
+    lines.append("👤 Кому назначить проект? Выберите пользователя или напишите его Short ID (несколько через запятую — командный проект):")
+    await _edit_quick(context, chat_id, draft, lines, _quick_keyboard(buttons, 2))
+
+async def _quick_ask_confirm(context, chat_id, draft, owner_name):
+    lines = _quick_summary(draft)
+    lines.append(f"👥 <b>Команда:</b> {owner_name}" if draft.member_ids else f"👤 <b>Владелец:</b> {owner_name}")
+    lines.append("")
+    lines.append("✅ Создать проект?")
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Создать", callback_data="qp:confirm"),
+        InlineKeyboardButton("❌ Отмена", callback_data="qp:cancel"),
+    ]])
+    await _edit_quick(context, chat_id, draft, lines, keyboard)
+
+def find_user(db, input_id):
+    """Ищет пользователя сначала по основному ID, затем по short_id"""
+    user = db.query(User).filter(User.id == input_id).first()
+    if not user:
+        user = db.query(User).filter(User.short_id == input_id).first()
+    return user
+
+# Команда /quickproject
+async def quickproject_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Черновики других диалогов (/plusoneday, /remindersettings...) не трогаем
+    context.user_data.pop('project', None)
+    message = await update.message.reply_text(
+        "🎯 <b>Создание нового проекта</b>\n\n📝 Назовите ваш проект:",
+        parse_mode=ParseMode.HTML,
+        reply_markup=_quick_keyboard([], 1)
+    )
+    context.user_data['project'] = ProjectDraft(name="", message_id=message.message_id)
+    return QUICK_NAME
+
+async def quickproject_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    draft = context.user_data['project']
+    project_name = update.message.text.strip()
+    if len(project_name) > 100:
+        lines = _quick_summary(draft) + ["❌ Название слишком длинное. Максимум 100 символов.", "📝 Назовите ваш проект:"]
+        await _edit_quick(context, update.effective_chat.id, draft, lines, _quick_keyboard([], 1))
+        return QUICK_NAME
+    
+    draft.name = project_name
+    await _quick_ask_days(context, update.effective_chat.id, draft)
+    return QUICK_DAYS
+
+async def quickproject_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    draft = context.user_data['project']
+    draft.days_count = int(query.data.split(":")[2])
+    draft.tasks = ()
+    await _quick_ask_tasks(context, update.effective_chat.id, draft)
+    return QUICK_TASKS
+
+async def quickproject_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    draft = context.user_data['project']
+    tasks = parse_task_lines(update.message.text)
+    if len(tasks) != draft.days_count:
+        await _quick_ask_tasks(
+            context, update.effective_chat.id, draft,
+            error=f"❌ Получено строк: {len(tasks)}, нужно ровно {draft.days_count}. Отправьте список еще раз."
+        )
+        return QUICK_TASKS
+    
+    draft.tasks = tasks
+    await _quick_ask_time(context, update.effective_chat.id, draft)
+    return QUICK_TIME
+
+async def _quick_set_time(update, context, value):
+    draft = context.user_data['project']
+    try:
+        parse_reminder_time(value)
+        if len(value) != 5:
+            raise ValueError
+    except ValueError:
+        await _quick_ask_time(context, update.effective_chat.id, draft, error="❌ Введите время в формате HH:MM (например, 09:00).")
+        return QUICK_TIME
+    
+    draft.reminder_time = value
+    await _quick_ask_date(context, update.effective_chat.id, draft, update.effective_user.id)
+    return QUICK_DATE
+
+async def quickproject_time_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    return await _quick_set_time(update, context, query.data.split(":", 2)[2])
+
+async def quickproject_time_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _quick_set_time(update, context, update.message.text.strip())
+
+async def quickproject_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    draft = context.user_data['project']
+    # Кнопка могла остаться от вчерашнего сообщения: дату проверяем на момент нажатия
+    today = local_now(user_timezone(get_db(), update.effective_user.id)).date()
+    try:
+        start_date = datetime.fromisoformat(query.data.split(":", 2)[2])
+    except ValueError:
+        start_date = None
+    if start_date is None or not today <= start_date.date() < today + timedelta(days=QUICK_DATE_CHOICES):
+        await _quick_ask_date(
+            context, update.effective_chat.id, draft, update.effective_user.id,
+            error="❌ Эта дата уже недоступна. Выберите другую:"
+        )
+        return QUICK_DATE
+    draft.start_date = start_date
+    await _quick_ask_owner(context, update.effective_chat.id, draft)
+    return QUICK_OWNER
+
+async def _quick_set_owner(update, context, owner_user):
+    draft = context.user_data['project']
+    draft.owner_id = owner_user.id if owner_user else update.effective_user.id
+    draft.member_ids = ()
+    owner_name = (owner_user.display_name or owner_user.username or str(owner_user.id)) if owner_user else "себя"
+    await _quick_ask_confirm(context, update.effective_chat.id, draft, owner_name)
+    return QUICK_CONFIRM
+
+async def quickproject_owner_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    value = query.data.split(":", 2)[2]
+    owner_user = None if value == "self" else find_user(get_db(), int(value))
+    if value != "self" and owner_user is None:
+        # Пользователь удален, пока открыт мастер: не назначаем проект себе молча
+        await _quick_ask_owner(
+            context, update.effective_chat.id, context.user_data['project'],
+            error=f"❌ Пользователь с ID {value} не найден."
+        )
+        return QUICK_OWNER
+    return await _quick_set_owner(update, context, owner_user)
+
+async def quickproject_owner_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    draft = context.user_data['project']
+    owner_input = update.message.text.strip().lower()
+    try:
+        draft.owner_id, draft.member_ids, owner_name = resolve_owner_input(get_db(), owner_input, update.effective_user.id)
+    except ValueError as e:
+        await _quick_ask_owner(context, update.effective_chat.id, draft, error=str(e))
+        return QUICK_OWNER
+    await _quick_ask_confirm(context, update.effective_chat.id, draft, owner_name)
+    return QUICK_CONFIRM
+
+async def quickproject_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    draft = context.user_data.pop('project')
+    db = get_db()
+    
+    try:
+        # Ключ — сообщение мастера: оно одно на весь черновик
+        creation_key = f"{query.message.chat_id}:{query.message.message_id}"
+        project, success_text = save_project_draft(db, draft, update.effective_user.id, creation_key)
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка создания проекта: {e}")
+        logger.error(f"Детали проекта: {draft}")
+        await query.edit_message_text(f"❌ Ошибка при создании проекта: {str(e)}")
+        return ConversationHandler.END
+    
+    await query.edit_message_text(success_text, parse_mode=ParseMode.HTML)
+    return ConversationHandler.END
+
+async def quickproject_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    context.user_data.pop('project', None)
+    await query.edit_message_text("❌ Создание проекта отменено.")
+    return ConversationHandler.END
+
+def display_name_of(user):
+    return user.display_name or user.username or str(user.id)
+
+def clone_for_owners(db, source, owners, start_date, created_by):
+    """Клонирует проект для владельцев, планирует напоминания и кладет в outbox
+    уведомления назначенным; коммит делает вызывающий"""
+    fire_times = {}
+    
+    def plan(clone, owner):
+        fire_times[clone] = init_project_schedule(clone, owner.timezone or DEFAULT_TIMEZONE)
+    
+    clones = clone_project(db, source, owners, start_date, created_by, plan=plan)
+    if any(clone.user_id != created_by for clone in clones):
+        creator = db.query(User).filter(User.id == created_by).first()
+        creator_name = display_name_of(creator) if creator else str(created_by)
+        enqueue_messages(db, "assignment", [
+            (clone.user_id, format_assignment_notice(creator_name, source.name, clone.project_id), None, ())
+            for clone in clones if clone.user_id != created_by
+        ])
+    return [(clone.id, clone.project_id, clone.user_id, fire_times[clone]) for clone in clones]
+
+# Команда /savetemplate [ID]
+async def save_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
-        await update.message.reply_text("❌ Используйте: /complete [ID проекта]")
+        await update.message.reply_text("❌ Используйте: /savetemplate [ID проекта]")
         return
     
-    project_id = context.args[0]
     user_id = update.effective_user.id
     db = get_db()
     
-    project = db.query(Project).filter(
-        Project.project_id == project_id,
-        Project.user_id == user_id
-    ).first()
-    
-    if not project:
+    source = db.query(Project).filter(Project.project_id == context.args[0]).first()
+    if not source or (source.user_id != user_id and not is_admin(user_id)):
         await update.message.reply_text("❌ Проект не найден или у вас нет к нему доступа.")
         return
+    if source.status == "template":
+        await update.message.reply_text("📄 Это уже шаблон.")
+        return
     
-    if project.status == "completed":
-        await update.message.reply_text("✅ Проект уже завершен.")
+    author = db.query(User).filter(User.id == user_id).first()
+    if not author:
+        await update.message.reply_text("❌ Сначала зарегистрируйтесь командой /start.")
         return
     
-    project.status = "completed"
-    db.commit()
+    try:
+        [template] = clone_project(db, source, [author], None, user_id, status="template")
+        template_id = template.project_id
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка сохранения шаблона: {e}")
+        await update.message.reply_text(f"❌ Ошибка при сохранении шаблона: {str(e)}")
+        return
+    event_log.append("template_saved", user_id, template_id, source.user_id, source=source.project_id, name=source.name)
+    
+    await update.message.reply_text(
+        f"📄 <b>Шаблон сохранен!</b>\n\n"
+        f"📋 <b>{source.name}</b> (ID шаблона: <code>{template_id}</code>)\n"
+        f"📅 Дней: {source.days_count} | ⏰ {source.reminder_time}\n\n"
+        f"• /clone {template_id} - создать проект по шаблону для себя\n"
+        f"• /clone {template_id} [Short ID] [ДД.ММ] - для другого пользователя\n"
+        f"• /assign {template_id} [ДД.ММ] [Short ID...] - назначить сразу нескольким (админ)",
+        parse_mode=ParseMode.HTML
+    )
+
+# Команда /templates
+async def list_templates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    db = get_read_db(update.effective_user.id)
+    templates = (
+        db.query(Project, User)
+        .outerjoin(User, User.id == Project.user_id)
+        .filter(Project.status == "template")
+        .order_by(Project.project_id)
+        .all()
+    )
+    
+    if not templates:
+        await update.message.reply_text("📭 Шаблонов пока нет.\n\n💡 Сохранить проект как шаблон: /savetemplate [ID]")
+        return
+    
+    lines = ["📄 <b>Шаблоны проектов:</b>", ""]
+    for template, author in templates:
+        author_name = display_name_of(author) if author else "—"
+        lines.append(f"• <b>[{template.project_id}]</b> {template.name} — {template.days_count} дн. | ⏰ {template.reminder_time} | 👤 {author_name}")
+    lines.append("")
+    lines.append("💡 Создать проект по шаблону: /clone [ID] [Short ID] [ДД.ММ]")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# Команда /clone [ID] [Short ID] [ДД.ММ]
+async def clone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not 1 <= len(context.args) <= 3:
+        await update.message.reply_text("❌ Используйте: /clone [ID проекта или шаблона] [Short ID] [ДД.ММ]")
+        return
+    
+    user_id = update.effective_user.id
+    db = get_db()
+    
+    source = db.query(Project).filter(Project.project_id == context.args[0]).first()
+    if not source or (source.status != "template" and source.user_id != user_id and not is_admin(user_id)):
+        await update.message.reply_text("❌ Проект не найден или у вас нет к нему доступа.")
+        return
+    
+    # Необязательные аргументы: Short ID владельца и/или дата начала (ДД.ММ)
+    owner = db.query(User).filter(User.id == user_id).first()
+    date_text = None
+    for arg in context.args[1:]:
+        if "." in arg:
+            date_text = arg
+            continue
+        try:
+            owner = find_user(db, int(arg))
+        except ValueError:
+            owner = None
+        if not owner:
+            await update.message.reply_text(f"❌ Пользователь с ID {arg} не найден.\n\n💡 Используйте /users чтобы посмотреть список пользователей.")
+            return
+    if not owner:
+        await update.message.reply_text("❌ Сначала зарегистрируйтесь командой /start.")
+        return
+    
+    today = local_now(owner.timezone or DEFAULT_TIMEZONE).date()
+    try:
+        start_date = parse_start_date(date_text, today) if date_text else datetime.combine(today + timedelta(days=1), datetime.min.time())
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    
+    try:
+        [(project_pk, project_id, owner_id, fire_at)] = clone_for_owners(db, source, [owner], start_date, user_id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка клонирования проекта: {e}")
+        await update.message.reply_text(f"❌ Ошибка при клонировании проекта: {str(e)}")
+        return
+    reminder_scheduler.schedule(project_pk, fire_at)
+    event_log.append("project_cloned", user_id, project_id, owner_id, source=source.project_id, name=source.name)
+    
+    await update.message.reply_text(
+        f"🧬 <b>Проект создан по образцу {source.project_id}!</b>\n\n"
+        f"📋 <b>{source.name}</b> (ID: <code>{project_id}</code>)\n"
+        f"👤 Владелец: {display_name_of(owner)}\n"
+        f"📆 Старт: {start_date.strftime('%d.%m.%Y')} | ⏰ {source.reminder_time}\n"
+        f"📅 Дней: {source.days_count}",
+        parse_mode=ParseMode.HTML
+    )
+
+# Команда /assign [ID шаблона] [ДД.ММ] [Short ID...] (только для админа)
+async def assign_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
+        return
+    
+    import re
+    short_ids = [int(x) for x in re.findall(r"\d+", " ".join(context.args[2:]))]
+    if len(context.args) < 3 or not short_ids:
+        await update.message.reply_text("❌ Используйте: /assign [ID шаблона] [ДД.ММ] [Short ID через пробел или запятую]")
+        return
+    
+    db = get_db()
+    source = db.query(Project).filter(Project.project_id == context.args[0]).first()
+    if not source:
+        await update.message.reply_text("❌ Проект или шаблон не найден.")
+        return
+    
+    try:
+        start_date = parse_start_date(context.args[1], local_now(user_timezone(db, user_id)).date())
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return
+    
+    # Все получатели одним запросом
+    owners = db.query(User).filter(User.short_id.in_(short_ids)).order_by(User.short_id).all()
+    missing = sorted(set(short_ids) - {owner.short_id for owner in owners})
+    if not owners:
+        await update.message.reply_text("❌ Ни один пользователь не найден.")
+        return
+    
+    try:
+        # Все копии проекта и задач — в одной транзакции
+        clones = clone_for_owners(db, source, owners, start_date, user_id)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка массового назначения: {e}")
+        await update.message.reply_text(f"❌ Ошибка при назначении: {str(e)}")
+        return
+    for project_pk, project_id, owner_id, fire_at in clones:
+        reminder_scheduler.schedule(project_pk, fire_at)
+        event_log.append("project_assigned", user_id, project_id, owner_id, source=source.project_id, name=source.name)
+    
+    names = {owner.id: display_name_of(owner) for owner in owners}
+    lines = [
+        f"👥 <b>Проект «{source.name}» назначен: {len(clones)}</b>",
+        f"📆 Старт: {start_date.strftime('%d.%m.%Y')}",
+        "",
+    ]
+    lines.extend(f"• <b>[{project_id}]</b> {names[owner_id]}" for _, project_id, owner_id, _ in clones)
+    if missing:
+        lines.append("")
+        lines.append(f"⚠️ Не найдены Short ID: {', '.join(map(str, missing))}")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# Команда /complete [ID]
+async def complete_project(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) != 1:
+        await update.message.reply_text("❌ Используйте: /complete [ID проекта]")
+        return
+    
+    project_id = context.args[0]
+    user_id = update.effective_user.id
+    db = get_db()
+    
+    project = db.query(Project).filter(
+        Project.project_id == project_id,
+        Project.user_id == user_id
+    ).first()
+    
+    if not project:
+        await update.message.reply_text("❌ Проект не найден или у вас нет к нему доступа.")
+        return
+    
+    if project.status == "completed":
+        await update.message.reply_text("✅ Проект уже завершен.")
+        return
+    
+    if project.status == "template":
+        await update.message.reply_text("📄 Это шаблон, его нельзя завершить. Удалить шаблон: /delete [ID]")
+        return
+    
+    bump_user_stats(db, project_stats_deltas(db, Project.id == project.id, sign=-1, columns=("projects_active",)))
+    project.status = "completed"
+    plan_reminder(project, DEFAULT_TIMEZONE)
+    db.commit()
+    reminder_scheduler.schedule(project.id, None)
+    event_log.append("project_completed", user_id, project.project_id, project.user_id)
     
     await update.message.reply_text(
         f"🎉 <b>Проект завершен!</b>\n\n"
@@ -623,22 +1578,20 @@ async def add_day_to_project(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ Нельзя добавить день к завершенному проекту.")
         return ConversationHandler.END
     
-    # Увеличиваем количество дней
-    project.days_count += 1
-    db.commit()
-    
-    # Сохраняем данные проекта в контексте
+    # Количество дней увеличится вместе с сохранением задачи, а не сейчас:
+    # брошенный диалог или повтор команды не оставят день без задачи
+    new_day = project.days_count + 1
     context.user_data['add_day'] = {
         'project_id': project.project_id,
         'project_name': project.name,
-        'new_day': project.days_count
+        'new_day': new_day
     }
     
     await update.message.reply_text(
         f"📅 <b>Добавление дня к проекту</b>\n\n"
         f"📋 Проект: {project.name} (ID: {project.project_id})\n"
-        f"📅 Новый день: {project.days_count}\n\n"
-        f"📝 Напишите, что вы будете делать в <b>День {project.days_count}</b>:",
+        f"📅 Новый день: {new_day}\n\n"
+        f"📝 Напишите, что вы будете делать в <b>День {new_day}</b>:",
         parse_mode=ParseMode.HTML
     )
     return ADD_DAY_TASK
@@ -657,14 +1610,36 @@ async def add_day_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Проект не найден.")
         return ConversationHandler.END
     
-    # Создаем новую ежедневную задачу
-    new_day_task = DailyTask(
-        project_id=project.id,
-        day_number=add_day_data['new_day'],
-        description=task_description
-    )
-    db.add(new_day_task)
-    db.commit()
+    # Задача и новый день сохраняются одной транзакцией. Уникальный ключ
+    # (project_id, day_number) не даст повтору добавить день второй раз
+    new_day = add_day_data['new_day']
+    db.add(DailyTask(project_id=project.id, day_number=new_day, description=task_description))
+    if project.days_count < new_day:
+        project.days_count = new_day
+        if project.end_date:
+            project.end_date += timedelta(days=1)
+    fire_at = plan_reminder(project, user_timezone(db, project.user_id))
+    if not project.is_team and project.status != "template" and project.user_id:
+        bump_user_stats(db, {project.user_id: {"tasks_total": 1}})
+    try:
+        if project.is_team:
+            # Новый день появляется у всех участников команды одним INSERT ... SELECT
+            db.flush()
+            add_member_tasks(db, project.id, day_number=new_day)
+            if project.status != "template":
+                members = db.query(ProjectMember.user_id).filter(ProjectMember.project_id == project.id).all()
+                bump_user_stats(db, {member_id: {"tasks_total": 1} for member_id, in members})
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        logger.info(f"День {new_day} проекта {project.project_id} уже добавлен, повтор пропущен")
+        project = db.query(Project).filter(Project.id == project.id).first()
+        task_description = db.query(DailyTask.description).filter(
+            DailyTask.project_id == project.id, DailyTask.day_number == new_day
+        ).scalar()
+    else:
+        reminder_scheduler.schedule(project.id, fire_at)
+        event_log.append("day_added", update.effective_user.id, project.project_id, project.user_id, day=new_day)
     
     await update.message.reply_text(
         f"✅ <b>День успешно добавлен!</b>\n\n"
@@ -687,17 +1662,20 @@ async def show_daily_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     project_id = context.args[0]
     user_id = update.effective_user.id
-    db = get_db()
+    db = get_read_db(update.effective_user.id)
     
     project = db.query(Project).filter(
         Project.project_id == project_id,
-        Project.user_id == user_id
+        project_visible_to(user_id)
     ).first()
     
     if not project:
         await update.message.reply_text("❌ Проект не найден или у вас нет к нему доступа.")
         return
     
+    # В командном проекте участник видит свои статусы, руководитель — сколько участников выполнили
+    team_statuses = team_day_statuses(db, project.id, user_id) if project.is_team else None
+    
     # Получаем все задачи проекта
     tasks = db.query(DailyTask).filter(DailyTask.project_id == project.id).order_by(DailyTask.day_number).all()
     
@@ -709,7 +1687,11 @@ async def show_daily_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     for task in tasks:
         status_emoji = {"pending": "⏳", "completed": "✅", "skipped": "⏭️"}
-        status = status_emoji.get(task.completed, "❓")
+        completed = task.completed if team_statuses is None else team_statuses.get(task.day_number)
+        if isinstance(completed, tuple):
+            status = f"✅ {completed[0]}/{completed[1]}"
+        else:
+            status = status_emoji.get(completed, "❓")
         lines.append(f"<b>День {task.day_number}:</b> {task.description} {status}")
     
     lines.append("")
@@ -720,6 +1702,60 @@ async def show_daily_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
+# Команда /ical [ID] — расписание проекта файлом .ics (без ID — всех проектов)
+async def export_ical(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) > 1:
+        await update.message.reply_text("❌ Используйте: /ical [ID проекта] или /ical для всех проектов")
+        return
+    
+    user_id = update.effective_user.id
+    project_id = context.args[0] if context.args else None
+    db = get_read_db(user_id)
+    
+    projects = calendar_projects(db, user_id, project_id)
+    if not projects:
+        await update.message.reply_text(
+            "❌ Проект не найден или у вас нет к нему доступа." if project_id else "📭 Нет проектов для экспорта."
+        )
+        return
+    
+    versions = {project.id: project_version(project) for project in projects}
+    key = calendar_key(project_id or f"user:{user_id}", versions)
+    filename = f"project-{project_id}.ics" if project_id else "projects.ics"
+    caption = f"📅 Календарь: проектов {len(projects)}, событий {sum(project.tasks_count for project in projects)}"
+    
+    # Ничего не изменилось с прошлой выгрузки — отправляем уже загруженный в Telegram файл
+    file_id = calendar_cache.file_id(key)
+    if file_id:
+        await update.message.reply_document(document=file_id, filename=filename, caption=caption)
+        return
+    
+    # События пересобираются только для проектов, чьей версии нет в кэше;
+    # задачи идут потоком с курсора прямо в файлы кэша
+    missing = {project.id: project for project in projects if not calendar_cache.has(project.id, versions[project.id])}
+    if missing:
+        rows = iter_calendar_tasks(db, list(missing), ICAL_FETCH_SIZE)
+        for project_pk, tasks in groupby(rows, key=lambda row: row[0]):
+            project = missing.pop(project_pk)
+            calendar_cache.store(project_pk, versions[project_pk], format_events(project, (
+                (day_number, description) for _, day_number, description in tasks
+            )))
+        for project_pk in missing:  # Проекты без задач
+            calendar_cache.store(project_pk, versions[project_pk], ())
+    
+    with tempfile.SpooledTemporaryFile(max_size=ICAL_SPOOL_BYTES) as spool:
+        spool.write(calendar_header(projects[0].name if project_id else "Мои проекты"))
+        for project in projects:
+            calendar_cache.copy_to(project.id, versions[project.id], spool)
+        spool.write(calendar_footer())
+        if spool.tell() > ICAL_MAX_BYTES:
+            await update.message.reply_text("❌ Календарь слишком большой для отправки. Выгрузите проекты по одному: /ical [ID]")
+            return
+        spool.seek(0)
+        message = await update.message.reply_document(document=spool, filename=filename, caption=caption)
+    if message and message.document:
+        calendar_cache.remember_file_id(key, message.document.file_id)
+
 # Команда /delete [ID]
 async def delete_project(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
@@ -740,10 +1776,22 @@ async def delete_project(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     project_name = project.name
+    project_pk = project.id
+    # Строка проекта удаляется физически, поэтому снимок для журнала берем до удаления
+    snapshot = {
+        "name": project.name,
+        "status": project.status,
+        "days": project.days_count,
+        "created_by": project.created_by,
+        "tasks_completed": sum(task.completed == "completed" for task in project.daily_tasks),
+    }
     
-    # Удаляем проект (каскадно удалятся и задачи)
+    # Удаляем проект (каскадно удалятся и задачи) и его вклад в сводку /stats
+    bump_user_stats(db, project_stats_deltas(db, Project.id == project_pk, sign=-1))
     db.delete(project)
     db.commit()
+    reminder_scheduler.schedule(project_pk, None)
+    event_log.append("project_deleted", user_id, project_id, user_id, **snapshot)
     
     await update.message.reply_text(
         f"🗑️ <b>Проект удален!</b>\n\n"
@@ -814,7 +1862,9 @@ async def reminder_times(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Проверяем формат времени
     for time in times:
-        if not re.match(r'^\d{2}:\d{2}$', time):
+        try:
+            parse_reminder_time(time)
+        except ValueError:
             await update.message.reply_text("❌ Неверный формат времени. Используйте HH:MM:")
             return REMINDER_TIMES
     
@@ -825,7 +1875,10 @@ async def reminder_times(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Сохраняем настройки (пока просто обновляем время на первое)
     project.reminder_time = times[0]  # Пока сохраняем только первое время
+    fire_at = plan_reminder(project, user_timezone(db, project.user_id))
     db.commit()
+    reminder_scheduler.schedule(project.id, fire_at)
+    event_log.append("reminder_changed", update.effective_user.id, project_id, project.user_id, times=times)
     
     times_str = " ".join(times)
     
@@ -842,6 +1895,94 @@ async def reminder_times(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+# Статусы задач, которые можно выставить командами и кнопками
+TASK_ACTIONS = {
+    "done": ("completed", "✅ Задача выполнена"),
+    "skip": ("skipped", "⏭ Задача пропущена"),
+}
+
+def format_reminder(project_id, name, day_number, days_count, reminder_time, description, progress_done, progress_total):
+    """Формирует текст напоминания о задаче дня (название и задача экранируются для HTML)"""
+    return f"""
+🔔 <b>Напоминание о проекте</b>
+
+📋 <b>Проект:</b> {html.escape(name)}
+🆔 <b>ID:</b> {project_id}
+📅 <b>День:</b> {day_number} из {days_count}
+⏰ <b>Время:</b> {reminder_time}
+
+📝 <b>Задача на сегодня:</b>
+{html.escape(description)}
+
+💡 <b>Статус:</b> ⏳ Ожидает выполнения
+
+🎯 <b>Прогресс:</b> {progress_done}/{progress_total} задач выполнено
+
+✅ <b>Команды для управления:</b>
+• /complete_task {project_id} {day_number} - выполнить задачу
+• /skip_task {project_id} {day_number} - пропустить задачу
+• /daily {project_id} - посмотреть все задачи
+"""
+
+def _digest_entry(item):
+    """Блок одного проекта в дайджесте: название и задача экранируются, задача обрезается"""
+    description = item["description"]
+    if len(description) > DIGEST_TASK_PREVIEW:
+        description = description[:DIGEST_TASK_PREVIEW - 1] + "…"
+    return (
+        f"📋 <b>[{item['project_id']}] {html.escape(item['name'])}</b>\n"
+        f"📅 День {item['day_number']} из {item['days_count']} · "
+        f"⏰ {item['reminder_time']} · 🎯 {item['done']}/{item['total']}\n"
+        f"📝 {html.escape(description)}\n"
+    )
+
+def format_digest(items):
+    """Формирует одно сообщение-дайджест с задачами дня по нескольким проектам"""
+    lines = ["🔔 <b>Напоминания на сегодня</b>", f"📂 Проектов: {len(items)}", ""]
+    lines += [_digest_entry(item) for item in items]
+    lines.append("✅ Отметьте задачи кнопками ниже или командами /complete_task и /skip_task")
+    return "\n".join(lines)
+
+def _digest_chunks(entries):
+    """Делит напоминания дайджеста на части: не больше DIGEST_MAX_PROJECTS
+    проектов и около DIGEST_MAX_LENGTH символов текста в каждой"""
+    chunk, length = [], 0
+    for entry in entries:
+        entry_length = len(_digest_entry(entry[1])) + 1
+        if chunk and (len(chunk) == DIGEST_MAX_PROJECTS or length + entry_length > DIGEST_MAX_LENGTH):
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(entry)
+        length += entry_length
+    if chunk:
+        yield chunk
+
+def digest_keyboard(items):
+    """Кнопки «выполнено / пропустить» для каждого проекта дайджеста"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(
+                f"✅ {item['project_id']} · день {item['day_number']}",
+                callback_data=f"task:done:{item['project_id']}:{item['day_number']}"
+            ),
+            InlineKeyboardButton(
+                f"⏭ {item['project_id']}",
+                callback_data=f"task:skip:{item['project_id']}:{item['day_number']}"
+            ),
+        ]
+        for item in items
+    ])
+
+def reminder_keyboard(project_id, day_number):
+    """Кнопки «выполнено / пропустить» под напоминанием"""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Выполнено", callback_data=f"task:done:{project_id}:{day_number}"),
+        InlineKeyboardButton("⏭ Пропустить", callback_data=f"task:skip:{project_id}:{day_number}"),
+    ]])
+
+# Кнопки примера /seereminder: task_button только отвечает на нажатие и не трогает задачи
+SAMPLE_TASK_CALLBACK = "task:sample"
+
 # Команда /seereminder (только для админа)
 async def see_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -849,28 +1990,697 @@ async def see_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Показываем пример сообщения напоминания
-    reminder_text = f"""
-🔔 <b>Напоминание о проекте</b>
+    reminder_text = format_reminder("0001", "Пример проекта", 1, 3, "12:00", "Смотреть", 0, 3)
+    
+    await update.message.reply_text(
+        reminder_text,
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Выполнено", callback_data=SAMPLE_TASK_CALLBACK),
+            InlineKeyboardButton("⏭ Пропустить", callback_data=SAMPLE_TASK_CALLBACK),
+        ]])
+    )
 
-📋 <b>Проект:</b> Пример проекта
-🆔 <b>ID:</b> 0001
-📅 <b>День:</b> 1 из 3
-⏰ <b>Время:</b> 12:00
+async def _change_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    command = "/complete_task" if action == "done" else "/skip_task"
+    if len(context.args) != 2:
+        await update.message.reply_text(f"❌ Используйте: {command} [ID проекта] [номер дня]")
+        return
+    
+    project_id = context.args[0]
+    try:
+        day_number = int(context.args[1])
+    except ValueError:
+        await update.message.reply_text("❌ Номер дня должен быть числом.")
+        return
+    
+    status, done_text = TASK_ACTIONS[action]
+    if set_task_status(project_id, day_number, update.effective_user.id, status):
+        event_log.append(f"task_{status}", update.effective_user.id, project_id, day=day_number)
+        await update.message.reply_text(
+            f"{done_text}\n\n📋 Проект: {project_id}\n📅 День: {day_number}",
+            parse_mode=ParseMode.HTML
+        )
+    else:
+        await update.message.reply_text(
+            "❌ Задача не найдена, у вас нет к ней доступа или статус уже установлен."
+        )
 
-📝 <b>Задача на сегодня:</b>
-Смотреть
+# Команда /complete_task [ID] [день]
+async def complete_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _change_task_status(update, context, "done")
 
-💡 <b>Статус:</b> ⏳ Ожидает выполнения
+# Команда /skip_task [ID] [день]
+async def skip_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _change_task_status(update, context, "skip")
 
-🎯 <b>Прогресс:</b> 0/3 задач выполнено
+# Кнопки «выполнено / пропустить» под напоминаниями
+async def task_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.data == SAMPLE_TASK_CALLBACK:
+        await query.answer("Это пример напоминания, кнопки ничего не меняют")
+        return
+    try:
+        _, action, project_id, day = query.data.split(":")
+        status, done_text = TASK_ACTIONS[action]
+        day_number = int(day)
+    except (ValueError, KeyError):
+        await query.answer("❌ Неизвестная кнопка")
+        return
+    
+    # Чтение задачи по индексу и одна запись в БД на нажатие: счетчики /stats пишутся пачкой
+    if not set_task_status(project_id, day_number, update.effective_user.id, status):
+        await query.answer("❌ Задача не найдена или уже отмечена")
+        return
+    event_log.append(f"task_{status}", update.effective_user.id, project_id, day=day_number)
+    
+    await query.answer(done_text)
+    
+    # Убираем только кнопки отмеченной задачи: в дайджесте остальные проекты остаются
+    pressed = {f"task:{name}:{project_id}:{day_number}" for name in TASK_ACTIONS}
+    markup = query.message.reply_markup
+    rows = [
+        row for row in (markup.inline_keyboard if markup else ())
+        if not any(button.callback_data in pressed for button in row)
+    ]
+    await query.edit_message_text(
+        f"{query.message.text_html}\n\n{done_text}: {project_id}, день {day_number}",
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup(rows) if rows else None
+    )
 
-✅ <b>Команды для управления:</b>
-• /complete_task 0001 1 - выполнить задачу
-• /skip_task 0001 1 - пропустить задачу
-• /daily 0001 - посмотреть все задачи
-"""
+FIND_PAGE_SIZE = 10
+FIND_MAX_PAGES = 5
+FIND_STATUS_EMOJI = {"active": "🟢", "completed": "✅", "paused": "⏸️", "template": "📄"}
+
+def find_results_page(user_id, query_text, page):
+    """Текст и кнопки страницы результатов /find"""
+    db = get_read_db(user_id)
+    # Админ ищет по всем проектам, остальные — только по своим
+    owner_filter = None if is_admin(user_id) else user_id
+    rows, has_more = search_projects(
+        db, query_text, owner_filter, limit=FIND_PAGE_SIZE, offset=page * FIND_PAGE_SIZE
+    )
+    
+    if not rows:
+        text = f"🔍 По запросу «{html.escape(query_text)}» ничего не найдено." if page == 0 else "🔍 Больше результатов нет."
+        return text, None
+    
+    lines = [f"🔍 <b>Результаты по запросу «{html.escape(query_text)}»</b> (стр. {page + 1}):", ""]
+    for project, owner in rows:
+        status = FIND_STATUS_EMOJI.get(project.status, "❓")
+        line = f"{status} <b>[{project.project_id}]</b> {html.escape(project.name)} — {project.days_count} дн."
+        if owner_filter is None and owner:
+            line += f" | 👤 {html.escape(display_name_of(owner))}"
+        lines.append(line)
+    
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"find:{page - 1}"))
+    if has_more and page + 1 < FIND_MAX_PAGES:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"find:{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+# Команда /find [текст]
+async def find_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query_text = " ".join(context.args).strip()
+    if len(query_text) < 2:
+        await update.message.reply_text("❌ Используйте: /find [текст] (минимум 2 символа)\n\nИщет по названиям проектов и задачам.")
+        return
+    
+    # Запрос нужен для листания страниц: в callback_data он может не поместиться
+    context.user_data['find_query'] = query_text[:100]
+    text, markup = find_results_page(update.effective_user.id, context.user_data['find_query'], 0)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+# Кнопки листания результатов /find
+async def find_page_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    query_text = context.user_data.get('find_query')
+    if not query_text:
+        await query.answer("❌ Поиск устарел, повторите /find")
+        return
     
-    await update.message.reply_text(reminder_text, parse_mode=ParseMode.HTML)
+    page = min(int(query.data.split(":")[1]), FIND_MAX_PAGES - 1)
+    await query.answer()
+    text, markup = find_results_page(update.effective_user.id, query_text, page)
+    try:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+
+# Команда /timezone [пояс]
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    db = get_db()
+    
+    if len(context.args) != 1:
+        current = user_timezone(db, user_id)
+        await update.message.reply_text(
+            f"🌍 <b>Часовой пояс:</b> {current}\n"
+            f"🕐 Сейчас у вас: {local_now(current).strftime('%d.%m %H:%M')}\n\n"
+            f"Изменить: /timezone Europe/Moscow",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    tz_name = context.args[0]
+    if not is_valid_timezone(tz_name):
+        await update.message.reply_text(
+            "❌ Неизвестный часовой пояс. Используйте название вида Europe/Moscow или Asia/Almaty."
+        )
+        return
+    
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        await update.message.reply_text("❌ Сначала зарегистрируйтесь командой /start.")
+        return
+    
+    user.timezone = tz_name
+    
+    # Напоминания всех активных проектов переезжают в новый часовой пояс
+    projects = db.query(Project).filter(Project.user_id == user_id, Project.status == "active").all()
+    planned = [(p.id, plan_reminder(p, tz_name)) for p in projects]
+    db.commit()
+    for project_pk, fire_at in planned:
+        reminder_scheduler.schedule(project_pk, fire_at)
+    
+    await update.message.reply_text(
+        f"✅ <b>Часовой пояс изменен:</b> {tz_name}\n"
+        f"🕐 Сейчас у вас: {local_now(tz_name).strftime('%d.%m %H:%M')}\n"
+        f"🔔 Напоминания будут приходить по этому времени",
+        parse_mode=ParseMode.HTML
+    )
+
+def load_reminder_schedule():
+    """Заполняет кучу напоминаний из БД при старте бота"""
+    db = get_db()
+    try:
+        # Проекты, у которых ближайшее напоминание еще не рассчитано
+        unplanned = (
+            db.query(Project, User.timezone)
+            .outerjoin(User, User.id == Project.user_id)
+            .filter(Project.status == "active", Project.next_reminder_at.is_(None))
+            .all()
+        )
+        for project, tz_name in unplanned:
+            plan_reminder(project, tz_name or DEFAULT_TIMEZONE)
+        db.commit()
+        
+        entries = (
+            db.query(Project.id, Project.next_reminder_at)
+            .filter(Project.status == "active", Project.next_reminder_at.isnot(None))
+            .all()
+        )
+        reminder_scheduler.load(entries)
+        logger.info(f"Запланировано напоминаний: {len(reminder_scheduler)}")
+    finally:
+        db.close()
+
+# Периодическая задача: жизненный цикл проектов (текущий день, просрочка, автозавершение)
+async def lifecycle_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        stats = run_lifecycle(lambda tz_name: local_now(tz_name).date())
+    except Exception as e:
+        logger.error(f"Ошибка обновления жизненного цикла проектов: {e}")
+        return
+    logger.info(
+        f"Жизненный цикл: обновлено проектов {stats['advanced']}, "
+        f"пропущено задач {stats['skipped_tasks']}, завершено проектов {stats['completed']}"
+    )
+
+async def stats_flush_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        flush_task_stats()
+    except Exception as e:
+        logger.error(f"Ошибка записи счетчиков статистики: {e}")
+
+async def stats_rollup_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        users_count = rollup_stats()
+    except Exception as e:
+        logger.error(f"Ошибка сверки статистики: {e}")
+        return
+    logger.info(f"Статистика пересчитана для {users_count} пользователей")
+
+def render_reminders(db, keys, projects=None):
+    """Собирает данные напоминаний для ключей (project_pk, day_number).
+
+    Проекты вместе с настройкой дайджеста владельца (если не переданы) и задачи
+    загружаются двумя запросами на всю пачку, участники командных проектов —
+    еще двумя. Возвращает словарь {ключ: список данных по получателям}: у
+    обычного проекта получатель — владелец, у командного — каждый участник.
+    """
+    project_pks = {pk for pk, _ in keys}
+    if not project_pks:
+        return {}
+    if projects is None:
+        projects = {
+            project.id: (project, digest)
+            for project, digest in (
+                db.query(Project, User.reminder_digest)
+                .outerjoin(User, User.id == Project.user_id)
+                .filter(Project.id.in_(project_pks))
+                .all()
+            )
+        }
+    tasks = (
+        db.query(DailyTask.project_id, DailyTask.day_number, DailyTask.description, DailyTask.completed)
+        .filter(DailyTask.project_id.in_(project_pks))
+        .all()
+    )
+    
+    descriptions = {}
+    progress = {}
+    for project_pk, day_number, description, completed in tasks:
+        descriptions[(project_pk, day_number)] = description
+        done, total = progress.get(project_pk, (0, 0))
+        progress[project_pk] = (done + (completed == "completed"), total + 1)
+    
+    team = team_recipients(db, [pk for pk in project_pks if pk in projects and projects[pk][0].is_team])
+    
+    rendered = {}
+    for project_pk, day_number in keys:
+        if project_pk not in projects:
+            continue
+        project, digest = projects[project_pk]
+        done, total = progress.get(project_pk, (0, 0))
+        item = {
+            "chat_id": project.user_id,
+            "digest": REMINDER_DIGEST_DEFAULT if digest is None else digest,
+            "project_id": project.project_id,
+            "name": project.name,
+            "day_number": day_number,
+            "days_count": project.days_count,
+            "reminder_time": project.reminder_time,
+            "description": descriptions.get((project_pk, day_number), "—"),
+            "done": done,
+            "total": total,
+        }
+        if project.is_team:
+            rendered[(project_pk, day_number)] = [
+                dict(
+                    item, chat_id=member_id, done=member_done, total=member_total,
+                    digest=REMINDER_DIGEST_DEFAULT if member_digest is None else member_digest
+                )
+                for member_id, member_digest, member_done, member_total in team.get(project_pk, ())
+            ]
+        else:
+            rendered[(project_pk, day_number)] = [item]
+    return rendered
+
+def build_reminder_messages(deliveries):
+    """Превращает напоминания в исходящие сообщения.
+
+    deliveries — список (delivery_id, данные напоминания). Напоминания пользователя
+    с включенным дайджестом объединяются в одно сообщение (не больше
+    DIGEST_MAX_PROJECTS проектов и DIGEST_MAX_LENGTH символов в каждом).
+    Возвращает список (список delivery_id, chat_id, текст, клавиатура).
+    """
+    messages = []
+    digests = {}
+    for delivery_id, item in deliveries:
+        if item["digest"]:
+            digests.setdefault(item["chat_id"], []).append((delivery_id, item))
+            continue
+        messages.append(([delivery_id], item["chat_id"], *_single_reminder(item)))
+    
+    for chat_id, entries in digests.items():
+        for chunk in _digest_chunks(entries):
+            items = [item for _, item in chunk]
+            if len(items) == 1:
+                text, keyboard = _single_reminder(items[0])
+            else:
+                text, keyboard = format_digest(items), digest_keyboard(items)
+            messages.append(([delivery_id for delivery_id, _ in chunk], chat_id, text, keyboard))
+    return messages
+
+def _single_reminder(item):
+    text = format_reminder(
+        item["project_id"], item["name"], item["day_number"], item["days_count"], item["reminder_time"],
+        item["description"], item["done"], item["total"]
+    )
+    return text, reminder_keyboard(item["project_id"], item["day_number"])
+
+def enqueue_reminders(db, messages):
+    """Кладет сообщения-напоминания в outbox одним пакетным INSERT; messages — результат build_reminder_messages()"""
+    enqueue_messages(db, "reminder", [
+        (chat_id, text, json.dumps(keyboard.to_dict()) if keyboard else None, delivery_ids)
+        for delivery_ids, chat_id, text, keyboard in messages
+    ])
+
+def outbox_retry_delay(attempts):
+    """Экспоненциальная пауза перед следующей попыткой: 5 с, 10 с, 20 с... но не больше часа"""
+    return timedelta(seconds=min(OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), 3600))
+
+async def send_outbox_message(bot, message):
+    """Отправляет одно уведомление из outbox и возвращает итог для finish_outbox()"""
+    attempts = message.attempts + 1
+    result = {
+        "id": message.id, "status": "sent", "attempts": attempts, "next_attempt_at": None,
+        "last_error": None, "sent_at": None, "delivery_ids": message.delivery_ids,
+    }
+    if message.kind == "reminder" and message.created_at < utcnow() - REMINDER_CATCHUP_WINDOW:
+        # Напоминание пролежало в очереди дольше окна догоняющей отправки (например, бот был выключен)
+        result.update(status="expired", attempts=message.attempts, last_error="Истекло окно отправки напоминания")
+        return result
+    try:
+        reply_markup = InlineKeyboardMarkup.de_json(json.loads(message.reply_markup), bot) if message.reply_markup else None
+        await bot.send_message(chat_id=message.chat_id, text=message.text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        result["sent_at"] = utcnow()
+        return result
+    except (Forbidden, BadRequest) as e:
+        # Бот заблокирован или сообщение некорректно — повтор не поможет
+        result.update(status="failed", last_error=str(e)[:300])
+    except RetryAfter as e:
+        retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+        result.update(status="pending", attempts=message.attempts, last_error=str(e)[:300],
+                      next_attempt_at=utcnow() + timedelta(seconds=retry_after))
+    except Exception as e:
+        result.update(status="pending", last_error=str(e)[:300], next_attempt_at=utcnow() + outbox_retry_delay(attempts))
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            result["status"] = "failed"
+    logger.warning(f"Уведомление {message.id} ({message.kind}) пользователю {message.chat_id}: {result['last_error']}")
+    return result
+
+# Периодическая задача: отправка уведомлений из outbox
+async def outbox_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        batch = due_outbox(OUTBOX_BATCH_SIZE)
+    except Exception as e:
+        logger.error(f"Ошибка чтения outbox: {e}")
+        return
+    if not batch:
+        return
+    
+    # Пачка отправляется параллельно, итоги сохраняются одним пакетным UPDATE
+    results = await asyncio.gather(*(send_outbox_message(context.bot, message) for message in batch))
+    try:
+        finish_outbox(results)
+    except Exception as e:
+        # Пачка останется занятой и по истечении аренды уйдет повторно: лучше дубль, чем потеря
+        logger.error(f"Ошибка записи итогов outbox: {e}")
+
+# Периодическая задача: отправка наступивших напоминаний
+async def dispatch_reminders(context: ContextTypes.DEFAULT_TYPE):
+    now = utcnow()
+    due = dict(reminder_scheduler.pop_due(now))
+    if not due:
+        return
+    
+    db = get_db()
+    try:
+        # Все наступившие проекты слота одним запросом, сгруппированные по владельцу
+        rows = (
+            db.query(Project, User.timezone, User.reminder_digest)
+            .outerjoin(User, User.id == Project.user_id)
+            .filter(Project.id.in_(due), Project.status == "active")
+            .order_by(Project.user_id, Project.project_id)
+            .all()
+        )
+        
+        slots = []
+        next_times = []
+        for project, tz_name, _ in rows:
+            tz_name = tz_name or DEFAULT_TIMEZONE
+            fire_at = due[project.id]
+            # Пропущенные слоты (бот был выключен) догоняем только в пределах окна
+            if now - fire_at <= REMINDER_CATCHUP_WINDOW:
+                day_number = (local_now(tz_name, fire_at).date() - project.start_date.date()).days + 1
+                slots.append((project.id, day_number, fire_at))
+            
+            planned = next_fire_time(project.start_date, project.days_count, project.reminder_time, tz_name, now)
+            next_at = planned[0] if planned else None
+            next_times.append({
+                "id": project.id,
+                "next_reminder_at": next_at,
+                "reminder_utc_minute": utc_minute_of_day(next_at) if next_at else None,
+            })
+        
+        rendered = render_reminders(
+            db, [(pk, day) for pk, day, _ in slots],
+            projects={project.id: (project, digest) for project, _, digest in rows}
+        )
+        recipients = {
+            (pk, day, fire_at, item["chat_id"]): item
+            for pk, day, fire_at in slots
+            for item in rendered.get((pk, day), ())
+            if item["chat_id"] is not None
+        }
+        # Слоты занимаются (по записи журнала на каждого получателя, у командного
+        # проекта — на каждого участника) и сообщения кладутся в outbox в той же
+        # транзакции, что и перенос следующего срабатывания: слот, уже занятый другим
+        # процессом или до перезапуска, второй раз не отправится, а занятый — не потеряется
+        claimed = claim_deliveries(db, list(recipients))
+        messages = build_reminder_messages([
+            (claimed[key], item) for key, item in recipients.items() if key in claimed
+        ])
+        
+        enqueue_reminders(db, messages)
+        
+        # Одним пакетным UPDATE сохраняем следующие срабатывания
+        if next_times:
+            db.execute(update(Project), next_times)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Ошибка планирования напоминаний: {e}")
+        # Возвращаем события в кучу, чтобы повторить на следующем тике
+        for project_pk, fire_at in due.items():
+            reminder_scheduler.schedule(project_pk, fire_at)
+        return
+    finally:
+        db.close()
+    
+    for item in next_times:
+        reminder_scheduler.schedule(item["id"], item["next_reminder_at"])
+
+async def post_shutdown(application: Application):
+    flush_update_offset()
+    event_log.flush()
+    try:
+        flush_task_stats()
+    except Exception as e:
+        logger.error(f"Ошибка записи счетчиков статистики: {e}")
+    if report_pool is not None:
+        report_pool.shutdown(wait=False, cancel_futures=True)
+
+# Дедупликация апдейтов: первым делом отбрасываем уже обработанные update_id
+async def drop_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update_dedup.is_duplicate(update.update_id):
+        logger.info(f"Апдейт {update.update_id} уже обработан, пропускаем")
+        raise ApplicationHandlerStop
+
+# Запоминаем автора апдейта: его записи включают чтение из основной БД вместо реплики
+async def bind_update_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    current_user_id.set(update.effective_user.id if update.effective_user else None)
+
+# После всех обработчиков апдейт считается выполненным
+async def mark_update_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_dedup.mark_done(update.update_id)
+
+def flush_update_offset():
+    """Сохраняет high-water mark обработанных апдейтов, если он продвинулся"""
+    if not update_dedup.dirty:
+        return
+    high_water = update_dedup.high_water
+    try:
+        save_update_offset(high_water)
+        update_dedup.saved = high_water
+    except Exception as e:
+        logger.error(f"Не удалось сохранить отметку апдейтов {high_water}: {e}")
+
+async def update_offset_job(context: ContextTypes.DEFAULT_TYPE):
+    flush_update_offset()
+
+async def event_log_job(context: ContextTypes.DEFAULT_TYPE):
+    event_log.flush()
+
+async def event_purge_job(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        dropped = purge_event_months(EVENT_RETENTION_MONTHS)
+    except Exception as e:
+        logger.error(f"Ошибка очистки журнала событий: {e}")
+        return
+    if dropped:
+        logger.info(f"Удалены месяцы журнала событий: {', '.join(dropped)}")
+
+def get_report_pool():
+    """Пул процессов отрисовки отчетов, создается при первом отчете.
+
+    Процессы запускаются через spawn (не наследуют соединения с БД и сокеты
+    бота) и работают с пониженным приоритетом. Запуск процессов занимает
+    сотни миллисекунд, поэтому функцию вызывают из потока, а не из цикла событий.
+    """
+    global report_pool
+    if report_pool is None:
+        pool = ProcessPoolExecutor(
+            max_workers=REPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=lower_priority
+        )
+        # Процессы стартуют при отправке задач: запускаем их сразу, здесь же
+        for _ in range(REPORT_WORKERS):
+            pool.submit(int)
+        report_pool = pool
+    return report_pool
+
+def report_week_start(day):
+    """Понедельник недели, в которую входит day"""
+    return day - timedelta(days=day.weekday())
+
+async def send_report_files(bot, chat_ids, files, caption):
+    """Рассылает файлы отчета пачками по OUTBOX_BATCH_SIZE в секунду"""
+    sends = [(chat_id, filename, content) for chat_id in chat_ids for filename, content in files]
+    for i in range(0, len(sends), OUTBOX_BATCH_SIZE):
+        if i:
+            await asyncio.sleep(OUTBOX_TICK_SECONDS)
+        batch = sends[i:i + OUTBOX_BATCH_SIZE]
+        results = await asyncio.gather(*(
+            bot.send_document(chat_id=chat_id, document=content, filename=filename, caption=caption)
+            for chat_id, filename, content in batch
+        ), return_exceptions=True)
+        for (chat_id, filename, _), result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Отчет {filename} пользователю {chat_id}: {result}")
+
+def enqueue_report_summaries(summaries):
+    """Кладет личные сводки в outbox одним пакетным INSERT; summaries — результат render_user_summaries()"""
+    db = get_db()
+    try:
+        enqueue_messages(db, "report", [(user_id, text, None, ()) for user_id, text in summaries])
+        db.commit()
+    finally:
+        db.close()
+
+async def build_weekly_report(bot, week_start, chat_ids, notify_users=False):
+    """Собирает недельный отчет и рассылает его.
+
+    Данные читаются несколькими агрегирующими запросами в потоке, графики и
+    файлы рисуются в пуле процессов — цикл событий в это время обслуживает
+    апдейты. Файлы отчета по организации уходят в chat_ids, личные сводки
+    (notify_users) — через outbox. Возвращает число пользователей в отчете.
+    """
+    global report_pool
+    loop = asyncio.get_running_loop()
+    data = await asyncio.to_thread(weekly_report_data, week_start)
+    pool = await asyncio.to_thread(get_report_pool)
+    try:
+        files, summaries = await loop.run_in_executor(pool, render_weekly_report, data, notify_users)
+    except BrokenProcessPool:
+        # Процесс отрисовки упал — следующий отчет создаст пул заново
+        report_pool = None
+        raise
+
+    if summaries:
+        await asyncio.to_thread(enqueue_report_summaries, summaries)
+    caption = f"📊 Отчет за неделю {week_start.strftime('%d.%m')}–{data['week_end'].strftime('%d.%m.%Y')}"
+    await send_report_files(bot, chat_ids, files, caption)
+    return len(data["users"])
+
+# Периодическая задача: недельный отчет за прошедшую неделю
+async def weekly_report_job(context: ContextTypes.DEFAULT_TYPE):
+    week_start = report_week_start(local_now(DEFAULT_TIMEZONE).date()) - timedelta(days=7)
+    started = time.perf_counter()
+    try:
+        users_count = await build_weekly_report(context.bot, week_start, ADMINS, notify_users=REPORT_USER_SUMMARIES)
+    except Exception as e:
+        logger.error(f"Ошибка недельного отчета: {e}")
+        return
+    logger.info(f"Недельный отчет с {week_start}: пользователей {users_count}, {time.perf_counter() - started:.1f} с")
+
+async def report_request(bot, chat_id, week_start):
+    try:
+        await build_weekly_report(bot, week_start, [chat_id])
+    except Exception as e:
+        logger.error(f"Ошибка отчета по запросу: {e}")
+        await bot.send_message(chat_id=chat_id, text="❌ Не удалось собрать отчет. Попробуйте позже.")
+
+# Команда /report [last] (только для админа)
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
+        return
+    if context.args not in ([], ["last"]):
+        await update.message.reply_text("❌ Используйте: /report (текущая неделя) или /report last (прошлая неделя)")
+        return
+
+    week_start = report_week_start(local_now(DEFAULT_TIMEZONE).date())
+    if context.args:
+        week_start -= timedelta(days=7)
+    await update.message.reply_text(f"⏳ Готовлю отчет за неделю с {week_start.strftime('%d.%m')}, пришлю файлами.")
+    # Отчет собирается в фоне: апдейты обрабатываются по очереди, и ожидание здесь задержало бы всех
+    context.application.create_task(report_request(context.bot, update.effective_chat.id, week_start), update=update)
+
+# Команда /digest [on|off]
+async def set_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    db = get_db()
+    
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        await update.message.reply_text("❌ Сначала зарегистрируйтесь командой /start.")
+        return
+    
+    if len(context.args) != 1 or context.args[0].lower() not in ("on", "off"):
+        enabled = REMINDER_DIGEST_DEFAULT if user.reminder_digest is None else user.reminder_digest
+        await update.message.reply_text(
+            f"📬 <b>Дайджест напоминаний:</b> {'включен' if enabled else 'выключен'}\n\n"
+            f"В режиме дайджеста напоминания по всем проектам с одинаковым временем "
+            f"приходят одним сообщением.\n\n"
+            f"• /digest on - включить\n"
+            f"• /digest off - выключить",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    user.reminder_digest = context.args[0].lower() == "on"
+    db.commit()
+    
+    await update.message.reply_text(
+        "✅ Дайджест включен: напоминания будут приходить одним сообщением."
+        if user.reminder_digest else
+        "✅ Дайджест выключен: по каждому проекту будет отдельное напоминание."
+    )
+
+def draft_memory_stats(application):
+    """Количество живых черновиков проектов и их примерный размер в байтах"""
+    drafts = [
+        data['project'] for data in application.user_data.values()
+        if isinstance(data.get('project'), ProjectDraft)
+    ]
+    return len(drafts), sum(draft.approx_size() for draft in drafts)
+
+# Периодическая задача: удаление брошенных черновиков
+async def cleanup_drafts_job(context: ContextTypes.DEFAULT_TYPE):
+    application = context.application
+    deadline = time.monotonic() - CONVERSATION_TIMEOUT
+    removed = 0
+    for user_id, data in list(application.user_data.items()):
+        draft = data.get('project')
+        if draft is not None and (not isinstance(draft, ProjectDraft) or draft.touched_at < deadline):
+            # Только просроченный черновик проекта: черновики других диалогов еще в работе
+            data.pop('project', None)
+            removed += 1
+        if not data:
+            application.drop_user_data(user_id)
+    
+    count, size = draft_memory_stats(application)
+    logger.info(f"Черновики: удалено {removed}, живых {count}, ~{size / 1024:.1f} КБ")
+
+# Команда /drafts (только для админа)
+async def drafts_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("⛔️ У вас нет доступа к этой команде.")
+        return
+    
+    count, size = draft_memory_stats(context.application)
+    await update.message.reply_text(
+        f"📝 <b>Черновики проектов в памяти</b>\n\n"
+        f"• Живых черновиков: {count}\n"
+        f"• Примерный объем: {size / 1024:.1f} КБ\n"
+        f"• Таймаут диалога: {CONVERSATION_TIMEOUT // 60} мин",
+        parse_mode=ParseMode.HTML
+    )
 
 # Команда /changename
 async def change_name_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -965,29 +2775,66 @@ async def change_name_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
 # Основная функция
 def main():
     logger.info("Запуск Project Manager Bot...")
+    timings = [("импорт", time.perf_counter() - IMPORT_STARTED)]
     
-    # Создаем таблицы
-    create_tables()
-    
-    # Получаем токен
+    # Получаем токен (до обращения к БД, чтобы без токена не ждать подключения)
     token = os.getenv("TELEGRAM_TOKEN")
     if not token:
         logger.error("TELEGRAM_TOKEN не найден!")
         return
     
+    # Первое подключение к БД; соединение остается в пуле для следующих шагов
+    stage = time.perf_counter()
+    with get_engine().connect():
+        pass
+    timings.append(("подключение к БД", time.perf_counter() - stage))
+    
+    # Создаем и обновляем таблицы, только если версия схемы устарела
+    stage = time.perf_counter()
+    migrated = create_tables()
+    timings.append(("схема БД (миграция)" if migrated else "схема БД (актуальна)", time.perf_counter() - stage))
+    
+    stage = time.perf_counter()
+    load_reminder_schedule()
+    update_dedup.load(load_update_offset())
+    timings.append(("напоминания", time.perf_counter() - stage))
+    
+    stage = time.perf_counter()
     # Создаем приложение
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(post_shutdown).build()
+    
+    # Повторно доставленные апдейты отбрасываются до всех обработчиков
+    application.add_handler(TypeHandler(Update, drop_duplicate_update), group=-2)
+    application.add_handler(TypeHandler(Update, bind_update_user), group=-1)
+    application.add_handler(TypeHandler(Update, mark_update_done), group=1)
     
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("users", users))
     application.add_handler(CommandHandler("projects", all_projects))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("report", report_command))
     application.add_handler(CommandHandler("seereminder", see_reminder))
     application.add_handler(CommandHandler("myprojects", my_projects))
     application.add_handler(CommandHandler("complete", complete_project))
     application.add_handler(CommandHandler("daily", show_daily_tasks))
+    application.add_handler(CommandHandler("ical", export_ical))
     application.add_handler(CommandHandler("delete", delete_project))
+    application.add_handler(CommandHandler("complete_task", complete_task))
+    application.add_handler(CommandHandler("skip_task", skip_task))
+    application.add_handler(CallbackQueryHandler(task_button, pattern=r"^task:"))
+    application.add_handler(CommandHandler("timezone", set_timezone))
+    application.add_handler(CommandHandler("digest", set_digest))
+    application.add_handler(CommandHandler("drafts", drafts_stats))
+    application.add_handler(CommandHandler("savetemplate", save_template))
+    application.add_handler(CommandHandler("templates", list_templates))
+    application.add_handler(CommandHandler("clone", clone_command))
+    application.add_handler(CommandHandler("assign", assign_template))
+    application.add_handler(CommandHandler("find", find_projects))
+    application.add_handler(CallbackQueryHandler(find_page_button, pattern=r"^find:\d+$"))
     
     # Диалог создания проекта
     newproject_handler = ConversationHandler(
@@ -1000,18 +2847,50 @@ def main():
             START_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, newproject_start_date)],
             PROJECT_OWNER: [MessageHandler(filters.TEXT & ~filters.COMMAND, newproject_owner)],
             CONFIRM_PROJECT: [MessageHandler(filters.TEXT & ~filters.COMMAND, newproject_confirm)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout("project"))],
         },
         fallbacks=[CommandHandler("cancel", newproject_cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     application.add_handler(newproject_handler)
     
+    # Быстрый мастер создания проекта (одно редактируемое сообщение)
+    text_input = filters.TEXT & ~filters.COMMAND
+    quick_cancel = CallbackQueryHandler(quickproject_cancel, pattern=r"^qp:cancel$")
+    quickproject_handler = ConversationHandler(
+        entry_points=[CommandHandler("quickproject", quickproject_start)],
+        states={
+            QUICK_NAME: [MessageHandler(text_input, quickproject_name), quick_cancel],
+            QUICK_DAYS: [CallbackQueryHandler(quickproject_days, pattern=r"^qp:days:\d+$"), quick_cancel],
+            QUICK_TASKS: [MessageHandler(text_input, quickproject_tasks), quick_cancel],
+            QUICK_TIME: [
+                CallbackQueryHandler(quickproject_time_button, pattern=r"^qp:time:"),
+                MessageHandler(text_input, quickproject_time_text),
+                quick_cancel,
+            ],
+            QUICK_DATE: [CallbackQueryHandler(quickproject_date, pattern=r"^qp:date:"), quick_cancel],
+            QUICK_OWNER: [
+                CallbackQueryHandler(quickproject_owner_button, pattern=r"^qp:owner:"),
+                MessageHandler(text_input, quickproject_owner_text),
+                quick_cancel,
+            ],
+            QUICK_CONFIRM: [CallbackQueryHandler(quickproject_confirm, pattern=r"^qp:confirm$"), quick_cancel],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout("project"))],
+        },
+        fallbacks=[CommandHandler("cancel", newproject_cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+    )
+    application.add_handler(quickproject_handler)
+    
     # Диалог добавления дня
     add_day_handler = ConversationHandler(
         entry_points=[CommandHandler("plusoneday", add_day_to_project)],
         states={
             ADD_DAY_TASK: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_day_task)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout("add_day"))],
         },
         fallbacks=[CommandHandler("cancel", newproject_cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     application.add_handler(add_day_handler)
     
@@ -1021,8 +2900,10 @@ def main():
         states={
             REMINDER_COUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, reminder_count)],
             REMINDER_TIMES: [MessageHandler(filters.TEXT & ~filters.COMMAND, reminder_times)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout("reminder_settings"))],
         },
         fallbacks=[CommandHandler("cancel", newproject_cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     application.add_handler(reminder_settings_handler)
     
@@ -1032,11 +2913,41 @@ def main():
         states={
             CHANGE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_name_input)],
             CONFIRM_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, change_name_confirm)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout("new_name"))],
         },
         fallbacks=[CommandHandler("cancel", newproject_cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
     application.add_handler(change_name_handler)
     
+    # Диспетчер напоминаний
+    application.job_queue.run_repeating(dispatch_reminders, interval=REMINDER_TICK_SECONDS, first=1)
+    application.job_queue.run_repeating(outbox_job, interval=OUTBOX_TICK_SECONDS, first=1)
+    # Очистка брошенных черновиков диалогов
+    application.job_queue.run_repeating(cleanup_drafts_job, interval=DRAFT_CLEANUP_INTERVAL_SECONDS, first=DRAFT_CLEANUP_INTERVAL_SECONDS)
+    # Пакетное обновление жизненного цикла проектов
+    application.job_queue.run_repeating(lifecycle_job, interval=LIFECYCLE_INTERVAL_SECONDS, first=10)
+    application.job_queue.run_repeating(update_offset_job, interval=UPDATE_OFFSET_FLUSH_SECONDS, first=UPDATE_OFFSET_FLUSH_SECONDS)
+    application.job_queue.run_repeating(stats_flush_job, interval=STATS_FLUSH_SECONDS, first=STATS_FLUSH_SECONDS)
+    application.job_queue.run_repeating(stats_rollup_job, interval=STATS_ROLLUP_INTERVAL_SECONDS, first=60)
+    # Журнал событий: пакетная запись буфера и удаление старых месяцев
+    application.job_queue.run_repeating(event_log_job, interval=EVENT_FLUSH_MS / 1000, first=EVENT_FLUSH_MS / 1000)
+    application.job_queue.run_repeating(event_purge_job, interval=EVENT_PURGE_INTERVAL_SECONDS, first=120)
+    # Недельный отчет по понедельникам (в PTB 20 дни недели считаются с воскресенья: 1 — понедельник)
+    application.job_queue.run_daily(
+        weekly_report_job, time=parse_reminder_time(REPORT_TIME).replace(tzinfo=ZoneInfo(DEFAULT_TIMEZONE)), days=(1,)
+    )
+    
+    if PROFILING_ENABLED:
+        # Обертки учитывают время только во время сеанса /profile
+        profiler.instrument(application)
+        for job in application.job_queue.jobs():
+            job.callback = profiler.wrap(job.callback)
+    
+    timings.append(("приложение", time.perf_counter() - stage))
+    
+    total = time.perf_counter() - IMPORT_STARTED
+    logger.info(f"Старт за {total:.3f} с: " + ", ".join(f"{name} {seconds:.3f} с" for name, seconds in timings))
     logger.info("Project Manager Bot запущен!")
     application.run_polling()
 
@@ -1,21 +1,177 @@
 import os
+import re
+import time
+import logging
+from contextvars import ContextVar
 from dotenv import load_dotenv
-from sqlalchemy import Column, BigInteger, Integer, String, ForeignKey, create_engine, DateTime, Text
+from sqlalchemy import (
+    Column, BigInteger, Integer, String, Boolean, ForeignKey, create_engine, DateTime, Date, Text,
+    select, update, insert, inspect, text, func, cast, literal, true, and_, or_, UniqueConstraint, Index, MetaData, Table
+)
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow")
+# Версия схемы: увеличивать при каждом изменении моделей, иначе create_tables() пропустит миграцию
+SCHEMA_VERSION = 8
+
+# Движок и фабрика сессий создаются при первом обращении к БД, а не при импорте
+_engine = None
+_session_factory = sessionmaker(autocommit=False, autoflush=False)
+# Реплика для чтения (DATABASE_READ_URL); без нее чтение идет в основную БД
+_read_engine = None
+_read_session_factory = sessionmaker(autocommit=False, autoflush=False)
 Base = declarative_base()
 
+# Сколько секунд после своей записи пользователь читает из основной БД,
+# чтобы не увидеть устаревшие данные из отстающей реплики
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+# Пользователь, чей апдейт сейчас обрабатывается (выставляет бот)
+current_user_id = ContextVar("current_user_id", default=None)
+_recent_writes = {}  # user_id -> time.monotonic() последней записи
+_recent_writes_pruned_at = 0.0
+
+# Аренда пачки outbox: столько секунд занятые сообщения не видны другим отправителям
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+
+# Без DATABASE_URL бот работает на встроенной SQLite в файле рядом с ботом
+DEFAULT_DATABASE_URL = "sqlite:///" + os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_MB", "256")) * 1024 * 1024
+# RETURNING (журнал доставки) появился в SQLite 3.35, FILTER в агрегатах — в 3.30
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+def _create_engine(url, read_only=False):
+    """Создает движок; для SQLite включает WAL и настраивает соединения.
+
+    В режиме WAL читатели не блокируют писателя и друг друга, а писатели
+    выстраиваются в очередь через busy_timeout вместо ошибки «database is locked».
+    read_only — отдельный пул читателей (PRAGMA query_only) для ReadSessionLocal.
+    """
+    if not url.startswith("sqlite"):
+        return create_engine(url)
+    
+    import sqlite3
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError(
+            f"Нужна SQLite не ниже {'.'.join(map(str, SQLITE_MIN_VERSION))}, установлена {sqlite3.sqlite_version}"
+        )
+    engine = create_engine(
+        url,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000, "check_same_thread": False}
+    )
+    
+    @event.listens_for(engine, "connect")
+    def _configure_sqlite(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # В WAL при NORMAL коммит не ждет fsync журнала, данные не теряются при падении процесса
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        # Без этого SQLite не выполняет ON DELETE CASCADE
+        cursor.execute("PRAGMA foreign_keys=ON")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+    
+    return engine
+
+def get_engine():
+    """Возвращает движок БД, создавая его при первом вызове"""
+    global _engine
+    if _engine is None:
+        load_dotenv()
+        url = os.getenv("DATABASE_URL")
+        if not url:
+            # Забытая переменная в продакшене иначе молча запустит бота на пустой БД
+            logger.warning(f"DATABASE_URL не задан, используется встроенная SQLite: {DEFAULT_DATABASE_URL}")
+            url = DEFAULT_DATABASE_URL
+        _engine = _create_engine(url)
+        _session_factory.configure(bind=_engine)
+    return _engine
+
+def SessionLocal():
+    """Новая сессия БД (движок создается лениво)"""
+    if _engine is None:
+        get_engine()
+    return _session_factory()
+
+def get_read_engine():
+    """Движок реплики для чтения.
+
+    Без DATABASE_READ_URL для файла SQLite это отдельный пул читателей того же
+    файла, для остальных БД — основной движок.
+    """
+    global _read_engine
+    if _read_engine is None:
+        load_dotenv()
+        read_url = os.getenv("DATABASE_READ_URL")
+        engine = get_engine()
+        if read_url:
+            _read_engine = _create_engine(read_url, read_only=True)
+        elif engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:"):
+            _read_engine = _create_engine(str(engine.url), read_only=True)
+        else:
+            _read_engine = engine
+        _read_session_factory.configure(bind=_read_engine)
+    return _read_engine
+
+def ReadSessionLocal(user_id=None):
+    """Сессия только для чтения: реплика, но основная БД, если пользователь
+    недавно сам что-то записал (read-your-writes)"""
+    wrote_at = _recent_writes.get(user_id)
+    if wrote_at is not None:
+        if time.monotonic() - wrote_at < READ_YOUR_WRITES_SECONDS:
+            return SessionLocal()
+        _recent_writes.pop(user_id, None)
+    if _read_engine is None:
+        get_read_engine()
+    return _read_session_factory()
+
+def note_user_write(user_id=None):
+    """Отмечает запись пользователя (по умолчанию — текущего апдейта)"""
+    global _recent_writes_pruned_at
+    user_id = user_id if user_id is not None else current_user_id.get()
+    if user_id is None:
+        return
+    now = time.monotonic()
+    _recent_writes[user_id] = now
+    # Раз в окно read-your-writes убираем истекшие отметки: иначе пользователи,
+    # которые записали и больше не читали, копились бы до перезапуска
+    if now - _recent_writes_pruned_at >= READ_YOUR_WRITES_SECONDS:
+        _recent_writes_pruned_at = now
+        for stale_id, wrote_at in list(_recent_writes.items()):
+            if now - wrote_at >= READ_YOUR_WRITES_SECONDS:
+                _recent_writes.pop(stale_id, None)
+
+# Любая запись через сессии основной БД включает read-your-writes для текущего пользователя
+@event.listens_for(_session_factory, "after_flush")
+def _note_flush(session, flush_context):
+    note_user_write()
+
+@event.listens_for(_session_factory, "do_orm_execute")
+def _note_bulk_write(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        note_user_write()
+
+def utcnow():
+    """Текущее время в UTC (наивный datetime — так время хранится в БД)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(Base):
     __tablename__ = "users"
     id = Column(BigInteger, primary_key=True)  # Telegram ID
     short_id = Column(Integer, unique=True, autoincrement=True)  # Короткий ID
     username = Column(String, nullable=True)
     display_name = Column(String(100), nullable=True)  # Пользовательский никнейм
+    timezone = Column(String(64), nullable=True, default=DEFAULT_TIMEZONE)  # IANA, например Europe/Moscow
+    reminder_digest = Column(Boolean, nullable=True)  # Объединять напоминания в одно сообщение (None — по умолчанию)
     projects = relationship("Project", back_populates="user")
 
 class Project(Base):
@@ -25,13 +181,20 @@ class Project(Base):
     user_id = Column(BigInteger, ForeignKey("users.id"))
     name = Column(String(100), nullable=False)
     days_count = Column(Integer, nullable=False)
-    reminder_time = Column(String(5), default="09:00")  # HH:MM
-    status = Column(String(20), default="active")  # active, completed, paused
-    created_at = Column(DateTime, default=datetime.utcnow)
+    reminder_time = Column(String(5), default="09:00")  # HH:MM по времени владельца
+    reminder_utc_minute = Column(Integer, nullable=True)  # Минута суток UTC ближайшего напоминания
+    next_reminder_at = Column(DateTime, nullable=True, index=True)  # Ближайшее напоминание (UTC)
+    status = Column(String(20), default="active")  # active, completed, paused, template
+    created_at = Column(DateTime, default=utcnow)
     start_date = Column(DateTime, nullable=True)
+    end_date = Column(DateTime, nullable=True, index=True)  # Последний день проекта
+    current_day = Column(Integer, nullable=True)  # Текущий день по времени владельца (< 1 — еще не начался)
     created_by = Column(BigInteger, nullable=True)
+    creation_key = Column(String(64), nullable=True, unique=True, index=True)  # Ключ идемпотентности создания
+    is_team = Column(Boolean, nullable=True, default=False)  # Командный: задачи выполняют участники из project_members
     user = relationship("User", back_populates="projects")
     daily_tasks = relationship("DailyTask", back_populates="project", cascade="all, delete-orphan")
+    members = relationship("ProjectMember", cascade="all, delete-orphan", passive_deletes=True)
 
 class DailyTask(Base):
     __tablename__ = "daily_tasks"
@@ -42,9 +205,317 @@ class DailyTask(Base):
     completed = Column(String(20), default="pending")  # pending, completed, skipped
     completed_at = Column(DateTime, nullable=True)
     project = relationship("Project", back_populates="daily_tasks")
+    member_statuses = relationship("MemberTask", cascade="all, delete-orphan", passive_deletes=True)
+    __table_args__ = (
+        # Одна задача на день проекта: повторная вставка того же дня не создаст дубль
+        Index("uq_daily_tasks_project_day", "project_id", "day_number", unique=True),
+    )
+
+class ProjectMember(Base):
+    """Участник командного проекта (владелец проекта — руководитель команды)"""
+    __tablename__ = "project_members"
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, index=True)
+    joined_at = Column(DateTime, default=utcnow)
+
+class MemberTask(Base):
+    """Статус задачи дня у участника командного проекта.
+
+    В командном проекте DailyTask хранит только текст задачи, а выполнение
+    отмечается здесь — по строке на (задача, участник).
+    """
+    __tablename__ = "member_tasks"
+    task_id = Column(Integer, ForeignKey("daily_tasks.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    completed = Column(String(20), default="pending")  # pending, completed, skipped
+    completed_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index("ix_member_tasks_user_status", "user_id", "completed"),
+    )
+
+class ReminderDelivery(Base):
+    """Журнал доставки напоминаний: одна строка на (проект, день, слот, получатель).
+
+    У командного проекта получателей несколько — по строке на каждого
+    участника, чтобы итог и статистика отправки велись по сообщениям.
+    """
+    __tablename__ = "reminder_deliveries"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
+    day_number = Column(Integer, nullable=False)
+    slot = Column(DateTime, nullable=False)  # Плановое время напоминания (UTC)
+    user_id = Column(BigInteger, nullable=False)  # Получатель напоминания
+    status = Column(String(20), default="claimed")  # claimed, sent, failed, expired
+    claimed_at = Column(DateTime, default=utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        UniqueConstraint("project_id", "day_number", "slot", "user_id", name="uq_reminder_delivery_recipient"),
+        Index("ix_reminder_deliveries_status_slot", "status", "slot"),
+    )
+
+class OutboxMessage(Base):
+    """Исходящее уведомление: пишется в одной транзакции с изменением данных,
+    отправляется фоновой задачей с повторами"""
+    __tablename__ = "outbox"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(20), nullable=False)  # assignment, reminder, report
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    reply_markup = Column(Text, nullable=True)  # JSON клавиатуры
+    delivery_ids = Column(String(500), nullable=True)  # Записи журнала напоминаний через запятую
+    status = Column(String(20), default="pending")  # pending, sending (занято отправителем), sent, failed, expired
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, default=utcnow)
+    last_error = Column(String(300), nullable=True)
+    created_at = Column(DateTime, default=utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index("ix_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+class UserStats(Base):
+    """Сводка по пользователю для /stats: обновляется при смене статуса задач
+    и пересчитывается периодической сверкой"""
+    __tablename__ = "user_stats"
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    projects_active = Column(Integer, nullable=False, default=0)
+    tasks_total = Column(Integer, nullable=False, default=0)
+    tasks_completed = Column(Integer, nullable=False, default=0)
+    tasks_skipped = Column(Integer, nullable=False, default=0)
+    tasks_overdue = Column(Integer, nullable=False, default=0)  # Пропущены автоматически по истечении дня
+    updated_at = Column(DateTime, default=utcnow)
+
+class DailyStats(Base):
+    """Сводка за день (UTC) для /stats"""
+    __tablename__ = "daily_stats"
+    day = Column(Date, primary_key=True)
+    active_projects = Column(Integer, nullable=False, default=0)  # Снимок при последней сверке за день
+    tasks_completed = Column(Integer, nullable=False, default=0)
+    tasks_skipped = Column(Integer, nullable=False, default=0)
+    tasks_overdue = Column(Integer, nullable=False, default=0)
+    reminders_sent = Column(Integer, nullable=False, default=0)
+    reminders_failed = Column(Integer, nullable=False, default=0)
+
+class UpdateOffset(Base):
+    """Единственная строка с наибольшим обработанным update_id Telegram"""
+    __tablename__ = "update_offset"
+    id = Column(Integer, primary_key=True)
+    last_update_id = Column(BigInteger, nullable=False)
+
+class SchemaVersion(Base):
+    """Единственная строка с версией схемы, до которой обновлена БД"""
+    __tablename__ = "schema_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+def schema_is_current():
+    """Одним запросом проверяет, что схема БД уже обновлена до SCHEMA_VERSION"""
+    try:
+        with get_engine().connect() as conn:
+            return conn.execute(select(SchemaVersion.version)).scalar() == SCHEMA_VERSION
+    except DBAPIError:
+        # Таблицы версии еще нет — БД новая или создана до появления версионирования
+        return False
 
 def create_tables():
+    """Создает и обновляет таблицы, если схема устарела.
+
+    Возвращает True, если миграция выполнялась, и False, если схема уже актуальна.
+    """
+    if schema_is_current():
+        return False
+    engine = get_engine()
     Base.metadata.create_all(bind=engine)
+    upgrade_schema()
+    with engine.begin() as conn:
+        conn.execute(SchemaVersion.__table__.delete())
+        conn.execute(SchemaVersion.__table__.insert().values(id=1, version=SCHEMA_VERSION))
+    return True
+
+def upgrade_schema():
+    """Добавляет в существующие таблицы колонки, появившиеся в моделях позже.
+
+    create_all не меняет уже созданные таблицы, поэтому новые nullable-колонки
+    докатываем через ALTER TABLE ... ADD COLUMN.
+    """
+    engine = get_engine()
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        # Журнал доставки раньше держал одну строку на слот. Уникальное ограничение
+        # на месте не поменять (SQLite), а журнал нужен только против повторов в
+        # окне догоняющей отправки — пересоздаем таблицу с ключом по получателю
+        deliveries = ReminderDelivery.__table__
+        rebuilt = set()
+        if inspector.has_table(deliveries.name) and "user_id" not in {
+            c["name"] for c in inspector.get_columns(deliveries.name)
+        }:
+            deliveries.drop(bind=conn)
+            deliveries.create(bind=conn)
+            rebuilt.add(deliveries.name)
+        # Перед уникальным индексом по (project_id, day_number) убираем дубли дней
+        if inspector.has_table(DailyTask.__tablename__):
+            first_tasks = select(func.min(DailyTask.id)).group_by(DailyTask.project_id, DailyTask.day_number)
+            conn.execute(DailyTask.__table__.delete().where(DailyTask.id.notin_(first_tasks)))
+        for table in Base.metadata.sorted_tables:
+            if table.name in rebuilt:
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+    create_search_index()
+
+# Полнотекстовый поиск: в PostgreSQL — GIN-индексы pg_trgm, в SQLite — таблицы FTS5,
+# которые поддерживаются в актуальном состоянии триггерами
+_PG_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_projects_name_trgm ON projects USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_daily_tasks_description_trgm ON daily_tasks USING gin (description gin_trgm_ops)",
+]
+
+def _fts5_ddl(table, column):
+    fts = f"{table}_fts"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='id', tokenize='unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column}); END",
+        # Индексируем строки, созданные до появления поиска
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+_SQLITE_SEARCH_DDL = _fts5_ddl("projects", "name") + _fts5_ddl("daily_tasks", "description")
+
+# Совпадения по названию проекта весят больше, чем по тексту задач
+_PG_SEARCH_HITS = """
+    SELECT id AS project_pk, 2 * similarity(name, :query) AS score
+    FROM projects WHERE name ILIKE :pattern ESCAPE '\\'
+    UNION ALL
+    SELECT project_id, similarity(description, :query)
+    FROM daily_tasks WHERE description ILIKE :pattern ESCAPE '\\'
+"""
+
+_SQLITE_SEARCH_HITS = """
+    SELECT rowid AS project_pk, -2 * bm25(projects_fts) AS score
+    FROM projects_fts WHERE projects_fts MATCH :match
+    UNION ALL
+    SELECT t.project_id, -bm25(daily_tasks_fts)
+    FROM daily_tasks_fts JOIN daily_tasks t ON t.id = daily_tasks_fts.rowid
+    WHERE daily_tasks_fts MATCH :match
+"""
+
+_LIKE_SEARCH_HITS = """
+    SELECT id AS project_pk, 2 AS score FROM projects WHERE lower(name) LIKE :pattern ESCAPE '\\'
+    UNION ALL
+    SELECT project_id, 1 FROM daily_tasks WHERE lower(description) LIKE :pattern ESCAPE '\\'
+"""
+
+_search_backend = None
+
+def create_search_index():
+    """Создает индексы поиска по названиям проектов и задачам для текущего диалекта.
+
+    Если индекс создать не удалось (нет прав на расширение, SQLite без FTS5),
+    поиск продолжит работать через LIKE, только медленнее.
+    """
+    global _search_backend
+    engine = get_engine()
+    statements = {"postgresql": _PG_SEARCH_DDL, "sqlite": _SQLITE_SEARCH_DDL}.get(engine.dialect.name)
+    if not statements:
+        return
+    try:
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+    except DBAPIError as e:
+        logger.warning(f"Индекс поиска не создан, поиск будет работать через LIKE: {e}")
+    _search_backend = None
+
+def search_backend():
+    """Какой поиск доступен в БД: pg_trgm, fts5 или like (определяется один раз)"""
+    global _search_backend
+    if _search_backend is None:
+        engine = get_engine()
+        with engine.connect() as conn:
+            if engine.dialect.name == "postgresql":
+                found = conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar()
+                _search_backend = "pg_trgm" if found else "like"
+            elif engine.dialect.name == "sqlite":
+                found = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'daily_tasks_fts'")).scalar()
+                _search_backend = "fts5" if found else "like"
+            else:
+                _search_backend = "like"
+    return _search_backend
+
+def _like_pattern(query):
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def search_projects(db, query, user_id=None, limit=10, offset=0):
+    """Ищет проекты по названию и тексту задач, лучшие совпадения первыми.
+
+    user_id ограничивает поиск проектами владельца и командными проектами,
+    где он участник (None — все проекты).
+    Возвращает (список пар (Project, User), есть_ли_следующая_страница).
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return [], False
+    
+    backend = search_backend()
+    if backend == "fts5":
+        hits = _SQLITE_SEARCH_HITS
+        # Каждое слово — префиксный запрос; кавычки экранируют синтаксис FTS5
+        params = {"match": " ".join(f'"{word}"*' for word in words)}
+    elif backend == "pg_trgm":
+        hits = _PG_SEARCH_HITS
+        params = {"query": query, "pattern": _like_pattern(query)}
+    else:
+        hits = _LIKE_SEARCH_HITS
+        params = {"pattern": _like_pattern(query.lower())}
+    
+    owner_filter = (
+        "WHERE p.user_id = :user_id OR p.id IN (SELECT project_id FROM project_members WHERE user_id = :user_id)"
+        if user_id is not None else ""
+    )
+    stmt = text(f"""
+        WITH hits AS ({hits})
+        SELECT h.project_pk, max(h.score) AS score
+        FROM hits h JOIN projects p ON p.id = h.project_pk
+        {owner_filter}
+        GROUP BY h.project_pk
+        ORDER BY score DESC, h.project_pk DESC
+        LIMIT :limit OFFSET :offset
+    """)
+    params.update(user_id=user_id, limit=limit + 1, offset=offset)
+    ranked = [pk for pk, _ in db.execute(stmt, params).all()]
+    has_more = len(ranked) > limit
+    ranked = ranked[:limit]
+    if not ranked:
+        return [], False
+    
+    rows = (
+        db.query(Project, User)
+        .outerjoin(User, User.id == Project.user_id)
+        .filter(Project.id.in_(ranked))
+        .all()
+    )
+    order = {pk: position for position, pk in enumerate(ranked)}
+    rows.sort(key=lambda row: order[row[0].id])
+    return rows, has_more
+
+def user_timezone(db, user_id):
+    """Часовой пояс пользователя или часовой пояс по умолчанию"""
+    tz_name = db.query(User.timezone).filter(User.id == user_id).scalar()
+    return tz_name or DEFAULT_TIMEZONE
 
 def generate_project_id():
     """Генерирует последовательный 4-значный номер проекта"""
@@ -66,6 +537,922 @@ def generate_project_id():
     finally:
         db.close()
 
+def generate_project_ids(db, count):
+    """Генерирует `count` последовательных 4-значных номеров проектов одним запросом"""
+    max_project_id = db.query(func.max(Project.project_id)).scalar()
+    try:
+        next_id = int(max_project_id) + 1 if max_project_id else 1
+    except ValueError:
+        next_id = 1
+    return [f"{next_id + i:04d}" for i in range(count)]
+
+def clone_project(db, source, owners, start_date, created_by, status="active", plan=None):
+    """Копирует проект и все его задачи для каждого владельца из `owners`.
+
+    Новые проекты вставляются одним пакетным INSERT, задачи — одним
+    INSERT ... SELECT из задач исходного проекта. plan(project, owner) вызывается
+    для каждой копии до вставки (например, чтобы рассчитать напоминание).
+    Коммит остается за вызывающим кодом. Возвращает список новых проектов.
+    """
+    project_ids = generate_project_ids(db, len(owners))
+    clones = []
+    for project_id, owner in zip(project_ids, owners):
+        clone = Project(
+            project_id=project_id,
+            user_id=owner.id,
+            name=source.name,
+            days_count=source.days_count,
+            reminder_time=source.reminder_time,
+            status=status,
+            start_date=start_date,
+            created_by=created_by
+        )
+        if plan:
+            plan(clone, owner)
+        clones.append(clone)
+    db.add_all(clones)
+    db.flush()
+    
+    copied_tasks = (
+        select(Project.id, DailyTask.day_number, DailyTask.description)
+        .select_from(DailyTask)
+        .join(Project, true())
+        .where(DailyTask.project_id == source.id, Project.id.in_([clone.id for clone in clones]))
+    )
+    db.execute(insert(DailyTask).from_select(["project_id", "day_number", "description"], copied_tasks))
+    bump_user_stats(db, project_stats_deltas(db, Project.id.in_([clone.id for clone in clones])))
+    return clones
+
+def project_visible_to(user_id):
+    """Условие для запросов к Project: пользователь владелец или участник проекта"""
+    memberships = select(ProjectMember.project_id).where(ProjectMember.user_id == user_id)
+    return or_(Project.user_id == user_id, Project.id.in_(memberships))
+
+def add_project_members(db, project_pk, user_ids):
+    """Добавляет участников командного проекта.
+
+    Участники вставляются одним пакетным INSERT, их статусы задач — одним
+    INSERT ... SELECT (участники × задачи проекта), сколько бы их ни было.
+    Коммит остается за вызывающим кодом.
+    """
+    now = utcnow()
+    db.execute(insert(ProjectMember), [
+        {"project_id": project_pk, "user_id": user_id, "joined_at": now} for user_id in user_ids
+    ])
+    add_member_tasks(db, project_pk, user_ids=user_ids)
+
+def add_member_tasks(db, project_pk, user_ids=None, day_number=None):
+    """Создает строки статусов задач для участников одним INSERT ... SELECT.
+
+    user_ids ограничивает участников (None — все), day_number — задачи
+    (None — все дни проекта). Коммит остается за вызывающим кодом.
+    """
+    pairs = (
+        select(DailyTask.id, ProjectMember.user_id)
+        .join(ProjectMember, ProjectMember.project_id == DailyTask.project_id)
+        .where(DailyTask.project_id == project_pk)
+    )
+    if user_ids is not None:
+        pairs = pairs.where(ProjectMember.user_id.in_(user_ids))
+    if day_number is not None:
+        pairs = pairs.where(DailyTask.day_number == day_number)
+    db.execute(insert(MemberTask).from_select(["task_id", "user_id"], pairs))
+
+def team_progress(db, project_pks, user_id=None):
+    """Прогресс командных проектов одним запросом: {project_pk: (выполнено, всего, участников)}.
+
+    Если user_id — участник проекта, считается его личный прогресс, иначе
+    (например, для руководителя) — суммарный по всем участникам.
+    """
+    if not project_pks:
+        return {}
+    is_user = MemberTask.user_id == user_id
+    done = MemberTask.completed == "completed"
+    rows = db.execute(
+        select(
+            DailyTask.project_id,
+            func.count().filter(is_user, done),
+            func.count().filter(is_user),
+            func.count().filter(done),
+            func.count(),
+            func.count(MemberTask.user_id.distinct()),
+        )
+        .join(MemberTask, MemberTask.task_id == DailyTask.id)
+        .where(DailyTask.project_id.in_(project_pks))
+        .group_by(DailyTask.project_id)
+    ).all()
+    return {
+        pk: (own_done, own_total, members) if own_total else (all_done, all_total, members)
+        for pk, own_done, own_total, all_done, all_total, members in rows
+    }
+
+def team_day_statuses(db, project_pk, user_id):
+    """Статусы дней командного проекта для /daily.
+
+    Участнику — {день: его статус}, остальным — {день: (выполнено, участников)}.
+    """
+    rows = db.execute(
+        select(DailyTask.day_number, MemberTask.user_id, MemberTask.completed)
+        .join(MemberTask, MemberTask.task_id == DailyTask.id)
+        .where(DailyTask.project_id == project_pk)
+    ).all()
+    own = {day: completed for day, member_id, completed in rows if member_id == user_id}
+    if own:
+        return own
+    totals = {}
+    for day, _, completed in rows:
+        done, members = totals.get(day, (0, 0))
+        totals[day] = (done + (completed == "completed"), members + 1)
+    return totals
+
+def team_recipients(db, project_pks):
+    """Получатели напоминаний командных проектов: {project_pk: [(user_id, дайджест, выполнено, всего)]}.
+
+    Участники с настройкой дайджеста и их личный прогресс — двумя запросами на всю пачку.
+    """
+    if not project_pks:
+        return {}
+    progress = {
+        (pk, member_id): (done, total)
+        for pk, member_id, done, total in db.execute(
+            select(
+                DailyTask.project_id, MemberTask.user_id,
+                func.count().filter(MemberTask.completed == "completed"), func.count()
+            )
+            .join(MemberTask, MemberTask.task_id == DailyTask.id)
+            .where(DailyTask.project_id.in_(project_pks))
+            .group_by(DailyTask.project_id, MemberTask.user_id)
+        ).all()
+    }
+    recipients = {}
+    for pk, member_id, digest in db.execute(
+        select(ProjectMember.project_id, ProjectMember.user_id, User.reminder_digest)
+        .join(User, User.id == ProjectMember.user_id)
+        .where(ProjectMember.project_id.in_(project_pks))
+        .order_by(ProjectMember.project_id, ProjectMember.user_id)
+    ).all():
+        done, total = progress.get((pk, member_id), (0, 0))
+        recipients.setdefault(pk, []).append((member_id, digest, done, total))
+    return recipients
+
+def calendar_projects(db, user_id, project_id=None):
+    """Проекты пользователя (свои и командные) для экспорта в календарь.
+
+    Одна строка на проект: поля расписания, часовой пояс владельца, число
+    задач и наибольший id задачи — из них складывается отпечаток версии.
+    Задачи при этом не загружаются. Шаблоны и проекты без даты начала пропускаются.
+    """
+    stmt = (
+        select(
+            Project.id, Project.project_id, Project.name, Project.start_date, Project.reminder_time,
+            Project.days_count, Project.created_at,
+            func.coalesce(User.timezone, DEFAULT_TIMEZONE).label("timezone"),
+            func.count(DailyTask.id).label("tasks_count"),
+            func.max(DailyTask.id).label("last_task_id"),
+        )
+        .outerjoin(User, User.id == Project.user_id)
+        .outerjoin(DailyTask, DailyTask.project_id == Project.id)
+        .where(project_visible_to(user_id), Project.status != "template", Project.start_date.isnot(None))
+        .group_by(
+            Project.id, Project.project_id, Project.name, Project.start_date, Project.reminder_time,
+            Project.days_count, Project.created_at, User.timezone
+        )
+        .order_by(Project.id)
+    )
+    if project_id is not None:
+        stmt = stmt.where(Project.project_id == project_id)
+    return db.execute(stmt).all()
+
+def iter_calendar_tasks(db, project_pks, batch_size=500):
+    """Задачи проектов потоком: (project_pk, номер дня, описание), по проектам и дням.
+
+    Строки читаются с серверного курсора (stream_results) порциями по
+    batch_size, а список проектов разбивается на части, чтобы не упираться
+    в лимит параметров запроса.
+    """
+    for i in range(0, len(project_pks), batch_size):
+        result = db.execute(
+            select(DailyTask.project_id, DailyTask.day_number, DailyTask.description)
+            .where(DailyTask.project_id.in_(project_pks[i:i + batch_size]))
+            .order_by(DailyTask.project_id, DailyTask.day_number),
+            execution_options={"stream_results": True, "yield_per": batch_size}
+        )
+        for partition in result.partitions():
+            yield from partition
+
+def weekly_report_data(week_start, batch_size=500):
+    """Данные недельного отчета за 7 дней с week_start (date) для reports.py.
+
+    Статусы задач сворачиваются в БД двумя агрегирующими запросами — по
+    личным проектам и по участникам командных — до строк (проект, пользователь,
+    день недели 0..6, статус, количество). Возвращаются только простые типы:
+    данные передаются в процесс отрисовки, и их сериализация не должна быть дорогой.
+    """
+    db = ReadSessionLocal()
+    try:
+        # День задачи относительно начала недели: 0 — понедельник, 6 — воскресенье
+        week_day = (DailyTask.day_number - 1 - _days_since(Project.start_date, week_start)).label("week_day")
+        in_week = (
+            Project.status != "template", Project.start_date.isnot(None),
+            week_day >= 0, week_day <= 6,
+        )
+        solo = db.execute(
+            select(Project.id, Project.user_id, week_day, DailyTask.completed, func.count())
+            .join(Project, Project.id == DailyTask.project_id)
+            .where(Project.is_team.isnot(True), Project.user_id.isnot(None), *in_week)
+            .group_by(Project.id, Project.user_id, week_day, DailyTask.completed)
+        ).all()
+        team = db.execute(
+            select(Project.id, MemberTask.user_id, week_day, MemberTask.completed, func.count())
+            .join(Project, Project.id == DailyTask.project_id)
+            .join(MemberTask, MemberTask.task_id == DailyTask.id)
+            .where(Project.is_team.is_(True), *in_week)
+            .group_by(Project.id, MemberTask.user_id, week_day, MemberTask.completed)
+        ).all()
+        rows = [
+            (pk, user_id, int(day), status or "pending", count)
+            for pk, user_id, day, status, count in solo + team
+        ]
+        # Названия проектов и имена пользователей — частями, чтобы не упираться в лимит параметров запроса
+        project_pks = sorted({row[0] for row in rows})
+        projects = {}
+        for i in range(0, len(project_pks), batch_size):
+            for pk, project_id, name, owner_id, is_team in db.execute(
+                select(Project.id, Project.project_id, Project.name, Project.user_id, Project.is_team)
+                .where(Project.id.in_(project_pks[i:i + batch_size]))
+            ).all():
+                projects[pk] = (project_id, name, owner_id, bool(is_team))
+        user_ids = sorted(({row[1] for row in rows} | {owner_id for _, _, owner_id, _ in projects.values()}) - {None})
+        users = {}
+        for i in range(0, len(user_ids), batch_size):
+            for user_id, display_name, username in db.execute(
+                select(User.id, User.display_name, User.username).where(User.id.in_(user_ids[i:i + batch_size]))
+            ).all():
+                users[user_id] = display_name or username or str(user_id)
+    finally:
+        db.close()
+    return {
+        "week_start": week_start,
+        "week_end": week_start + timedelta(days=6),
+        "rows": rows,
+        "projects": projects,
+        "users": users,
+    }
+
+def _days_since(column, today):
+    """SQL-выражение: сколько дней прошло от даты в колонке до `today`"""
+    if get_engine().dialect.name == "sqlite":
+        return cast(func.julianday(literal(today.isoformat())) - func.julianday(func.date(column)), Integer)
+    return cast(literal(today, Date), Date) - cast(column, Date)
+
+def _add_days(column, days):
+    """SQL-выражение: дата в колонке плюс `days` дней (days — выражение)"""
+    if get_engine().dialect.name == "sqlite":
+        return func.datetime(column, literal("+").concat(cast(days, String)).concat(" days"))
+    return column + func.make_interval(0, 0, 0, days)
+
+def run_lifecycle(today_for_timezone):
+    """Пакетно продвигает жизненный цикл проектов.
+
+    Для каждого часового пояса пользователей (today_for_timezone(tz) -> date)
+    несколькими UPDATE по множеству строк: заполняет end_date, пересчитывает
+    current_day, помечает просроченные задачи пропущенными и завершает проекты,
+    у которых прошел последний день. Возвращает счетчики изменений.
+    """
+    stats = {"advanced": 0, "skipped_tasks": 0, "completed": 0}
+    user_tz = func.coalesce(User.timezone, DEFAULT_TIMEZONE)
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Project)
+            .where(Project.end_date.is_(None), Project.start_date.isnot(None))
+            .values(end_date=_add_days(Project.start_date, Project.days_count - 1))
+            .execution_options(synchronize_session=False)
+        )
+        
+        for (tz_name,) in db.execute(select(user_tz).distinct()).all():
+            today = today_for_timezone(tz_name)
+            owners = select(User.id).where(user_tz == tz_name)
+            active = (
+                Project.status == "active",
+                Project.start_date.isnot(None),
+                Project.user_id.in_(owners),
+            )
+            
+            result = db.execute(
+                update(Project)
+                .where(*active)
+                .values(current_day=_days_since(Project.start_date, today) + 1)
+                .execution_options(synchronize_session=False)
+            )
+            stats["advanced"] += result.rowcount
+            
+            # В командных проектах просрочиваются личные статусы участников, а не сами задачи
+            solo = Project.is_team.isnot(True)
+            current_day = select(Project.current_day).where(Project.id == DailyTask.project_id).scalar_subquery()
+            overdue = (
+                DailyTask.completed == "pending",
+                DailyTask.project_id.in_(select(Project.id).where(*active, solo)),
+                DailyTask.day_number < current_day
+            )
+            team_overdue = (
+                MemberTask.completed == "pending",
+                MemberTask.task_id.in_(
+                    select(DailyTask.id)
+                    .join(Project, Project.id == DailyTask.project_id)
+                    .where(*active, Project.is_team.is_(True), DailyTask.day_number < Project.current_day)
+                )
+            )
+            # Просроченные задачи по владельцам и участникам — для сводок /stats
+            overdue_by_user = db.execute(
+                select(Project.user_id, func.count(DailyTask.id))
+                .join(Project, Project.id == DailyTask.project_id)
+                .where(*active, solo, DailyTask.completed == "pending", DailyTask.day_number < Project.current_day)
+                .group_by(Project.user_id)
+            ).all() + db.execute(
+                select(MemberTask.user_id, func.count()).where(*team_overdue).group_by(MemberTask.user_id)
+            ).all()
+            skipped = 0
+            for table, conditions in ((DailyTask, overdue), (MemberTask, team_overdue)):
+                result = db.execute(
+                    update(table)
+                    .where(*conditions)
+                    .values(completed="skipped", completed_at=utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                skipped += result.rowcount
+            stats["skipped_tasks"] += skipped
+            if overdue_by_user:
+                deltas = {}
+                for user_id, count in overdue_by_user:
+                    if user_id is None:
+                        continue
+                    changes = deltas.setdefault(user_id, {"tasks_skipped": 0, "tasks_overdue": 0})
+                    changes["tasks_skipped"] += count
+                    changes["tasks_overdue"] += count
+                bump_user_stats(db, deltas)
+                bump_daily_stats(db, utcnow().date(), tasks_overdue=skipped)
+            
+            finished = (*active, _days_since(Project.end_date, today) > 0)
+            bump_user_stats(db, project_stats_deltas(db, *finished, sign=-1, columns=("projects_active",)))
+            result = db.execute(
+                update(Project)
+                .where(*finished)
+                .values(status="completed", next_reminder_at=None, reminder_utc_minute=None)
+                .execution_options(synchronize_session=False)
+            )
+            stats["completed"] += result.rowcount
+        
+        db.commit()
+        return stats
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def _insert(model):
+    """INSERT с поддержкой ON CONFLICT для текущего диалекта"""
+    # Модуль диалекта импортируем по месту: на старте грузится только используемый
+    if get_engine().dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(model)
+
+def claim_deliveries(db, keys, batch_size=500):
+    """Занимает слоты напоминаний пакетами INSERT ... ON CONFLICT DO NOTHING.
+
+    keys — список (project_pk, day_number, slot, user_id получателя). Возвращает
+    словарь {ключ: id записи журнала} только для слотов, занятых этим вызовом:
+    уже занятые (другим процессом или до перезапуска) слоты не возвращаются.
+    Ключи вставляются частями по batch_size, чтобы большой слот (например,
+    09:00) не упирался в лимит параметров запроса SQLite.
+    Коммит остается за вызывающим кодом.
+    """
+    claimed = {}
+    now = utcnow()
+    for i in range(0, len(keys), batch_size):
+        stmt = (
+            _insert(ReminderDelivery)
+            .values([
+                {
+                    "project_id": pk, "day_number": day, "slot": slot, "user_id": user_id,
+                    "status": "claimed", "claimed_at": now,
+                }
+                for pk, day, slot, user_id in keys[i:i + batch_size]
+            ])
+            .on_conflict_do_nothing(index_elements=["project_id", "day_number", "slot", "user_id"])
+            .returning(
+                ReminderDelivery.id, ReminderDelivery.project_id, ReminderDelivery.day_number,
+                ReminderDelivery.slot, ReminderDelivery.user_id,
+            )
+        )
+        claimed.update(
+            ((pk, day, slot, user_id), delivery_id) for delivery_id, pk, day, slot, user_id in db.execute(stmt).all()
+        )
+    return claimed
+
+def _record_deliveries(db, results):
+    """Пакетно сохраняет итоги отправки: список (delivery_id, status, sent_at)"""
+    db.execute(
+        update(ReminderDelivery),
+        [{"id": delivery_id, "status": status, "sent_at": sent_at} for delivery_id, status, sent_at in results]
+    )
+    sent = sum(1 for _, status, _ in results if status == "sent")
+    failed = sum(1 for _, status, _ in results if status == "failed")
+    bump_daily_stats(db, utcnow().date(), reminders_sent=sent, reminders_failed=failed)
+
+def enqueue_message(db, kind, chat_id, text, reply_markup=None, delivery_ids=()):
+    """Добавляет уведомление в outbox в текущей транзакции; коммит за вызывающим кодом"""
+    db.add(OutboxMessage(
+        kind=kind,
+        chat_id=chat_id,
+        text=text,
+        reply_markup=reply_markup,
+        delivery_ids=",".join(map(str, delivery_ids)) or None,
+        next_attempt_at=utcnow()
+    ))
+
+def enqueue_messages(db, kind, messages):
+    """Добавляет пачку уведомлений в outbox одним пакетным INSERT.
+
+    messages — список (chat_id, текст, клавиатура JSON или None, delivery_ids).
+    Коммит остается за вызывающим кодом.
+    """
+    if not messages:
+        return
+    now = utcnow()
+    db.execute(insert(OutboxMessage), [
+        {
+            "kind": kind,
+            "chat_id": chat_id,
+            "text": text,
+            "reply_markup": reply_markup,
+            "delivery_ids": ",".join(map(str, delivery_ids)) or None,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        }
+        for chat_id, text, reply_markup, delivery_ids in messages
+    ])
+
+def due_outbox(limit, lease_seconds=OUTBOX_LEASE_SECONDS):
+    """Занимает очередную пачку неотправленных уведомлений, старые первыми.
+
+    Пачка одним UPDATE ... RETURNING переводится в status='sending' с арендой
+    до now + lease_seconds, поэтому два экземпляра бота (например, при
+    перевыкатке) не отправят одни и те же сообщения. На PostgreSQL строки,
+    занятые параллельной транзакцией, пропускаются (SKIP LOCKED). Если
+    экземпляр упал, не дописав итоги, по истечении аренды пачку займет другой.
+    Если отправлять нечего, выполняется только одно чтение.
+    """
+    now = utcnow()
+    is_due = (OutboxMessage.status.in_(("pending", "sending")), OutboxMessage.next_attempt_at <= now)
+    # Задача работает каждую секунду: пустую очередь проверяем чтением по индексу,
+    # не открывая пишущую транзакцию (в SQLite она конкурировала бы с настоящими записями)
+    with get_engine().connect() as conn:
+        if conn.execute(select(OutboxMessage.id).where(*is_due).limit(1)).first() is None:
+            return []
+    due = (
+        select(OutboxMessage.id)
+        .where(*is_due)
+        .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+        .limit(limit)
+    )
+    if get_engine().dialect.name == "postgresql":
+        due = due.with_for_update(skip_locked=True)
+    db = SessionLocal()
+    try:
+        batch = db.execute(
+            update(OutboxMessage)
+            .where(OutboxMessage.id.in_(due.scalar_subquery()))
+            .values(status="sending", next_attempt_at=now + timedelta(seconds=lease_seconds))
+            .returning(
+                OutboxMessage.id, OutboxMessage.kind, OutboxMessage.chat_id, OutboxMessage.text,
+                OutboxMessage.reply_markup, OutboxMessage.delivery_ids, OutboxMessage.attempts,
+                OutboxMessage.created_at,
+            )
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    return sorted(batch, key=lambda message: message.id)
+
+def finish_outbox(results):
+    """Пакетно сохраняет итоги отправки пачки outbox.
+
+    results — список словарей {id, status, attempts, next_attempt_at, last_error,
+    sent_at, delivery_ids}. Для напоминаний окончательный итог (sent/failed/expired)
+    одновременно записывается в журнал доставки.
+    """
+    if not results:
+        return
+    db = SessionLocal()
+    try:
+        db.execute(update(OutboxMessage), [
+            {key: value for key, value in result.items() if key != "delivery_ids"}
+            for result in results
+        ])
+        ledger = [
+            (int(delivery_id), result["status"], result["sent_at"])
+            for result in results if result["status"] != "pending" and result["delivery_ids"]
+            for delivery_id in result["delivery_ids"].split(",")
+        ]
+        if ledger:
+            _record_deliveries(db, ledger)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def load_update_offset():
+    """Наибольший обработанный update_id, сохраненный до перезапуска, или None"""
+    with get_engine().connect() as conn:
+        return conn.execute(select(UpdateOffset.last_update_id).where(UpdateOffset.id == 1)).scalar()
+
+def save_update_offset(update_id):
+    """Сохраняет наибольший обработанный update_id одним UPSERT"""
+    stmt = _insert(UpdateOffset).values(id=1, last_update_id=update_id)
+    with get_engine().begin() as conn:
+        conn.execute(stmt.on_conflict_do_update(index_elements=["id"], set_={"last_update_id": update_id}))
+
+# Журнал событий: отдельная таблица events_ГГГГММ на каждый месяц. Запросы по
+# пользователю или проекту идут по индексам месячных таблиц от новых к старым,
+# а старые месяцы удаляются целиком через DROP TABLE
+_event_metadata = MetaData()
+_event_tables = {}  # "ГГГГММ" -> Table
+_event_months = None  # Существующие месячные таблицы, новые первыми
+EVENT_TABLE_PATTERN = re.compile(r"^events_(\d{6})$")
+
+def _event_table(month):
+    """Месячная таблица журнала; создается при первом обращении"""
+    global _event_months
+    table = _event_tables.get(month)
+    if table is None:
+        name = f"events_{month}"
+        table = Table(
+            name, _event_metadata,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("occurred_at", DateTime, nullable=False),
+            Column("actor_id", BigInteger, nullable=True),  # Кто совершил действие (None — сам бот)
+            Column("event_type", String(30), nullable=False),
+            Column("project_id", String(10), nullable=True),  # Публичный номер: переживает удаление проекта
+            Column("subject_id", BigInteger, nullable=True),  # Затронутый пользователь (владелец, назначенный)
+            Column("details", Text, nullable=True),  # JSON
+            Index(f"ix_{name}_actor", "actor_id", "occurred_at"),
+            Index(f"ix_{name}_subject", "subject_id", "occurred_at"),
+            Index(f"ix_{name}_project", "project_id", "occurred_at"),
+        )
+        table.create(get_engine(), checkfirst=True)
+        _event_tables[month] = table
+        if _event_months is not None and month not in _event_months:
+            _event_months = sorted(_event_months + [month], reverse=True)
+    return table
+
+def event_months():
+    """Месяцы, за которые есть таблицы журнала (ГГГГММ), новые первыми"""
+    global _event_months
+    if _event_months is None:
+        names = inspect(get_engine()).get_table_names()
+        _event_months = sorted(
+            (match.group(1) for match in map(EVENT_TABLE_PATTERN.match, names) if match),
+            reverse=True
+        )
+    return _event_months
+
+def write_events(events):
+    """Пакетно записывает события: по одному INSERT на месяц, одной транзакцией.
+
+    events — список словарей с ключами колонок журнала (occurred_at обязателен).
+    """
+    by_month = {}
+    for item in events:
+        by_month.setdefault(item["occurred_at"].strftime("%Y%m"), []).append(item)
+    tables = {month: _event_table(month) for month in by_month}
+    with get_engine().begin() as conn:
+        for month, rows in by_month.items():
+            conn.execute(tables[month].insert(), rows)
+
+def query_events(db, actor_id=None, project_id=None, limit=20):
+    """Последние события пользователя (как автора или затронутого) или проекта.
+
+    Месячные таблицы просматриваются от новых к старым, пока не наберется limit.
+    """
+    found = []
+    for month in event_months():
+        table = _event_table(month)
+        stmt = select(table).order_by(table.c.occurred_at.desc(), table.c.id.desc()).limit(limit - len(found))
+        if project_id is not None:
+            stmt = stmt.where(table.c.project_id == project_id)
+        if actor_id is not None:
+            stmt = stmt.where((table.c.actor_id == actor_id) | (table.c.subject_id == actor_id))
+        found.extend(db.execute(stmt).mappings().all())
+        if len(found) >= limit:
+            break
+    return found
+
+def purge_event_months(keep_months):
+    """Удаляет таблицы журнала старше keep_months последних месяцев; возвращает удаленные месяцы"""
+    global _event_months
+    now = utcnow()
+    oldest_kept = (now.year * 12 + now.month - 1) - (keep_months - 1)
+    oldest = f"{oldest_kept // 12:04d}{oldest_kept % 12 + 1:02d}"
+    dropped = [month for month in event_months() if month < oldest]
+    for month in dropped:
+        _event_table(month).drop(get_engine(), checkfirst=True)
+        _event_metadata.remove(_event_tables.pop(month))
+    _event_months = [month for month in event_months() if month not in dropped]
+    return dropped
+
+# Статусы задач, для которых в сводках есть счетчики tasks_<статус>
+STATS_TASK_STATUSES = ("completed", "skipped")
+
+# Счетчики /stats от смены статусов копятся в памяти и пишутся пачкой
+# (flush_task_stats): нажатие кнопки остается одной записью в БД.
+# Несброшенное при сбое восстановит сверка rollup_stats()
+_pending_user_stats = {}  # user_id -> {колонка: приращение}
+_pending_daily_stats = {}  # день -> {колонка: приращение}
+
+def _add_deltas(target, key, deltas):
+    changes = target.setdefault(key, {})
+    for column, delta in deltas.items():
+        changes[column] = changes.get(column, 0) + delta
+
+def flush_task_stats():
+    """Записывает накопленные приращения счетчиков одной транзакцией.
+
+    Возвращает число пользователей, чьи счетчики обновлены. При ошибке
+    приращения возвращаются в буфер до следующего сброса.
+    """
+    if not _pending_user_stats and not _pending_daily_stats:
+        return 0
+    users, days = dict(_pending_user_stats), dict(_pending_daily_stats)
+    _pending_user_stats.clear()
+    _pending_daily_stats.clear()
+    db = SessionLocal()
+    try:
+        bump_user_stats(db, users)
+        for day, deltas in days.items():
+            bump_daily_stats(db, day, **deltas)
+        db.commit()
+    except Exception:
+        db.rollback()
+        for user_id, deltas in users.items():
+            _add_deltas(_pending_user_stats, user_id, deltas)
+        for day, deltas in days.items():
+            _add_deltas(_pending_daily_stats, day, deltas)
+        raise
+    finally:
+        db.close()
+    return len(users)
+
+def set_task_status(project_id, day_number, user_id, status):
+    """Меняет статус задачи: одно чтение по индексу и один условный UPDATE.
+
+    Чтение находит задачу и ее прежний статус (в командном проекте — личный
+    статус участника из member_tasks), чтобы сдвинуть счетчики сводки
+    (/stats). Сами счетчики не пишутся при каждом нажатии, а копятся в
+    памяти до flush_task_stats(). Возвращает True, если статус изменился, и
+    False, если задача не найдена, проект чужой или статус уже такой же.
+    """
+    db = SessionLocal()
+    try:
+        task = db.execute(
+            select(DailyTask.id, DailyTask.completed, Project.user_id, Project.is_team, MemberTask.completed)
+            .join(Project, Project.id == DailyTask.project_id)
+            .outerjoin(MemberTask, and_(MemberTask.task_id == DailyTask.id, MemberTask.user_id == user_id))
+            .where(Project.project_id == project_id, DailyTask.day_number == day_number)
+        ).first()
+        if not task:
+            return False
+        task_pk, task_status, owner_id, is_team, member_status = task
+        if is_team:
+            if member_status is None:
+                return False  # Не участник команды
+            table = MemberTask
+            key = (MemberTask.task_id == task_pk, MemberTask.user_id == user_id)
+            previous = member_status
+        else:
+            if owner_id != user_id:
+                return False
+            table, key, previous = DailyTask, (DailyTask.id == task_pk,), task_status
+        if previous == status:
+            return False
+        result = db.execute(
+            update(table)
+            .where(*key, table.completed == previous)
+            .values(completed=status, completed_at=utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    
+    deltas = {}
+    if status in STATS_TASK_STATUSES:
+        deltas[f"tasks_{status}"] = 1
+    if previous in STATS_TASK_STATUSES:
+        deltas[f"tasks_{previous}"] = -1
+    if result.rowcount and deltas:
+        _add_deltas(_pending_user_stats, user_id, deltas)
+        # Сводка за день считает задачи, решенные в этот день: смена уже
+        # принятого статуса не переносит задачу между днями и не уводит
+        # счетчик сегодняшнего дня в минус
+        if previous not in STATS_TASK_STATUSES:
+            _add_deltas(_pending_daily_stats, utcnow().date(), deltas)
+    return result.rowcount > 0
+
+def bump_user_stats(db, deltas):
+    """Прибавляет к счетчикам user_stats: deltas = {user_id: {колонка: приращение}}.
+
+    Один INSERT ... ON CONFLICT DO UPDATE на пользователя; коммит за вызывающим кодом.
+    """
+    for user_id, changes in deltas.items():
+        stmt = _insert(UserStats).values(user_id=user_id, updated_at=utcnow(), **{
+            column: max(delta, 0) for column, delta in changes.items()
+        })
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={column: getattr(UserStats, column) + delta for column, delta in changes.items()}
+        ))
+
+PROJECT_STATS_COLUMNS = ("projects_active", "tasks_total", "tasks_completed", "tasks_skipped")
+
+def project_stats_deltas(db, *conditions, sign=1, columns=PROJECT_STATS_COLUMNS):
+    """Вклад проектов, отобранных условиями на Project, в счетчики user_stats.
+
+    Правила те же, что у rollup_stats(): личный проект засчитывается
+    владельцу (задачи — по статусам), командный — каждому участнику (его
+    личные статусы задач), projects_active — если проект активен, шаблоны
+    не считаются. sign=-1 — чтобы вычесть вклад (завершение, удаление).
+    Считать нужно до изменения проектов. Возвращает
+    {user_id: {колонка: приращение}} для bump_user_stats().
+    """
+    solo = (
+        select(
+            Project.user_id,
+            Project.status,
+            func.count(DailyTask.id),
+            func.count(DailyTask.id).filter(DailyTask.completed == "completed"),
+            func.count(DailyTask.id).filter(DailyTask.completed == "skipped"),
+        )
+        .outerjoin(DailyTask, DailyTask.project_id == Project.id)
+        .where(*conditions, Project.is_team.isnot(True), Project.user_id.isnot(None), Project.status != "template")
+        .group_by(Project.id, Project.user_id, Project.status)
+    )
+    team = (
+        select(
+            ProjectMember.user_id,
+            Project.status,
+            func.count(MemberTask.task_id),
+            func.count(MemberTask.task_id).filter(MemberTask.completed == "completed"),
+            func.count(MemberTask.task_id).filter(MemberTask.completed == "skipped"),
+        )
+        .select_from(ProjectMember)
+        .join(Project, Project.id == ProjectMember.project_id)
+        .outerjoin(DailyTask, DailyTask.project_id == Project.id)
+        .outerjoin(MemberTask, and_(MemberTask.task_id == DailyTask.id, MemberTask.user_id == ProjectMember.user_id))
+        .where(*conditions, Project.status != "template")
+        .group_by(Project.id, ProjectMember.user_id, Project.status)
+    )
+    deltas = {}
+    for user_id, status, total, completed, skipped in db.execute(solo).all() + db.execute(team).all():
+        changes = deltas.setdefault(user_id, dict.fromkeys(columns, 0))
+        for column, value in (
+            ("projects_active", status == "active"), ("tasks_total", total),
+            ("tasks_completed", completed), ("tasks_skipped", skipped),
+        ):
+            if column in changes:
+                changes[column] += sign * value
+    return deltas
+
+def bump_daily_stats(db, day, **deltas):
+    """Прибавляет к счетчикам daily_stats за день `day`; коммит за вызывающим кодом"""
+    if not deltas:
+        return
+    stmt = _insert(DailyStats).values(day=day, **{column: max(delta, 0) for column, delta in deltas.items()})
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["day"],
+        set_={column: getattr(DailyStats, column) + delta for column, delta in deltas.items()}
+    ))
+
+def rollup_stats():
+    """Периодическая сверка сводок с исходными таблицами.
+
+    Пересчитывает по каждому пользователю число активных проектов и задач по
+    статусам (группирующие выборки по своим проектам и по участию в
+    командных) и записывает снимок активных
+    проектов за сегодня. Счетчик tasks_overdue не пересчитывается — он
+    копится только инкрементально. Возвращает число обновленных пользователей.
+    """
+    # Сначала дописываем накопленные нажатия, чтобы они не легли поверх пересчета
+    flush_task_stats()
+    db = SessionLocal()
+    try:
+        solo = Project.is_team.isnot(True)
+        task_counts = (
+            select(
+                Project.user_id,
+                func.count(DailyTask.id).label("total"),
+                func.count(DailyTask.id).filter(DailyTask.completed == "completed").label("completed"),
+                func.count(DailyTask.id).filter(DailyTask.completed == "skipped").label("skipped"),
+            )
+            .join(DailyTask, DailyTask.project_id == Project.id)
+            .where(Project.status != "template", Project.user_id.isnot(None), solo)
+            .group_by(Project.user_id)
+        )
+        member_task_counts = (
+            select(
+                MemberTask.user_id,
+                func.count(),
+                func.count().filter(MemberTask.completed == "completed"),
+                func.count().filter(MemberTask.completed == "skipped"),
+            )
+            .join(DailyTask, DailyTask.id == MemberTask.task_id)
+            .join(Project, Project.id == DailyTask.project_id)
+            .where(Project.status != "template")
+            .group_by(MemberTask.user_id)
+        )
+        active_counts = {}
+        for user_id, count in db.execute(
+            select(Project.user_id, func.count(Project.id))
+            .where(Project.status == "active", Project.user_id.isnot(None), solo)
+            .group_by(Project.user_id)
+        ).all() + db.execute(
+            select(ProjectMember.user_id, func.count())
+            .join(Project, Project.id == ProjectMember.project_id)
+            .where(Project.status == "active")
+            .group_by(ProjectMember.user_id)
+        ).all():
+            active_counts[user_id] = active_counts.get(user_id, 0) + count
+        
+        rows = {}
+        for user_id, total, completed, skipped in db.execute(task_counts).all() + db.execute(member_task_counts).all():
+            counts = rows.setdefault(user_id, {"tasks_total": 0, "tasks_completed": 0, "tasks_skipped": 0})
+            counts["tasks_total"] += total
+            counts["tasks_completed"] += completed
+            counts["tasks_skipped"] += skipped
+        for user_id in db.execute(select(UserStats.user_id)).scalars():
+            rows.setdefault(user_id, {"tasks_total": 0, "tasks_completed": 0, "tasks_skipped": 0})
+        now = utcnow()
+        for user_id, counts in rows.items():
+            counts.update(projects_active=active_counts.get(user_id, 0), updated_at=now)
+            stmt = _insert(UserStats).values(user_id=user_id, **counts)
+            db.execute(stmt.on_conflict_do_update(index_elements=["user_id"], set_=counts))
+        
+        # Снимок — число проектов, а не участий в них
+        active_total = db.execute(
+            select(func.count(Project.id)).where(Project.status == "active", Project.user_id.isnot(None))
+        ).scalar()
+        stmt = _insert(DailyStats).values(day=now.date(), active_projects=active_total)
+        db.execute(stmt.on_conflict_do_update(index_elements=["day"], set_={"active_projects": active_total}))
+        db.commit()
+        return len(rows)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def read_stats(db, days=7, top=15):
+    """Данные для /stats только из сводных таблиц: (итоги, лучшие пользователи, сводки за дни).
+
+    Итоги по всем пользователям считаются агрегатами в БД, строки
+    пользователей выбираются только первые `top` по выполненным задачам.
+    """
+    totals = db.execute(
+        select(
+            func.count(UserStats.user_id).label("users"),
+            func.coalesce(func.sum(UserStats.projects_active), 0).label("projects_active"),
+            func.coalesce(func.sum(UserStats.tasks_total), 0).label("tasks_total"),
+            func.coalesce(func.sum(UserStats.tasks_completed), 0).label("tasks_completed"),
+            func.coalesce(func.sum(UserStats.tasks_skipped), 0).label("tasks_skipped"),
+            func.coalesce(func.sum(UserStats.tasks_overdue), 0).label("tasks_overdue"),
+            func.max(UserStats.updated_at).label("updated_at"),
+        )
+        .join(User, User.id == UserStats.user_id)
+    ).one()
+    users = (
+        db.query(UserStats, User)
+        .join(User, User.id == UserStats.user_id)
+        .order_by(UserStats.tasks_completed.desc(), UserStats.user_id)
+        .limit(top)
+        .all()
+    )
+    daily = db.query(DailyStats).order_by(DailyStats.day.desc()).limit(days).all()
+    return totals, users, daily
+
 if __name__ == "__main__":
     print("Создание таблиц...")
     create_tables()
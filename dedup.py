@@ -0,0 +1,52 @@
+"""
+Защита от повторной обработки апдейтов Telegram (ретраи вебхука, перезапуски).
+
+Недавние update_id хранятся в ограниченном окне в памяти, а наибольший
+полностью обработанный update_id (high-water mark) периодически сохраняется
+в БД, чтобы после перезапуска не обрабатывать уже выполненные апдейты.
+"""
+from collections import deque
+
+# Если update_id меньше сохраненного на столько, Telegram начал нумерацию заново
+# (после недели без апдейтов номер следующего выбирается случайно)
+UPDATE_ID_RESET_GAP = 100000
+
+
+class UpdateDeduplicator:
+    """Окно последних update_id плюс high-water mark обработанных апдейтов"""
+
+    def __init__(self, window=2048):
+        self._window = window
+        self._order = deque()
+        self._seen = set()
+        self.high_water = None  # Наибольший обработанный update_id
+        self.saved = None  # Значение high_water, уже сохраненное в БД
+
+    def load(self, high_water):
+        """Восстанавливает high-water mark, сохраненный до перезапуска"""
+        self.high_water = self.saved = high_water
+
+    def is_duplicate(self, update_id):
+        """Проверяет апдейт и запоминает его; True — апдейт уже обрабатывался"""
+        if update_id in self._seen:
+            return True
+        if self.high_water is not None and update_id <= self.high_water:
+            if self.high_water - update_id < UPDATE_ID_RESET_GAP:
+                return True
+            # Нумерация началась заново — старая отметка больше не действует
+            self.high_water = None
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self._window:
+            self._seen.discard(self._order.popleft())
+        return False
+
+    def mark_done(self, update_id):
+        """Отмечает апдейт полностью обработанным"""
+        if self.high_water is None or update_id > self.high_water:
+            self.high_water = update_id
+
+    @property
+    def dirty(self):
+        """Есть ли несохраненное продвижение high-water mark"""
+        return self.high_water is not None and self.high_water != self.saved
@@ -0,0 +1,65 @@
+"""
+Журнал действий пользователей (кто создал, назначил, завершил, удалил проект).
+
+Обработчики только добавляют событие в буфер в памяти; в БД буфер уходит
+одной пакетной записью раз в EVENT_FLUSH_MS или при накоплении EVENT_FLUSH_SIZE
+событий, поэтому аудит не добавляет синхронную запись к каждой команде.
+"""
+import asyncio
+import json
+import logging
+
+from database import utcnow, write_events
+
+logger = logging.getLogger(__name__)
+
+
+class EventBuffer:
+    """Буфер событий с пакетным сбросом в журнал"""
+
+    def __init__(self, flush_size=100, max_size=10000, writer=write_events):
+        self.flush_size = flush_size
+        self.max_size = max_size  # Если БД недоступна, старые события вытесняются
+        self._writer = writer
+        self._events = []
+        self._flush_scheduled = False
+
+    def __len__(self):
+        return len(self._events)
+
+    def append(self, event_type, actor_id=None, project_id=None, subject_id=None, **details):
+        """Добавляет событие; при заполнении буфера планирует сброс сразу после текущего обработчика"""
+        self._events.append({
+            "occurred_at": utcnow(),
+            "actor_id": actor_id,
+            "event_type": event_type,
+            "project_id": project_id,
+            "subject_id": subject_id,
+            "details": json.dumps(details, ensure_ascii=False, default=str) if details else None,
+        })
+        if len(self._events) > self.max_size:
+            dropped = len(self._events) - self.max_size
+            del self._events[:dropped]
+            logger.warning(f"Буфер журнала переполнен, отброшено событий: {dropped}")
+        if len(self._events) >= self.flush_size and not self._flush_scheduled:
+            try:
+                asyncio.get_running_loop().call_soon(self.flush)
+                self._flush_scheduled = True
+            except RuntimeError:
+                # Вне цикла событий (скрипты) пишем сразу
+                self.flush()
+
+    def flush(self):
+        """Записывает накопленные события одной транзакцией"""
+        self._flush_scheduled = False
+        if not self._events:
+            return 0
+        batch = self._events[:]
+        del self._events[:len(batch)]
+        try:
+            self._writer(batch)
+        except Exception as e:
+            logger.error(f"Ошибка записи журнала событий: {e}")
+            self._events[:0] = batch
+            return 0
+        return len(batch)
@@ -0,0 +1,157 @@
+"""
+Экспорт расписания проектов в iCalendar (.ics) для команды /ical.
+
+Задачи читаются потоком с серверного курсора и сразу превращаются в события,
+поэтому выгрузка всей истории пользователя не держит в памяти все задачи.
+Блок событий каждого проекта кэшируется на диске под отпечатком версии
+проекта: файл пересобирается только для проектов, расписание которых менялось.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from scheduler import parse_reminder_time
+
+PRODID = "-//Project Manager Bot//RU"
+EVENT_DURATION = timedelta(minutes=30)
+# RFC 5545: строки длиннее 75 октетов переносятся
+LINE_LIMIT = 75
+
+
+def escape_text(value):
+    """Экранирует значение текстового свойства (обратная косая, ; , и переводы строк)"""
+    return (
+        value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+        .replace("\r\n", "\\n").replace("\n", "\\n")
+    )
+
+
+def fold_line(line):
+    """Строка свойства в байтах с CRLF; длинные строки переносятся, не разрывая символы UTF-8"""
+    data = line.encode("utf-8")
+    if len(data) <= LINE_LIMIT:
+        return data + b"\r\n"
+    parts = []
+    limit = LINE_LIMIT
+    while data:
+        cut = min(limit, len(data))
+        # Не режем многобайтовый символ: байты продолжения имеют вид 10xxxxxx
+        while cut < len(data) and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = LINE_LIMIT - 1  # Строка продолжения начинается с пробела
+    return b"\r\n ".join(parts) + b"\r\n"
+
+
+def _utc_stamp(moment):
+    return moment.strftime("%Y%m%dT%H%M%SZ")
+
+
+def calendar_header(name):
+    return b"".join(fold_line(line) for line in (
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{escape_text(name)}",
+    ))
+
+
+def calendar_footer():
+    return fold_line("END:VCALENDAR")
+
+
+def project_version(project):
+    """Отпечаток версии расписания проекта: меняется вместе с любым полем, попадающим в события"""
+    key = "|".join(str(value) for value in (
+        project.id, project.project_id, project.name, project.start_date, project.reminder_time,
+        project.days_count, project.created_at, project.timezone, project.tasks_count, project.last_task_id,
+    ))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def calendar_key(scope, versions):
+    """Отпечаток всего файла: область выгрузки плюс версии всех проектов в нем"""
+    key = scope + "|" + "|".join(f"{pk}:{version}" for pk, version in sorted(versions.items()))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def format_events(project, tasks):
+    """События проекта: по одному на задачу дня в reminder_time по часовому поясу владельца.
+
+    project — строка calendar_projects(), tasks — итератор (номер дня, описание).
+    Время переводится в UTC отдельно для каждого дня (переходы на летнее время).
+    """
+    tz = ZoneInfo(project.timezone)
+    at = parse_reminder_time(project.reminder_time or "09:00")
+    first_day = project.start_date.date()
+    title = escape_text(f"[{project.project_id}] {project.name}")
+    # DTSTAMP берется из проекта, чтобы блок событий не менялся без изменения версии
+    stamp = _utc_stamp(project.created_at or project.start_date)
+    for day_number, description in tasks:
+        day = first_day + timedelta(days=day_number - 1)
+        starts = datetime.combine(day, at, tzinfo=tz).astimezone(timezone.utc)
+        lines = (
+            "BEGIN:VEVENT",
+            f"UID:project-{project.id}-day-{day_number}@project-manager-bot",
+            f"DTSTAMP:{stamp}",
+            f"DTSTART:{_utc_stamp(starts)}",
+            f"DTEND:{_utc_stamp(starts + EVENT_DURATION)}",
+            f"SUMMARY:{title} — день {day_number}/{project.days_count}",
+            f"DESCRIPTION:{escape_text(description)}",
+            "END:VEVENT",
+        )
+        yield b"".join(fold_line(line) for line in lines)
+
+
+class CalendarCache:
+    """Кэш блоков событий по проектам на диске и file_id уже отправленных файлов"""
+
+    def __init__(self, directory=None, max_file_ids=1000):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "project-bot-ical")
+        self.max_file_ids = max_file_ids
+        self._file_ids = {}  # отпечаток всего файла -> file_id Telegram
+
+    def _path(self, project_pk, version):
+        # Своя папка на проект: очистка старых версий не перебирает весь кэш
+        return os.path.join(self.directory, str(project_pk), f"{version}.ics")
+
+    def has(self, project_pk, version):
+        return os.path.exists(self._path(project_pk, version))
+
+    def store(self, project_pk, version, events):
+        """Записывает блок событий проекта потоком; прежние версии проекта удаляются"""
+        path = self._path(project_pk, version)
+        project_dir = os.path.dirname(path)
+        os.makedirs(project_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=project_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for event in events:
+                    out.write(event)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        for name in os.listdir(project_dir):
+            if name.endswith(".ics") and os.path.join(project_dir, name) != path:
+                os.unlink(os.path.join(project_dir, name))
+
+    def copy_to(self, project_pk, version, out):
+        with open(self._path(project_pk, version), "rb") as fragment:
+            shutil.copyfileobj(fragment, out)
+
+    def file_id(self, key):
+        return self._file_ids.get(key)
+
+    def remember_file_id(self, key, file_id):
+        """Запоминает file_id отправленного файла: повторная выгрузка не загружает его заново"""
+        self._file_ids.pop(key, None)
+        self._file_ids[key] = file_id
+        while len(self._file_ids) > self.max_file_ids:
+            del self._file_ids[next(iter(self._file_ids))]
@@ -0,0 +1,148 @@
+"""
+Профилирование обработчиков по запросу администратора (/profile).
+
+Пока профилирование выключено, обертка обработчика делает одну проверку флага,
+а обработчики событий SQLAlchemy не подключены вовсе. Во время сеанса работает
+cProfile, время обработчиков и SQL-запросов копится с привязкой к обработчику.
+"""
+import cProfile
+import functools
+import io
+import pstats
+import re
+import tempfile
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+# Обработчик, внутри которого сейчас выполняется код (для привязки SQL)
+_current_handler = ContextVar("current_handler", default="—")
+
+
+def _normalize_sql(statement):
+    """Схлопывает пробелы и списки параметров, чтобы одинаковые запросы группировались"""
+    statement = re.sub(r"\s+", " ", statement).strip()
+    statement = re.sub(r"\((?:\?|%\(\w+\)s|:\w+)(?:, (?:\?|%\(\w+\)s|:\w+))+\)", "(...)", statement)
+    return statement[:300]
+
+
+class HandlerProfiler:
+    """Сеанс профилирования: cProfile + время по обработчикам и SQL-запросам"""
+
+    def __init__(self):
+        self.active = False
+        self.started_at = None
+        self._profile = None
+        self._engines = ()
+        self._handlers = {}  # имя -> [вызовов, секунд]
+        self._sql = {}  # (обработчик, запрос) -> [вызовов, секунд]
+
+    def wrap(self, callback):
+        """Оборачивает обработчик или задачу JobQueue для учета времени"""
+        name = getattr(callback, "__name__", repr(callback))
+
+        @functools.wraps(callback)
+        async def profiled(*args, **kwargs):
+            if not self.active:
+                return await callback(*args, **kwargs)
+            token = _current_handler.set(name)
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                stats = self._handlers.setdefault(name, [0, 0.0])
+                stats[0] += 1
+                stats[1] += time.perf_counter() - started
+                _current_handler.reset(token)
+
+        return profiled
+
+    def instrument(self, application):
+        """Оборачивает все зарегистрированные обработчики, включая шаги диалогов"""
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self._instrument_handler(handler)
+
+    def _instrument_handler(self, handler):
+        nested = getattr(handler, "states", None)
+        if nested is not None:
+            for inner in handler.entry_points + handler.fallbacks:
+                self._instrument_handler(inner)
+            for state_handlers in nested.values():
+                for inner in state_handlers:
+                    self._instrument_handler(inner)
+            return
+        handler.callback = self.wrap(handler.callback)
+
+    def start(self, engines):
+        """Начинает сеанс; engines — движки SQLAlchemy, запросы которых учитываются"""
+        self._handlers = {}
+        self._sql = {}
+        self._engines = tuple({id(engine): engine for engine in engines}.values())
+        for engine in self._engines:
+            event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.started_at = time.perf_counter()
+        self.active = True
+
+    def stop(self):
+        """Завершает сеанс и возвращает (отчет в тексте, дамп pstats в байтах)"""
+        self.active = False
+        self._profile.disable()
+        duration = time.perf_counter() - self.started_at
+        for engine in self._engines:
+            event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+            event.remove(engine, "after_cursor_execute", self._after_cursor_execute)
+        self._engines = ()
+
+        stats = pstats.Stats(self._profile)
+        self._profile = None
+        with tempfile.NamedTemporaryFile(suffix=".pstats") as dump:
+            stats.dump_stats(dump.name)
+            dump.seek(0)
+            raw = dump.read()
+        return self._report(stats, duration), raw
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        pending = conn.info.get("profile_started")
+        if not pending:
+            return  # Запрос начался до включения профилирования
+        started = pending.pop()
+        key = (_current_handler.get(), _normalize_sql(statement))
+        stats = self._sql.setdefault(key, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started
+
+    def _report(self, stats, duration):
+        out = io.StringIO()
+        out.write(f"Профилирование: {duration:.1f} с\n\n")
+
+        out.write("Обработчики (вызовов, всего мс, среднее мс):\n")
+        handlers = sorted(self._handlers.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (calls, seconds) in handlers:
+            out.write(f"  {name:<32} {calls:>6} {seconds * 1000:>10.1f} {seconds * 1000 / calls:>8.2f}\n")
+        if not handlers:
+            out.write("  нет вызовов\n")
+
+        out.write("\nSQL по обработчикам (вызовов, всего мс, запрос):\n")
+        queries = sorted(self._sql.items(), key=lambda item: item[1][1], reverse=True)[:40]
+        for (handler, statement), (calls, seconds) in queries:
+            out.write(f"  [{handler}] {calls:>6} {seconds * 1000:>10.1f}  {statement}\n")
+        if not queries:
+            out.write("  нет запросов\n")
+
+        out.write("\ncProfile, топ-40 по суммарному времени:\n")
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(40)
+        return out.getvalue()
+
+    def summary(self):
+        """Короткая сводка для подписи к документу: самые долгие обработчики"""
+        top = sorted(self._handlers.items(), key=lambda item: item[1][1], reverse=True)[:3]
+        return ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, (_, seconds) in top)
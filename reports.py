@@ -0,0 +1,263 @@
+"""
+Еженедельные отчеты о выполнении задач: личные сводки и отчет по организации.
+
+Модуль не зависит от бота и БД: на вход — данные weekly_report_data(), на
+выход — готовые тексты и файлы. Функции запускаются в пуле процессов
+(ProcessPoolExecutor), поэтому сборка графиков и больших HTML/CSV не
+занимает цикл событий, который обслуживает апдейты.
+"""
+import csv
+import html
+import io
+import os
+from datetime import timedelta
+
+STATUSES = ("completed", "skipped", "pending")
+STATUS_LABELS = {"completed": "Выполнено", "skipped": "Пропущено", "pending": "Ожидает"}
+STATUS_COLORS = {"completed": "#4caf50", "skipped": "#ff9800", "pending": "#b0bec5"}
+DAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+BAR_WIDTH = 10  # Символов в текстовой полосе прогресса
+CHART_TOP_USERS = 30
+SUMMARY_MAX_PROJECTS = 10  # Проектов в личной сводке, остальные — строкой «и еще N»
+# Процессы отчетов работают с пониженным приоритетом, чтобы не отнимать CPU у бота
+WORKER_NICE = 10
+
+
+def lower_priority():
+    """Инициализатор процессов пула: понижает их приоритет планировщика ОС"""
+    try:
+        os.nice(WORKER_NICE)
+    except (AttributeError, OSError):
+        pass  # Windows или нет прав — работаем с обычным приоритетом
+
+
+def _empty():
+    return dict.fromkeys(STATUSES, 0)
+
+
+def _percent(part, whole):
+    return f"{part / whole * 100:.0f}%" if whole else "—"
+
+
+def summarize(data):
+    """Сворачивает строки (проект, пользователь, день недели, статус, количество) в сводки.
+
+    Возвращает словарь: by_user {user_id: счетчики}, by_user_day
+    {(user_id, день недели): счетчики}, by_user_project {(user_id, project_pk): счетчики},
+    by_project {project_pk: счетчики}, by_day {день недели: счетчики}, total.
+    """
+    summary = {
+        "by_user": {}, "by_user_day": {}, "by_user_project": {},
+        "by_project": {}, "by_day": {}, "total": _empty(),
+    }
+    for project_pk, user_id, day, status, count in data["rows"]:
+        status = status if status in STATUSES else "pending"
+        for bucket, key in (
+            ("by_user", user_id), ("by_user_day", (user_id, day)), ("by_user_project", (user_id, project_pk)),
+            ("by_project", project_pk), ("by_day", day),
+        ):
+            summary[bucket].setdefault(key, _empty())[status] += count
+        summary["total"][status] += count
+    return summary
+
+
+def _week_days(data):
+    return [data["week_start"] + timedelta(days=i) for i in range(7)]
+
+
+def _bar(done, total):
+    filled = round(done / total * BAR_WIDTH) if total else 0
+    return "▓" * filled + "░" * (BAR_WIDTH - filled)
+
+
+def render_user_summaries(data):
+    """Личные сводки за неделю в HTML-разметке Telegram: список (user_id, текст)"""
+    summary = summarize(data)
+    projects = data["projects"]
+    period = f"{data['week_start'].strftime('%d.%m')}–{data['week_end'].strftime('%d.%m')}"
+    user_projects = {}
+    for (user_id, project_pk), counts in summary["by_user_project"].items():
+        user_projects.setdefault(user_id, []).append((project_pk, counts))
+    messages = []
+    for user_id, counts in sorted(summary["by_user"].items()):
+        total = sum(counts.values())
+        lines = [
+            f"📊 <b>Итоги недели {period}</b>",
+            "",
+            f"✅ Выполнено: {counts['completed']} из {total} ({_percent(counts['completed'], total)})",
+            f"⏭ Пропущено: {counts['skipped']} · ⏳ Ожидает: {counts['pending']}",
+            "",
+        ]
+        for week_day, day in enumerate(_week_days(data)):
+            day_counts = summary["by_user_day"].get((user_id, week_day))
+            if not day_counts:
+                continue
+            day_total = sum(day_counts.values())
+            lines.append(
+                f"<code>{DAY_NAMES[day.weekday()]} {day.strftime('%d.%m')} "
+                f"{_bar(day_counts['completed'], day_total)}</code> {day_counts['completed']}/{day_total}"
+            )
+        lines += ["", "📋 <b>По проектам:</b>"]
+        user_rows = sorted(user_projects[user_id])
+        for project_pk, project_counts in user_rows[:SUMMARY_MAX_PROJECTS]:
+            project_id, name, _, _ = projects[project_pk]
+            lines.append(
+                f"• [{project_id}] {html.escape(name)} — "
+                f"{project_counts['completed']}/{sum(project_counts.values())}"
+            )
+        if len(user_rows) > SUMMARY_MAX_PROJECTS:
+            lines.append(f"… и еще {len(user_rows) - SUMMARY_MAX_PROJECTS}")
+        messages.append((user_id, "\n".join(lines)))
+    return messages
+
+
+def svg_stacked_bars(labels, series, width=720, height=260):
+    """Вертикальные столбцы с накоплением: series — список {статус: значение} на каждую подпись"""
+    margin_left, margin_bottom, margin_top = 40, 30, 20
+    plot_height = height - margin_bottom - margin_top
+    peak = max((sum(values.values()) for values in series), default=0) or 1
+    step = (width - margin_left) / max(len(labels), 1)
+    bar = step * 0.6
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="sans-serif" font-size="11">']
+    parts.append(f'<line x1="{margin_left}" y1="{height - margin_bottom}" x2="{width}" y2="{height - margin_bottom}" stroke="#888"/>')
+    parts.append(f'<text x="{margin_left - 6}" y="{margin_top + 4}" text-anchor="end">{peak}</text>')
+    for i, (label, values) in enumerate(zip(labels, series)):
+        x = margin_left + i * step + (step - bar) / 2
+        y = height - margin_bottom
+        for status in STATUSES:
+            value = values.get(status, 0)
+            if not value:
+                continue
+            h = value / peak * plot_height
+            y -= h
+            parts.append(
+                f'<rect x="{x:.1f}" y="{y:.1f}" width="{bar:.1f}" height="{h:.1f}" fill="{STATUS_COLORS[status]}">'
+                f'<title>{STATUS_LABELS[status]}: {value}</title></rect>'
+            )
+        parts.append(
+            f'<text x="{x + bar / 2:.1f}" y="{height - margin_bottom + 16}" text-anchor="middle">{html.escape(label)}</text>'
+        )
+    parts.append("</svg>")
+    return "".join(parts)
+
+
+def svg_completion_bars(rows, width=720, row_height=18):
+    """Горизонтальные полосы доли выполненных задач: rows — список (подпись, выполнено, всего)"""
+    label_width = 200
+    height = row_height * len(rows) + 10
+    plot_width = width - label_width - 60
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="sans-serif" font-size="11">']
+    for i, (label, done, total) in enumerate(rows):
+        y = i * row_height + 5
+        share = done / total if total else 0
+        parts.append(f'<text x="{label_width - 6}" y="{y + 12}" text-anchor="end">{html.escape(label[:32])}</text>')
+        parts.append(f'<rect x="{label_width}" y="{y}" width="{plot_width}" height="{row_height - 4}" fill="#eceff1"/>')
+        parts.append(
+            f'<rect x="{label_width}" y="{y}" width="{plot_width * share:.1f}" height="{row_height - 4}" '
+            f'fill="{STATUS_COLORS["completed"]}"/>'
+        )
+        parts.append(f'<text x="{label_width + plot_width + 6}" y="{y + 12}">{_percent(done, total)}</text>')
+    parts.append("</svg>")
+    return "".join(parts)
+
+
+def _html_table(headers, rows):
+    head = "".join(f"<th>{html.escape(str(cell))}</th>" for cell in headers)
+    body = "".join(
+        "<tr>" + "".join(f"<td>{html.escape(str(cell))}</td>" for cell in row) + "</tr>"
+        for row in rows
+    )
+    return f"<table><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+
+
+def render_org_report(data):
+    """Отчет по организации: список файлов (имя, содержимое в байтах) — HTML с графиками и CSV"""
+    summary = summarize(data)
+    users, projects = data["users"], data["projects"]
+    days = _week_days(data)
+    period = f"{data['week_start'].strftime('%d.%m.%Y')}–{data['week_end'].strftime('%d.%m.%Y')}"
+    total = summary["total"]
+    total_count = sum(total.values())
+
+    user_rows = sorted(
+        summary["by_user"].items(),
+        key=lambda item: (-item[1]["completed"], users.get(item[0], str(item[0])))
+    )
+    project_rows = sorted(summary["by_project"].items(), key=lambda item: projects[item[0]][0])
+
+    day_chart = svg_stacked_bars(
+        [f"{DAY_NAMES[day.weekday()]} {day.strftime('%d.%m')}" for day in days],
+        [summary["by_day"].get(week_day, _empty()) for week_day in range(len(days))]
+    )
+    user_chart = svg_completion_bars([
+        (users.get(user_id, str(user_id)), counts["completed"], sum(counts.values()))
+        for user_id, counts in user_rows[:CHART_TOP_USERS]
+    ])
+    legend = " ".join(
+        f'<span style="color:{STATUS_COLORS[status]}">■</span> {STATUS_LABELS[status]}' for status in STATUSES
+    )
+    users_table = _html_table(
+        ["Пользователь", "Всего", "Выполнено", "Пропущено", "Ожидает", "Выполнение"],
+        [
+            (users.get(user_id, user_id), sum(counts.values()), counts["completed"], counts["skipped"],
+             counts["pending"], _percent(counts["completed"], sum(counts.values())))
+            for user_id, counts in user_rows
+        ]
+    )
+    projects_table = _html_table(
+        ["ID", "Проект", "Владелец", "Тип", "Всего", "Выполнено", "Пропущено", "Ожидает", "Выполнение"],
+        [
+            (projects[pk][0], projects[pk][1], users.get(projects[pk][2], projects[pk][2] or "—"),
+             "команда" if projects[pk][3] else "личный", sum(counts.values()), counts["completed"],
+             counts["skipped"], counts["pending"], _percent(counts["completed"], sum(counts.values())))
+            for pk, counts in project_rows
+        ]
+    )
+    report = f"""<!DOCTYPE html>
+<html lang="ru"><head><meta charset="utf-8"><title>Отчет за неделю {period}</title>
+<style>
+body {{ font-family: sans-serif; margin: 24px; color: #263238; }}
+table {{ border-collapse: collapse; margin: 12px 0 28px; }}
+th, td {{ border: 1px solid #cfd8dc; padding: 4px 8px; text-align: right; }}
+th:first-child, td:first-child, td:nth-child(2) {{ text-align: left; }}
+th {{ background: #eceff1; }}
+</style></head><body>
+<h1>Отчет за неделю {period}</h1>
+<p>Задач: <b>{total_count}</b> · выполнено <b>{total['completed']}</b> ({_percent(total['completed'], total_count)})
+· пропущено <b>{total['skipped']}</b> · ожидает <b>{total['pending']}</b> · участников <b>{len(user_rows)}</b></p>
+<h2>Задачи по дням</h2>
+<p>{legend}</p>
+{day_chart}
+<h2>Выполнение по пользователям</h2>
+{user_chart}
+{users_table}
+<h2>Проекты</h2>
+{projects_table}
+</body></html>
+"""
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["week_start", "project_id", "project", "team", "user_id", "user", *STATUSES])
+    for (user_id, project_pk), counts in sorted(summary["by_user_project"].items()):
+        project_id, name, _, is_team = projects[project_pk]
+        writer.writerow([
+            data["week_start"].isoformat(), project_id, name, int(bool(is_team)), user_id,
+            users.get(user_id, ""), *(counts[status] for status in STATUSES)
+        ])
+
+    stamp = data["week_start"].strftime("%Y-%m-%d")
+    return [
+        (f"report-{stamp}.html", report.encode("utf-8")),
+        # BOM, чтобы Excel открыл кириллицу без выбора кодировки
+        (f"report-{stamp}.csv", out.getvalue().encode("utf-8-sig")),
+    ]
+
+
+def render_weekly_report(data, user_summaries=False):
+    """Точка входа для пула процессов: (файлы отчета, личные сводки).
+
+    Данные передаются в процесс один раз на оба результата — их
+    сериализация идет в потоке бота и держит GIL.
+    """
+    return render_org_report(data), render_user_summaries(data) if user_summaries else []
@@ -0,0 +1,113 @@
+"""
+Планировщик напоминаний: расчёт следующего срабатывания с учётом часового пояса
+и куча ближайших событий для диспетчера.
+
+Все моменты времени хранятся в БД как наивные datetime в UTC.
+"""
+import heapq
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+def is_valid_timezone(tz_name):
+    """Проверяет, что строка — известное имя часового пояса IANA"""
+    try:
+        ZoneInfo(tz_name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def local_now(tz_name, now=None):
+    """Текущее время в часовом поясе пользователя"""
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(tz_name))
+
+
+def parse_reminder_time(value):
+    """'HH:MM' -> datetime.time; бросает ValueError на некорректном значении"""
+    hours, minutes = value.split(":")
+    return time(int(hours), int(minutes))
+
+
+def utc_minute_of_day(moment):
+    """Минута суток (0..1439) наивного UTC-времени — корзина напоминания"""
+    return moment.hour * 60 + moment.minute
+
+
+def next_fire_time(start_date, days_count, reminder_time, tz_name, after):
+    """Ближайшее срабатывание напоминания строго после `after` (наивный UTC).
+
+    Возвращает пару (момент в UTC, номер дня проекта) или None, если проект
+    уже закончился. Локальное время переводится в UTC отдельно для каждого дня,
+    поэтому переходы на летнее/зимнее время учитываются: несуществующее время
+    сдвигается вперёд, неоднозначное срабатывает один раз (первое вхождение).
+    """
+    if start_date is None or not days_count:
+        return None
+    tz = ZoneInfo(tz_name)
+    at = parse_reminder_time(reminder_time)
+    after_utc = after.replace(tzinfo=timezone.utc)
+
+    first_day = start_date.date() if isinstance(start_date, datetime) else start_date
+    last_day = first_day + timedelta(days=days_count - 1)
+    day = max(first_day, after_utc.astimezone(tz).date())
+
+    while day <= last_day:
+        fire_at = datetime.combine(day, at, tzinfo=tz).astimezone(timezone.utc)
+        if fire_at > after_utc:
+            return fire_at.replace(tzinfo=None), (day - first_day).days + 1
+        day += timedelta(days=1)
+    return None
+
+
+class ReminderScheduler:
+    """Куча ближайших напоминаний: O(log n) на добавление и извлечение события.
+
+    Для каждого проекта хранится одно актуальное время срабатывания; устаревшие
+    записи в куче не удаляются сразу, а пропускаются при извлечении.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._next = {}
+
+    def __len__(self):
+        return len(self._next)
+
+    def load(self, entries):
+        """Заполняет кучу парами (project_pk, fire_at) за O(n)"""
+        self._next = {pk: fire_at for pk, fire_at in entries if fire_at is not None}
+        self._heap = [(fire_at, pk) for pk, fire_at in self._next.items()]
+        heapq.heapify(self._heap)
+
+    def schedule(self, project_pk, fire_at):
+        """Назначает (или снимает, если fire_at is None) напоминание проекта"""
+        if fire_at is None:
+            self._next.pop(project_pk, None)
+            return
+        if self._next.get(project_pk) == fire_at:
+            return
+        self._next[project_pk] = fire_at
+        heapq.heappush(self._heap, (fire_at, project_pk))
+        if len(self._heap) > 2 * len(self._next) + 64:
+            self.load(self._next.items())
+
+    def peek(self):
+        """Время ближайшего актуального срабатывания или None"""
+        while self._heap:
+            fire_at, pk = self._heap[0]
+            if self._next.get(pk) == fire_at:
+                return fire_at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        """Извлекает все события с временем <= now: список (project_pk, fire_at)"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, pk = heapq.heappop(self._heap)
+            if self._next.get(pk) != fire_at:
+                continue
+            del self._next[pk]
+            due.append((pk, fire_at))
+        return due